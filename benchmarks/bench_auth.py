@@ -0,0 +1,81 @@
+"""Compare auth token schemes.
+
+Usage: python benchmarks/bench_auth.py [iterations]
+"""
+from hashlib import sha512
+import hmac
+import os
+import os.path
+import sys
+from timeit import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'flask'))
+
+from motdplayer.tokens import (
+    get_legacy_token, HMACTokenizer, verify_legacy_token)
+
+
+SERVER_SALT = os.urandom(32)
+FIELDS = (
+    "x" * 64,               # personal salt
+    "my_server01",          # server ID
+    "example2",             # plugin ID
+    "76561197960265728",    # SteamID64
+    "main",                 # page ID
+    17,                     # session ID
+)
+
+
+def get_hmac_token_unkeyed(*fields):
+    # What HMACTokenizer would cost without the pre-absorbed key
+    mac = hmac.new(SERVER_SALT, digestmod=sha512)
+    mac.update('\n'.join(map(str, fields)).encode('ascii'))
+    return mac.hexdigest()
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    tokenizer = HMACTokenizer(SERVER_SALT)
+    tokenizer_short = HMACTokenizer(SERVER_SALT, token_size=32)
+
+    legacy_token = get_legacy_token(*FIELDS, SERVER_SALT)
+    hmac_token = tokenizer.get_token(*FIELDS)
+    hmac_token_short = tokenizer_short.get_token(*FIELDS)
+
+    assert verify_legacy_token(legacy_token, get_legacy_token(
+        *FIELDS, SERVER_SALT))
+    assert tokenizer.verify(hmac_token, *FIELDS)
+    assert tokenizer.verify(hmac_token_short, *FIELDS)
+
+    cases = (
+        ("legacy sha512, issue", len(legacy_token),
+         lambda: get_legacy_token(*FIELDS, SERVER_SALT)),
+        ("legacy sha512, verify", len(legacy_token),
+         lambda: verify_legacy_token(
+             legacy_token, get_legacy_token(*FIELDS, SERVER_SALT))),
+        ("hmac, new key, issue", len(legacy_token),
+         lambda: get_hmac_token_unkeyed(*FIELDS)),
+        ("hmac, issue", len(hmac_token),
+         lambda: tokenizer.get_token(*FIELDS)),
+        ("hmac, verify", len(hmac_token),
+         lambda: tokenizer.verify(hmac_token, *FIELDS)),
+        ("hmac/32, issue", len(hmac_token_short),
+         lambda: tokenizer_short.get_token(*FIELDS)),
+        ("hmac/32, verify", len(hmac_token_short),
+         lambda: tokenizer_short.verify(hmac_token_short, *FIELDS)),
+    )
+
+    print("{:<24}{:>8}{:>14}{:>16}".format(
+        "scheme", "chars", "us/token", "tokens/sec"))
+
+    for case_name, token_length, func in cases:
+        time = timeit(func, number=iterations)
+
+        print("{:<24}{:>8}{:>14.2f}{:>16.0f}".format(
+            case_name, token_length, time / iterations * 1e6,
+            iterations / time))
+
+
+if __name__ == "__main__":
+    main()
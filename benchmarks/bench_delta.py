@@ -0,0 +1,60 @@
+"""Compare full and delta-encoded WebSocket updates of a live scoreboard.
+
+Every update changes the ping of all players and the score of a few of
+them, like a HUD page that is refreshed several times per second.
+
+Usage: python benchmarks/bench_delta.py [updates]
+"""
+from copy import deepcopy
+import json
+import os.path
+import sys
+from timeit import timeit
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(__file__), '..', 'srcds', 'addons', 'source-python',
+    'packages', 'custom', 'motdplayer'))
+
+from delta import make_patch
+
+
+def make_scoreboard(players, tick):
+    return {
+        'action': "scoreboard",
+        'round_time': 115 - tick // 10,
+        'players': [{
+            'steamid': str(76561197960265728 + i),
+            'name': "Player {}".format(i),
+            'team': 2 + i % 2,
+            'kills': i * 3 % 41 + (tick // 7 if i % 13 == 0 else 0),
+            'deaths': i * 5 % 23,
+            'ping': 20 + (i + tick) % 80 // 10,
+        } for i in range(players)],
+    }
+
+
+def main():
+    updates = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+    print("{:<12}{:>14}{:>14}{:>16}".format(
+        "players", "full, bytes", "delta, bytes", "diff+copy, us"))
+
+    for players in (16, 64):
+        states = [make_scoreboard(players, tick) for tick in range(updates)]
+
+        full_size = sum(len(json.dumps(state)) for state in states)
+        delta_size = len(json.dumps(states[0])) + sum(
+            len(json.dumps(make_patch(old, new) or {}))
+            for old, new in zip(states, states[1:]))
+
+        diff_time = timeit(
+            lambda: [(make_patch(old, new), deepcopy(new))
+                     for old, new in zip(states, states[1:])], number=1)
+
+        print("{:<12}{:>14}{:>14}{:>16.2f}".format(
+            players, full_size // updates, delta_size // updates,
+            diff_time / (updates - 1) * 1e6))
+
+
+if __name__ == "__main__":
+    main()
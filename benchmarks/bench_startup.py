@@ -0,0 +1,148 @@
+"""Startup time of the web-application with many MoTD applications.
+
+Generates synthetic applications (a model, a few WRPs and a helper module
+each), then measures in fresh interpreters how long it takes to load them
+and upgrade an existing database, with and without manifests, and how
+long the first request for a lazily loaded application waits for its
+import.
+
+Usage: python benchmarks/bench_startup.py [applications]
+"""
+import json
+import os
+import os.path
+import subprocess
+import sys
+import tempfile
+
+FLASK_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         '..', 'flask')
+
+PACKAGE_NAME = "bench_applications"
+PAGES_PER_APPLICATION = 3
+HELPERS_PER_APPLICATION = 200
+
+APPLICATION_TEMPLATE = '''\
+from motdplayer import db, WebRequestProcessor
+
+from . import helpers
+
+
+class Record(db.Model):
+    __tablename__ = "bench_app{index}_records"
+
+    id = db.Column(db.Integer, primary_key=True)
+    steamid = db.Column(db.String(32), index=True)
+    value = db.Column(db.Integer)
+
+
+for page_index in range({pages}):
+    wrp = WebRequestProcessor("bench_app{index}", "page{{}}".format(
+        page_index))
+
+    @wrp.register_regular_callback
+    def callback(ex_data_func):
+        return "page.html", helpers.helper0(ex_data_func(dict()))
+'''
+
+HELPER_TEMPLATE = '''
+def helper{index}(data):
+    return {{key: value for key, value in data.items() if key != {index}}}
+'''
+
+
+def generate(dir_, applications):
+    package_dir = os.path.join(dir_, PACKAGE_NAME)
+    os.mkdir(package_dir)
+    open(os.path.join(package_dir, "__init__.py"), 'w').close()
+
+    for index in range(applications):
+        app_dir = os.path.join(package_dir, "app{}".format(index))
+        os.mkdir(app_dir)
+
+        with open(os.path.join(app_dir, "__init__.py"), 'w') as f:
+            f.write(APPLICATION_TEMPLATE.format(
+                index=index, pages=PAGES_PER_APPLICATION))
+
+        with open(os.path.join(app_dir, "helpers.py"), 'w') as f:
+            for helper_index in range(HELPERS_PER_APPLICATION):
+                f.write(HELPER_TEMPLATE.format(index=helper_index))
+
+        with open(os.path.join(app_dir, "manifest.json"), 'w') as f:
+            json.dump({"bench_app{}".format(index): [
+                "page{}".format(page_index)
+                for page_index in range(PAGES_PER_APPLICATION)]}, f)
+
+
+def run_child(dir_, lazy):
+    from time import perf_counter
+
+    sys.path[:0] = [FLASK_DIR, dir_]
+
+    from flask import Flask
+    from flask_sqlalchemy import SQLAlchemy
+
+    import motdplayer
+
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:///{}".format(
+        os.path.join(dir_, "bench.db"))
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+    db = SQLAlchemy(app)
+    motdplayer.init(app, None, db)
+
+    from motdplayer.applications import get_wrp, load_applications
+    from motdplayer.migrations import upgrade
+
+    started_at = perf_counter()
+    load_applications(
+        PACKAGE_NAME, os.path.join(dir_, PACKAGE_NAME), lazy=lazy,
+        preload=())
+
+    with app.app_context():
+        upgrade(db)
+
+    startup = perf_counter() - started_at
+
+    with app.app_context():
+        started_at = perf_counter()
+        get_wrp("bench_app0", "page0")
+        first_request = perf_counter() - started_at
+
+    print(json.dumps({'startup': startup, 'first_request': first_request}))
+
+
+def measure(dir_, lazy):
+    output = subprocess.check_output([
+        sys.executable, __file__, "--child", dir_, "lazy" if lazy else "eager",
+    ], cwd=FLASK_DIR)
+
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def main():
+    applications = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+
+    with tempfile.TemporaryDirectory() as dir_:
+        generate(dir_, applications)
+
+        print("{:<10}{:>14}{:>22}".format(
+            "loading", "startup, ms", "first request, ms"))
+
+        # Cold run first, so that both modes find compiled bytecode and
+        # the tables, like after a restart
+        measure(dir_, lazy=False)
+
+        for lazy in (False, True):
+            result = measure(dir_, lazy)
+            print("{:<10}{:>14.1f}{:>22.2f}".format(
+                "lazy" if lazy else "eager", result['startup'] * 1000,
+                result['first_request'] * 1000))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == "--child":
+        run_child(sys.argv[2], sys.argv[3] == "lazy")
+    else:
+        main()
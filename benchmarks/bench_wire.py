@@ -0,0 +1,87 @@
+"""Compare wire codecs used between Flask and SRCDS.
+
+Usage: python benchmarks/bench_wire.py [iterations]
+"""
+import os.path
+import sys
+from timeit import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'flask'))
+
+from motdplayer.wire import codecs
+
+
+def make_inventory(items):
+    return {
+        'status': "OK",
+        'custom_data': {
+            'action': "inventory",
+            'items': [{
+                'id': i,
+                'name': "Item #{}".format(i),
+                'class': "weapon_ak47" if i % 2 else "weapon_m4a1",
+                'amount': i % 7,
+                'equipped': i % 3 == 0,
+                'wear': i / 1000,
+            } for i in range(items)],
+        },
+    }
+
+
+def make_scoreboard(players):
+    return {
+        'status': "OK",
+        'custom_data': {
+            'action': "scoreboard",
+            'players': [{
+                'steamid': str(76561197960265728 + i),
+                'name': "Player {}".format(i),
+                'team': 2 + i % 2,
+                'kills': i * 3 % 41,
+                'deaths': i * 5 % 23,
+                'ping': 20 + i % 80,
+            } for i in range(players)],
+        },
+    }
+
+
+PAYLOADS = (
+    ("set-identity", {
+        'action': "set-identity",
+        'new_salt': "x" * 64,
+        'steamid': "76561197960265728",
+        'session_id': 1,
+        'request_type': "AJAX",
+    }),
+    ("scoreboard (64 players)", make_scoreboard(64)),
+    ("inventory (500 items)", make_inventory(500)),
+)
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+
+    if len(codecs) == 1:
+        print("Only JSON is available, install 'msgpack' to compare codecs")
+
+    print("{:<26}{:<10}{:>12}{:>14}{:>14}".format(
+        "payload", "codec", "bytes", "encode, us", "decode, us"))
+
+    for payload_name, payload in PAYLOADS:
+        for codec_name, codec in sorted(codecs.items()):
+            data = codec.encode(payload)
+            assert codec.decode(data) == payload
+
+            encode_time = timeit(
+                lambda: codec.encode(payload), number=iterations)
+            decode_time = timeit(
+                lambda: codec.decode(data), number=iterations)
+
+            print("{:<26}{:<10}{:>12}{:>14.2f}{:>14.2f}".format(
+                payload_name, codec_name, len(data),
+                encode_time / iterations * 1e6,
+                decode_time / iterations * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""CPU cost versus bytes saved by permessage-deflate on the gateway.
+
+A connection sends the same kind of message over and over (a player list
+refreshed every second, a stats table, a short chat line), so with the
+context kept between messages most of every message is a back-reference
+to the previous one.
+
+Usage: python benchmarks/bench_ws_compression.py [messages]
+"""
+import json
+import os.path
+import sys
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'flask'))
+
+from motdplayer.gateway import PerMessageDeflate
+from motdplayer.relay import encode_ws_message
+
+
+def make_player_list(players, tick):
+    return [{
+        'steamid': str(76561197960265728 + i),
+        'name': "Player {}".format(i),
+        'team': 2 + i % 2,
+        'ping': 20 + (i + tick) % 80 // 10,
+    } for i in range(players)]
+
+
+def make_stats_table(rows, tick):
+    return [{
+        'map': "de_map{}".format(i % 7),
+        'kills': i * 17 % 301 + tick,
+        'deaths': i * 11 % 207,
+        'headshots': i * 5 % 97,
+        'accuracy': round((i * 37 % 100) / 100, 2),
+        'time_played': 3600 + i * 45,
+    } for i in range(rows)]
+
+
+def make_chat_line(tick):
+    return {'author': "Player {}".format(tick % 16), 'text': "gg"}
+
+
+PAYLOADS = (
+    ("players x64", lambda tick: make_player_list(64, tick)),
+    ("stats x200", lambda tick: make_stats_table(200, tick)),
+    ("chat line", make_chat_line),
+)
+
+
+def main():
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+    print("{:<14}{:>7}{:>10}{:>13}{:>10}{:>12}".format(
+        "payload", "level", "context", "raw, bytes", "sent, %",
+        "us/message"))
+
+    for name, make_payload in PAYLOADS:
+        data = [encode_ws_message(
+            status="CUSTOM_DATA", custom_data=make_payload(tick))
+            for tick in range(messages)]
+
+        raw_size = sum(len(message) for message in data)
+
+        for level in (1, 6, 9):
+            for takeover in (True, False):
+                deflate = PerMessageDeflate(
+                    level, threshold=256,
+                    server_no_context_takeover=not takeover)
+
+                started_at = perf_counter()
+                sent_size = sum(len(deflate.compress(message)[0])
+                                for message in data)
+                duration = perf_counter() - started_at
+
+                print("{:<14}{:>7}{:>10}{:>13}{:>10.1f}{:>12.2f}".format(
+                    name, level, "kept" if takeover else "reset",
+                    raw_size // messages, sent_size / raw_size * 100,
+                    duration / messages * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,402 @@
+"""Local stand-in for a game server running MOTDPlayer.
+
+FakeSRCDS answers the same actions as MOTDPlayerRawReceiver (hello,
+set-identity, reset, switch, custom-data, close-stream) over plain TCP.
+Streamed answers are sent at once rather than spread over ticks.
+It also plays the receiving end of CCP: the client asks for the plugin and
+for the RAW communication mode, waits for the communication to be accepted,
+then both sides exchange data packets until either of them ends it. So the
+load test drives the real MOTDClient, handshake included.
+
+The packet layout (PACKET_HEADER and PacketType) is modelled on ccp, not
+taken from it. run.py makes one handshake with the installed ccp library
+before the load starts and refuses to report numbers if it fails.
+"""
+from enum import IntEnum
+from inspect import isgenerator
+import json
+from socket import IPPROTO_TCP, SHUT_RDWR, TCP_NODELAY
+from socketserver import BaseRequestHandler, ThreadingTCPServer
+import struct
+from threading import Lock, Thread
+
+from ccp.constants import CommunicationMode
+from ccp.transmit import CommunicationEnded
+
+from motdplayer import AuthMethod
+from motdplayer.database import HMAC_TOKEN_SIZE
+from motdplayer.tokens import get_legacy_token, HMACTokenizer
+from motdplayer.wire import codecs, JSONCodec
+
+from pages import PLUGIN_ID
+
+
+PLUGIN_NAME = "motdplayer"
+
+# Every CCP packet is its type and payload size followed by the payload
+PACKET_HEADER = struct.Struct('>BI')
+
+
+class PacketType(IntEnum):
+    REQUEST_PLUGIN = 1  # Payload: plugin name
+    SET_MODE = 2  # Payload: CommunicationMode
+    ACCEPT = 3
+    DATA = 4
+    END = 5
+
+
+class HandshakeError(Exception):
+    pass
+
+
+def receive_exactly(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise CommunicationEnded()
+
+        data += chunk
+
+    return data
+
+
+def send_packet(sock, packet_type, payload=b""):
+    sock.sendall(PACKET_HEADER.pack(packet_type, len(payload)) + payload)
+
+
+def receive_packet(sock):
+    packet_type, size = PACKET_HEADER.unpack(
+        receive_exactly(sock, PACKET_HEADER.size))
+
+    return packet_type, receive_exactly(sock, size)
+
+
+class FakePlayer:
+    def __init__(self, steamid64):
+        self.steamid64 = steamid64
+        self.salt = ""
+        self.sessions = {}
+        self.next_session_id = 1
+        self.lock = Lock()
+
+
+class FakeStream:
+    """Per-request state, like MOTDRequestStream."""
+    def __init__(self, connection, stream_id=None):
+        self.connection = connection
+        self.id = stream_id
+        self.player = None
+        self.session_id = None
+        self.request_type = None
+        self.ws_page = None
+
+    @property
+    def srcds(self):
+        return self.connection.server.srcds
+
+    def send_message(self, **kwargs):
+        if self.id is not None:
+            kwargs['stream_id'] = self.id
+
+        self.connection.send(self.connection.codec.encode(kwargs))
+
+    def stop(self):
+        if self.id is None:
+            self.connection.stop()
+        else:
+            self.connection.streams.pop(self.id, None)
+            self.send_message(status="STREAM_CLOSED")
+
+    def fail(self, status):
+        self.send_message(status=status)
+        self.stop()
+
+    def create_page(self, is_websocket=False):
+        page_class = self.srcds.pages[self.player.sessions[self.session_id]]
+        return page_class(
+            self.player.steamid64, is_websocket,
+            lambda data: self.send_message(status="OK", custom_data=data))
+
+    def on_message(self, message):
+        action = message.get('action')
+
+        if action == "reset":
+            if self.request_type == "WEBSOCKET":
+                self.stop()
+                return
+
+            self.player = self.session_id = self.request_type = None
+            self.send_message(status="OK")
+
+        elif action == "set-identity":
+            if self.player is not None:
+                self.stop()
+                return
+
+            player = self.srcds.players.get(message['steamid'])
+            if player is None:
+                self.fail("ERROR_UNKNOWN_STEAMID")
+                return
+
+            if message['session_id'] not in player.sessions:
+                self.fail("ERROR_SESSION_CLOSED_1")
+                return
+
+            self.player = player
+            self.session_id = message['session_id']
+            self.request_type = message['request_type']
+
+            if self.request_type == "WEBSOCKET":
+                page = self.create_page(is_websocket=True)
+                if not page.ws_support:
+                    self.fail("ERROR_NO_WS_SUPPORT")
+                    return
+
+                self.ws_page = page
+
+            if message['new_salt'] is not None:
+                with player.lock:
+                    player.salt = message['new_salt']
+
+            if self.ws_page is not None and message.get('flow_control'):
+                self.send_message(status="OK", ws_window=self.srcds.ws_window)
+            else:
+                self.send_message(status="OK")
+
+        elif action == "ack":
+            if self.ws_page is None:
+                self.stop()
+                return
+
+            with self.srcds.lock:
+                self.srcds.ws_acked += message['count']
+
+        elif action == "switch":
+            if self.player is None:
+                self.stop()
+                return
+
+            new_page_id = message['new_page_id']
+            if new_page_id not in self.srcds.pages:
+                self.fail("ERROR_UNKNOWN_PAGE")
+                return
+
+            if not self.create_page().on_switch_requested(new_page_id):
+                self.fail("ERROR_SWITCH_REFUSED")
+                return
+
+            with self.player.lock:
+                self.player.sessions[self.session_id] = new_page_id
+
+            self.send_message(status="OK")
+
+        elif action == "custom-data":
+            if self.player is None:
+                self.stop()
+                return
+
+            if self.ws_page is not None:
+                self.ws_page.on_data_received(message['custom_data'])
+                return
+
+            answer = self.create_page().on_data_received(
+                message['custom_data'])
+
+            if isgenerator(answer):
+                if not message.get('stream'):
+                    answer = list(answer)
+                else:
+                    for chunk in answer:
+                        self.send_message(status="CHUNK", custom_data=chunk)
+
+                    self.send_message(status="OK", stream_end=True)
+                    return
+
+            self.send_message(status="OK", custom_data=answer)
+
+        else:
+            self.stop()
+
+
+class FakeConnection(BaseRequestHandler):
+    """Single CCP connection from Flask, like MOTDPlayerRawReceiver."""
+    def setup(self):
+        self.request.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+
+        self.codec = JSONCodec
+        self.multiplex = False
+        self.default_stream = FakeStream(self)
+        self.streams = {}
+        self.stopped = False
+
+        self._send_lock = Lock()
+
+    def send(self, data):
+        with self._send_lock:
+            send_packet(self.request, PacketType.DATA, data)
+
+    def stop(self):
+        self.stopped = True
+        try:
+            with self._send_lock:
+                send_packet(self.request, PacketType.END)
+
+            self.request.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
+
+    def accept(self):
+        """Go through the CCP handshake.
+
+        :raise HandshakeError: if the client wants another plugin or mode
+        """
+        packet_type, plugin_name = receive_packet(self.request)
+        if (packet_type != PacketType.REQUEST_PLUGIN or
+                plugin_name != PLUGIN_NAME.encode('utf-8')):
+
+            raise HandshakeError("Unknown plugin")
+
+        packet_type, mode = receive_packet(self.request)
+        if (packet_type != PacketType.SET_MODE or
+                mode != bytes([CommunicationMode.RAW])):
+
+            raise HandshakeError("Unsupported communication mode")
+
+        with self._send_lock:
+            send_packet(self.request, PacketType.ACCEPT)
+
+    def on_hello(self, message):
+        features = [feature for feature in message.get('features', ())
+                    if feature in ("multiplex", )]
+
+        self.multiplex = "multiplex" in features
+        for name in message.get('codecs', ()):
+            if name in codecs:
+                self.codec = codecs[name]
+                break
+
+        # The reply itself is always JSON
+        self.send(json.dumps({
+            'status': "OK",
+            'features': features,
+            'codec': self.codec.name,
+        }).encode('utf-8'))
+
+    def handle(self):
+        try:
+            self.accept()
+        except (OSError, CommunicationEnded):
+            return
+        except HandshakeError:
+            self.stop()
+            return
+
+        while not self.stopped:
+            try:
+                packet_type, data = receive_packet(self.request)
+            except (OSError, CommunicationEnded):
+                return
+
+            # The client has stopped
+            if packet_type == PacketType.END:
+                return
+
+            if packet_type != PacketType.DATA:
+                self.stop()
+                return
+
+            # 'hello' comes first, while the codec is still JSON
+            message = self.codec.decode(data)
+            if message.get('action') == "hello":
+                self.on_hello(message)
+                continue
+
+            if not self.multiplex:
+                self.default_stream.on_message(message)
+                continue
+
+            stream_id = message.pop('stream_id')
+            if message.get('action') == "close-stream":
+                self.streams.pop(stream_id, None)
+                continue
+
+            stream = self.streams.get(stream_id)
+            if stream is None:
+                stream = self.streams[stream_id] = FakeStream(self, stream_id)
+
+            stream.on_message(message)
+
+
+class FakeSRCDSServer(ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeSRCDS:
+    def __init__(self, server_id, pages, server_salt,
+                 auth_method=AuthMethod.SRCDS, host="127.0.0.1", port=0,
+                 ws_window=64):
+
+        self.server_id = server_id
+        self.pages = pages
+        self.server_salt = server_salt
+        self.auth_method = auth_method
+        self.players = {}
+        self.ws_window = ws_window
+        self.ws_acked = 0
+        self.lock = Lock()
+
+        self._tokenizer = HMACTokenizer(server_salt, HMAC_TOKEN_SIZE)
+        self._players_lock = Lock()
+
+        self._server = FakeSRCDSServer((host, port), FakeConnection)
+        self._server.srcds = self
+        self._thread = None
+
+    @property
+    def addr(self):
+        return self._server.server_address
+
+    def start(self):
+        self._thread = Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def get_auth_token(self, player, page_id, session_id):
+        fields = (player.salt, self.server_id, PLUGIN_ID, player.steamid64,
+                  page_id, session_id)
+
+        if self.auth_method == AuthMethod.SRCDS_HMAC:
+            return self._tokenizer.get_token(*fields)
+
+        return get_legacy_token(*fields, self.server_salt)
+
+    def send_page(self, steamid64, page_id):
+        """Open a new MoTD session, like Page.send().
+
+        :return: arguments of the page URL
+        """
+        with self._players_lock:
+            player = self.players.get(steamid64)
+            if player is None:
+                player = self.players[steamid64] = FakePlayer(steamid64)
+
+        with player.lock:
+            session_id = player.next_session_id
+            player.next_session_id += 1
+            player.sessions[session_id] = page_id
+
+            return {
+                'server_id': self.server_id,
+                'plugin_id': PLUGIN_ID,
+                'page_id': page_id,
+                'steamid': int(steamid64),
+                'auth_method': int(self.auth_method),
+                'auth_token': self.get_auth_token(
+                    player, page_id, session_id),
+                'session_id': session_id,
+            }
@@ -0,0 +1,130 @@
+"""Page behaviours of the fake SRCDS.
+
+Every page has a game-server half (a FakePage subclass, registered with
+register_page) and a web half (the WebRequestProcessor created for it by
+register_wrps). Extra behaviours can live in any module that registers
+its pages on import, see run.py --page-module.
+"""
+from time import sleep
+
+
+PLUGIN_ID = "loadtest"
+PAGE_TEMPLATE = "loadtest/page.html"
+
+page_classes = {}
+
+
+def register_page(page_class):
+    page_classes[page_class.page_id] = page_class
+    return page_class
+
+
+class FakePage:
+    """Mimics motdplayer.Page on the game server.
+
+    A page instance serves a single request. WebSocket pages live as long
+    as the WebSocket does and answer through send_data.
+    """
+    page_id = None
+    ws_support = False
+
+    def __init__(self, steamid64, is_websocket, send_data=None):
+        self.steamid64 = steamid64
+        self.is_websocket = is_websocket
+        self.send_data = send_data
+
+    def on_data_received(self, data):
+        """Answer an INIT/AJAX request or handle WebSocket data."""
+        raise NotImplementedError
+
+    def on_switch_requested(self, new_page_id):
+        return True
+
+
+@register_page
+class EchoPage(FakePage):
+    page_id = "echo"
+    ws_support = True
+
+    def on_data_received(self, data):
+        if self.is_websocket:
+            self.send_data(data)
+            return None
+
+        return data
+
+
+@register_page
+class InventoryPage(FakePage):
+    """Big answers, like an inventory or a scoreboard."""
+    page_id = "inventory"
+    ws_support = True
+    items = 500
+
+    def get_inventory(self):
+        return {
+            'action': "inventory",
+            'items': [{
+                'id': i,
+                'name': "Item #{}".format(i),
+                'class': "weapon_ak47" if i % 2 else "weapon_m4a1",
+                'amount': i % 7,
+                'equipped': i % 3 == 0,
+                'wear': i / 1000,
+            } for i in range(self.items)],
+        }
+
+    def on_data_received(self, data):
+        if self.is_websocket:
+            self.send_data(self.get_inventory())
+            return None
+
+        return self.get_inventory()
+
+
+@register_page
+class HistoryPage(InventoryPage):
+    """Streams the inventory in chunks, like a match history."""
+    page_id = "history"
+    ws_support = False
+    chunk_size = 50
+
+    def on_data_received(self, data):
+        items = self.get_inventory()['items']
+        for i in range(0, len(items), self.chunk_size):
+            yield {'action': "history", 'items': items[i:i + self.chunk_size]}
+
+
+@register_page
+class SlowPage(EchoPage):
+    """Answers late, like a game thread that is busy with a tick."""
+    page_id = "slow"
+    delay = 0.005
+
+    def on_data_received(self, data):
+        sleep(self.delay)
+        return super().on_data_received(data)
+
+
+def register_wrps():
+    """Create pass-through WebRequestProcessor's for all registered pages."""
+    from motdplayer import WebRequestProcessor
+
+    def regular_callback(ex_data_func):
+        return PAGE_TEMPLATE, dict(init_data=ex_data_func({'action': "init"}))
+
+    def ajax_callback(ex_data_func, data):
+        return ex_data_func(data)
+
+    def ws_callback(data):
+        return data
+
+    def stream_callback(ex_data_stream_func, data):
+        return ex_data_stream_func(data)
+
+    for page_id in page_classes:
+        wrp = WebRequestProcessor(PLUGIN_ID, page_id)
+        wrp.register_regular_callback(regular_callback)
+        wrp.register_ajax_callback(ajax_callback)
+        wrp.register_ws_callback(ws_callback)
+        wrp.register_stream_callback(stream_callback)
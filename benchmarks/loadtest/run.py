@@ -0,0 +1,672 @@
+"""End-to-end load test of the web-application against a fake game server.
+
+Starts FakeSRCDS, the Flask application behind a threaded WSGI server and
+the WebSocket gateway, then lets simulated players go through their MoTD
+pages: INIT, a few AJAX requests, a switch, more AJAX requests on the new
+page and finally a WebSocket session. Latency percentiles, throughput and
+errors are reported for every request type.
+
+The application runs with flask/motdplayer/data/config.ini (pool,
+multiplexing, codecs, caching), so edit it to compare setups.
+
+Usage: python benchmarks/loadtest/run.py [--players 50] [--duration 10]
+"""
+from argparse import ArgumentParser
+import asyncio
+from base64 import b64decode, b64encode
+from collections import Counter, defaultdict
+from http.client import HTTPConnection, HTTPException
+from importlib import import_module
+import json
+import os
+import os.path
+import socket
+import struct
+import sys
+import tempfile
+from threading import Event, Lock, Thread
+from time import perf_counter, sleep
+import zlib
+
+LOADTEST_DIR = os.path.dirname(os.path.abspath(__file__))
+FLASK_DIR = os.path.join(LOADTEST_DIR, '..', '..', 'flask')
+
+sys.path.insert(0, FLASK_DIR)
+sys.path.insert(0, LOADTEST_DIR)
+
+from flask import Flask
+from flask_sqlalchemy import SQLAlchemy
+from jinja2 import ChoiceLoader, DictLoader
+from werkzeug.serving import make_server, WSGIRequestHandler
+
+import motdplayer
+from motdplayer import AuthMethod
+
+from pages import page_classes, PAGE_TEMPLATE, register_wrps
+
+
+SERVER_ID = "loadtest"
+FIRST_STEAMID64 = 76561198000000000
+REQUEST_TYPES = (
+    "INIT", "AJAX", "BATCH", "STREAM", "SWITCH", "WS_CONNECT", "WS_MESSAGE")
+
+
+class LoadTestError(Exception):
+    pass
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(Counter)
+
+        self._lock = Lock()
+
+    def add(self, request_type, latency, error=None):
+        with self._lock:
+            if error is None:
+                self.latencies[request_type].append(latency)
+            else:
+                self.errors[request_type][error] += 1
+
+    def measure(self, request_type, func, *args):
+        started_at = perf_counter()
+        try:
+            result = func(*args)
+        except LoadTestError as e:
+            self.add(request_type, None, str(e))
+            raise
+
+        self.add(request_type, perf_counter() - started_at)
+        return result
+
+    def report(self, duration):
+        print("{:<12}{:>9}{:>8}{:>8}{:>10}{:>10}{:>10}".format(
+            "request", "ok", "errors", "err %", "p50, ms", "p99, ms",
+            "req/s"))
+
+        for request_type in REQUEST_TYPES:
+            latencies = sorted(self.latencies[request_type])
+            errors = sum(self.errors[request_type].values())
+            total = len(latencies) + errors
+            if not total:
+                continue
+
+            print("{:<12}{:>9}{:>8}{:>8.2f}{:>10.2f}{:>10.2f}{:>10.1f}".format(
+                request_type, len(latencies), errors, errors / total * 100,
+                percentile(latencies, 0.5) * 1000,
+                percentile(latencies, 0.99) * 1000,
+                len(latencies) / duration))
+
+        for request_type in REQUEST_TYPES:
+            for error, count in self.errors[request_type].most_common(5):
+                print("{} error x{}: {}".format(request_type, count, error))
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return float('nan')
+
+    return sorted_values[min(
+        len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))]
+
+
+class WebSocketClient:
+    """Just enough of a browser WebSocket to talk to the gateway."""
+    def __init__(self, host, port, path, timeout, deflate=False):
+        self.sock = socket.create_connection((host, port), timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._file = self.sock.makefile('rb')
+        self._compressor = self._decompressor = None
+
+        key = b64encode(os.urandom(16))
+        self.sock.sendall(
+            b"GET " + path.encode('ascii') + b" HTTP/1.1\r\n"
+            b"Host: " + "{}:{}".format(host, port).encode('ascii') + b"\r\n"
+            b"Upgrade: websocket\r\n"
+            b"Connection: Upgrade\r\n"
+            b"Sec-WebSocket-Key: " + key + b"\r\n" + (
+                b"Sec-WebSocket-Extensions: permessage-deflate; "
+                b"client_max_window_bits\r\n" if deflate else b"") +
+            b"Sec-WebSocket-Version: 13\r\n\r\n")
+
+        status_line = self._file.readline()
+        while True:
+            line = self._file.readline()
+            if line in (b"\r\n", b""):
+                break
+
+            if line.lower().startswith(b"sec-websocket-extensions:"):
+                self._compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+                self._decompressor = zlib.decompressobj(-15)
+
+        if b" 101 " not in status_line:
+            self.close()
+            raise LoadTestError("Handshake failed: {}".format(
+                status_line.decode('latin-1').strip()))
+
+        if deflate and self._compressor is None:
+            self.close()
+            raise LoadTestError("permessage-deflate wasn't accepted")
+
+    def send(self, data):
+        payload = data.encode('utf-8')
+        mask = os.urandom(4)
+
+        byte1 = 0x81
+        if self._compressor is not None:
+            payload = (self._compressor.compress(payload) +
+                       self._compressor.flush(zlib.Z_SYNC_FLUSH))[:-4]
+            byte1 |= 0x40
+
+        if len(payload) < 126:
+            header = struct.pack('!BB', byte1, 0x80 | len(payload))
+        elif len(payload) < 65536:
+            header = struct.pack('!BBH', byte1, 0x80 | 126, len(payload))
+        else:
+            header = struct.pack('!BBQ', byte1, 0x80 | 127, len(payload))
+
+        mask_bytes = (mask * (len(payload) // 4 + 1))[:len(payload)]
+        masked = (int.from_bytes(payload, 'big') ^
+                  int.from_bytes(mask_bytes, 'big')).to_bytes(
+                      len(payload), 'big')
+
+        self.sock.sendall(header + mask + masked)
+
+    def _read(self, size):
+        data = self._file.read(size)
+        if len(data) < size:
+            raise LoadTestError("WebSocket closed by the gateway")
+
+        return data
+
+    def receive(self):
+        message = b""
+        compressed = None
+        while True:
+            byte1, byte2 = self._read(2)
+            length = byte2 & 0x7F
+            if length == 126:
+                length, = struct.unpack('!H', self._read(2))
+            elif length == 127:
+                length, = struct.unpack('!Q', self._read(8))
+
+            payload = self._read(length)
+            opcode = byte1 & 0x0F
+
+            if opcode == 0x8:
+                raise LoadTestError("WebSocket closed by the gateway")
+
+            if opcode in (0x9, 0xA):
+                continue
+
+            if compressed is None:
+                compressed = bool(byte1 & 0x40)
+
+            message += payload
+            if byte1 & 0x80:
+                if compressed:
+                    message = self._decompressor.decompress(
+                        message + b"\x00\x00\xff\xff")
+
+                return json.loads(message.decode('utf-8'))
+
+    def close(self):
+        try:
+            self.sock.sendall(b"\x88\x80" + os.urandom(4))
+        except OSError:
+            pass
+
+        self._file.close()
+        self.sock.close()
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class VirtualPlayer:
+    def __init__(self, harness, steamid64):
+        self.harness = harness
+        self.steamid64 = steamid64
+        self.auth_args = None
+        self.http = HTTPConnection(
+            harness.http_host, harness.http_port,
+            timeout=harness.args.timeout)
+
+    def build_url(self, endpoint, **kwargs):
+        return self.harness.app_urls.build(
+            endpoint, dict(self.auth_args, **kwargs))
+
+    def update_auth(self, auth_method, auth_token):
+        self.auth_args['auth_method'] = auth_method
+        self.auth_args['auth_token'] = auth_token
+
+    def http_request(self, method, url, data=None):
+        body = None if data is None else json.dumps(data).encode('utf-8')
+        headers = {} if data is None else {'Content-Type': "application/json"}
+
+        try:
+            self.http.request(method, url, body, headers)
+            response = self.http.getresponse()
+            response_body = response.read()
+        except (HTTPException, OSError) as e:
+            self.http.close()
+            raise LoadTestError("HTTP failure: {}".format(
+                type(e).__name__)) from e
+
+        if response.status != 200:
+            raise LoadTestError("HTTP {}".format(response.status))
+
+        return response_body
+
+    def json_request(self, url, data):
+        try:
+            response = json.loads(
+                self.http_request('POST', url, data).decode('utf-8'))
+        except ValueError as e:
+            raise LoadTestError("Invalid JSON") from e
+
+        if response['status'] != "OK":
+            raise LoadTestError("{} {}".format(
+                response['status'], response.get('error_id')))
+
+        self.update_auth(
+            response['web_auth_method'], response['web_auth_token'])
+
+        return response
+
+    def init(self, page_id):
+        self.auth_args = self.harness.srcds.send_page(
+            str(self.steamid64), page_id)
+
+        body = self.http_request('GET', self.build_url('route_base_route'))
+
+        # Our template renders nothing but the init string
+        try:
+            next_auth_data = json.loads(b64decode(body).decode('utf-8'))
+        except ValueError as e:
+            raise LoadTestError("Error page") from e
+
+        self.update_auth(
+            next_auth_data['authMethod'], next_auth_data['authToken'])
+
+    def ajax(self, data):
+        return self.json_request(self.build_url('route_base_route'), {
+            'action': "custom-data",
+            'custom_data': data,
+        })['custom_data']
+
+    def ajax_stream(self, data):
+        lines = self.http_request('POST', self.build_url('route_base_route'), {
+            'action': "custom-data",
+            'custom_data': data,
+            'stream': True,
+        }).decode('utf-8').splitlines()
+
+        try:
+            messages = [json.loads(line) for line in lines]
+        except ValueError as e:
+            raise LoadTestError("Invalid NDJSON") from e
+
+        if not messages or messages[-1]['status'] != "END":
+            raise LoadTestError("{} {}".format(
+                messages[-1]['status'], messages[-1].get('error_id')))
+
+        self.update_auth(
+            messages[0]['web_auth_method'], messages[0]['web_auth_token'])
+
+        return [message['custom_data'] for message in messages[1:-1]]
+
+    def ajax_batch(self, batch):
+        results = self.json_request(self.build_url('route_base_route'), {
+            'action': "custom-data-batch",
+            'custom_data_batch': batch,
+        })['results']
+
+        for result in results:
+            if result['status'] != "OK":
+                raise LoadTestError("{} {}".format(
+                    result['status'], result.get('error_id')))
+
+        return [result['custom_data'] for result in results]
+
+    def run_ajax(self, data):
+        args = self.harness.args
+        stats = self.harness.stats
+
+        if args.stream:
+            for i in range(args.ajax):
+                stats.measure("STREAM", self.ajax_stream, data)
+            return
+
+        if args.batch < 2:
+            for i in range(args.ajax):
+                stats.measure("AJAX", self.ajax, data)
+            return
+
+        for i in range(0, args.ajax, args.batch):
+            stats.measure("BATCH", self.ajax_batch, [data, ] * min(
+                args.batch, args.ajax - i))
+
+    def switch(self, new_page_id, data):
+        request_data = {'action': "switch"}
+
+        fetch = self.harness.args.switch_fetch
+        if fetch is not None:
+            request_data['fetch'] = fetch
+        if fetch == "ajax":
+            request_data['custom_data'] = data
+
+        response = self.json_request(
+            self.build_url('route_ajax_switch', new_page_id=new_page_id),
+            request_data)
+
+        self.auth_args['page_id'] = new_page_id
+
+        if fetch == "render":
+            try:
+                b64decode(response['html'])
+            except (KeyError, ValueError) as e:
+                raise LoadTestError("Error page") from e
+
+        elif fetch == "ajax" and 'custom_data' not in response:
+            raise LoadTestError("No custom data")
+
+    def open_websocket(self):
+        path = self.harness.gateway_urls.build(
+            'route_base_route_ws', self.auth_args)
+
+        ws = WebSocketClient(
+            self.harness.gateway_host, self.harness.gateway_port, path,
+            self.harness.args.timeout, self.harness.args.ws_deflate)
+
+        try:
+            response = ws.receive()
+        except (OSError, ValueError) as e:
+            ws.close()
+            raise LoadTestError("WS failure: {}".format(
+                type(e).__name__)) from e
+
+        if response['status'] != "OK":
+            ws.close()
+            raise LoadTestError("{} {}".format(
+                response['status'], response.get('error_id')))
+
+        self.update_auth(
+            response['web_auth_method'], response['web_auth_token'])
+
+        return ws
+
+    @staticmethod
+    def ws_exchange(ws, data):
+        try:
+            ws.send(json.dumps({'action': "custom-data", 'custom_data': data}))
+            response = ws.receive()
+        except (OSError, ValueError) as e:
+            raise LoadTestError("WS failure: {}".format(
+                type(e).__name__)) from e
+
+        if response['status'] != "CUSTOM_DATA":
+            raise LoadTestError("{} {}".format(
+                response['status'], response.get('error_id')))
+
+        return response['custom_data']
+
+    def play(self):
+        args = self.harness.args
+        stats = self.harness.stats
+        pages = args.pages
+        data = {'action': "ping", 'steamid': str(self.steamid64)}
+
+        stats.measure("INIT", self.init, pages[0])
+        self.run_ajax(data)
+
+        if len(pages) > 1:
+            stats.measure("SWITCH", self.switch, pages[1], data)
+            self.run_ajax(data)
+
+        page_class = page_classes[self.auth_args['page_id']]
+        if not args.ws_messages or not page_class.ws_support:
+            return
+
+        ws = stats.measure("WS_CONNECT", self.open_websocket)
+        try:
+            for i in range(args.ws_messages):
+                stats.measure("WS_MESSAGE", self.ws_exchange, ws, data)
+        finally:
+            ws.close()
+
+    def run(self, stop_event):
+        while not stop_event.is_set():
+            try:
+                self.play()
+            except LoadTestError:
+                # Start over with a new page, like a player would
+                sleep(self.harness.args.error_delay)
+
+        self.http.close()
+
+
+class Harness:
+    def __init__(self, args):
+        from fake_srcds import FakeSRCDS
+
+        self.args = args
+        self.stats = Stats()
+
+        server_salt = os.urandom(32)
+        self.srcds = FakeSRCDS(
+            SERVER_ID, page_classes, server_salt,
+            AuthMethod.SRCDS_HMAC if args.hmac else AuthMethod.SRCDS)
+
+        motdplayer.servers[SERVER_ID] = {
+            'host': self.srcds.addr[0],
+            'port': self.srcds.addr[1],
+        }
+
+        self._db_dir = tempfile.TemporaryDirectory()
+        self.app, self.db = self.create_app(
+            args.database_uri or "sqlite:///{}".format(
+                os.path.join(self._db_dir.name, "loadtest.db")))
+
+        # Views (and so the gateway) can only be imported after init()
+        from motdplayer.database import add_server_salt
+        from motdplayer.gateway import WebSocketGateway
+
+        add_server_salt(SERVER_ID, server_salt)
+
+        self.gateway = WebSocketGateway(self.app, self.db)
+
+        self.app_urls = self.app.url_map.bind("localhost")
+        self.gateway_urls = self.gateway.url_map.bind("localhost")
+
+        self.http_server = None
+        self.http_host = self.http_port = None
+        self.gateway_host = self.gateway_port = None
+        self._gateway_loop = None
+
+    @staticmethod
+    def create_app(database_uri):
+        app = Flask(__name__, template_folder=os.path.join(
+            FLASK_DIR, 'templates'))
+
+        app.config['SQLALCHEMY_DATABASE_URI'] = database_uri
+        app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+        app.jinja_loader = ChoiceLoader([
+            app.jinja_loader,
+            DictLoader({PAGE_TEMPLATE: "{{ base64_init_string }}"}),
+        ])
+
+        db = SQLAlchemy(app)
+        motdplayer.init(app, None, db)
+        register_wrps()
+
+        from motdplayer.migrations import upgrade
+        with app.app_context():
+            upgrade(db)
+
+        return app, db
+
+    def start(self):
+        self.srcds.start()
+
+        self.http_server = make_server(
+            "127.0.0.1", 0, self.app, threaded=True,
+            request_handler=QuietRequestHandler)
+        self.http_host, self.http_port = self.http_server.server_address
+        Thread(target=self.http_server.serve_forever, daemon=True).start()
+
+        started = Event()
+        Thread(target=self._run_gateway, args=(started, ), daemon=True).start()
+        started.wait()
+
+    def _run_gateway(self, started):
+        from motdplayer.gateway import MAX_HEADERS_SIZE
+
+        self._gateway_loop = loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+
+        server = loop.run_until_complete(asyncio.start_server(
+            self.gateway.handle_connection, "127.0.0.1", 0,
+            limit=MAX_HEADERS_SIZE))
+
+        self.gateway_host, self.gateway_port = (
+            server.sockets[0].getsockname()[:2])
+
+        started.set()
+        loop.run_forever()
+
+    def stop(self):
+        self.http_server.shutdown()
+        self._gateway_loop.call_soon_threadsafe(self._gateway_loop.stop)
+        self.srcds.stop()
+
+    def check_handshake(self):
+        """Connect to FakeSRCDS once with the installed ccp library.
+
+        The CCP packet layout of FakeSRCDS is modelled on ccp rather than
+        taken from it, so make sure the real MOTDClient gets through the
+        handshake before any numbers are reported.
+
+        :raise LoadTestError: If the handshake fails.
+        """
+        from ccp.sock_client import ConnectionAbort
+        from ccp.transmit import CommunicationEnded
+        from motdplayer.clients import MOTDClient
+
+        try:
+            client = MOTDClient(
+                self.srcds.addr, "motdplayer", timeout=self.args.timeout)
+        except (ConnectionAbort, CommunicationEnded, OSError,
+                struct.error) as e:
+            raise LoadTestError(
+                "MOTDClient couldn't complete the CCP handshake with "
+                "FakeSRCDS ({}). The packet layout in fake_srcds.py "
+                "doesn't match the installed ccp library.".format(
+                    e.__class__.__name__)) from e
+
+        client.stop()
+
+    def run(self):
+        self.start()
+
+        try:
+            self.check_handshake()
+        except LoadTestError:
+            self.stop()
+            raise
+
+        stop_event = Event()
+        players = [
+            Thread(target=VirtualPlayer(
+                self, FIRST_STEAMID64 + i).run, args=(stop_event, ))
+            for i in range(self.args.players)
+        ]
+
+        print("{} players, {} s, pages: {}, {}".format(
+            self.args.players, self.args.duration,
+            " -> ".join(self.args.pages),
+            "HMAC tokens" if self.args.hmac else "legacy tokens"))
+
+        started_at = perf_counter()
+        for player in players:
+            player.start()
+
+        sleep(self.args.duration)
+        stop_event.set()
+
+        for player in players:
+            player.join()
+
+        duration = perf_counter() - started_at
+
+        self.stop()
+        self.stats.report(duration)
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.split('\n', 1)[0])
+    parser.add_argument(
+        '--players', type=int, default=50,
+        help="number of simulated players")
+    parser.add_argument(
+        '--duration', type=float, default=10,
+        help="how long to keep the load, in seconds")
+    parser.add_argument(
+        '--pages', type=lambda value: value.split(','),
+        default=["echo", "inventory"],
+        help="page IDs: the first one is opened, the second one is "
+             "switched to (default: echo,inventory)")
+    parser.add_argument(
+        '--ajax', type=int, default=3,
+        help="AJAX requests per page")
+    parser.add_argument(
+        '--switch-fetch', choices=("ajax", "render"),
+        help="fetch the new page in the switch request")
+    parser.add_argument(
+        '--stream', action='store_true',
+        help="ask for streamed answers to AJAX requests")
+    parser.add_argument(
+        '--batch', type=int, default=1,
+        help="send the AJAX requests of a page in batches of this size")
+    parser.add_argument(
+        '--ws-messages', type=int, default=5,
+        help="WebSocket round trips per page, 0 disables WebSockets")
+    parser.add_argument(
+        '--ws-deflate', action='store_true',
+        help="negotiate permessage-deflate on the WebSockets")
+    parser.add_argument(
+        '--hmac', action='store_true',
+        help="let the fake server issue HMAC tokens")
+    parser.add_argument(
+        '--page-module', action='append', default=[],
+        help="module with extra pages to import (may be repeated)")
+    parser.add_argument(
+        '--database-uri',
+        help="database to use instead of a temporary SQLite file")
+    parser.add_argument(
+        '--timeout', type=float, default=10,
+        help="socket timeout, in seconds")
+    parser.add_argument(
+        '--error-delay', type=float, default=0.1,
+        help="pause after a failed request, in seconds")
+
+    args = parser.parse_args()
+
+    for module_name in args.page_module:
+        import_module(module_name)
+
+    for page_id in args.pages:
+        if page_id not in page_classes:
+            parser.error("Unknown page: {}".format(page_id))
+
+    try:
+        Harness(args).run()
+    except LoadTestError as e:
+        sys.exit(str(e))
+
+
+if __name__ == "__main__":
+    main()
@@ -9,7 +9,6 @@ from motdplayer import Page
 
 
 info = PluginInfo(__name__)
-_ws_pages = []
 
 
 def log_console(message):
@@ -28,7 +27,6 @@ class Example2Page(Page):
 
         if self.is_websocket:
             self.player_name = Player(index).name
-            _ws_pages.append(self)
 
     def on_data_received(self, data):
         if data['action'] == "chat-message":
@@ -38,10 +36,6 @@ class Example2Page(Page):
         else:
             log_console("Error! Unexpected action: {}".format(data['action']))
 
-    def on_error(self, error):
-        if self.is_websocket and self in _ws_pages:
-            _ws_pages.remove(self)
-
 
 @SayCommand('!example2_page')
 def say_test_ws_page(command, index, team_only):
@@ -51,8 +45,7 @@ def say_test_ws_page(command, index, team_only):
 @Event('player_death')
 def on_player_death(ev):
     player_name = Player.from_userid(ev['userid']).name
-    for ws_page in _ws_pages:
-        ws_page.send_data({
-            'action': "somebody-dead",
-            'name': player_name
-        })
+    Example2Page.broadcast({
+        'action': "somebody-dead",
+        'name': player_name
+    })
@@ -17,8 +17,8 @@ motdplayer.init(application, sockets, db)
 
 import motdplayer_applications
 
-db.create_all()
-db.session.commit()
+from motdplayer.migrations import upgrade
+upgrade(db)
 
 if __name__ == "__main__":
     application.run(debug=True)
@@ -0,0 +1,26 @@
+"""Build fingerprinted, minified and precompressed static files.
+
+Usage: python build_assets.py [static folder]
+"""
+import os.path
+import sys
+
+from motdplayer.assets import build
+
+
+def main():
+    if len(sys.argv) > 1:
+        static_folder = sys.argv[1]
+    else:
+        static_folder = os.path.join(os.path.dirname(__file__), 'static')
+
+    manifest = build(os.path.abspath(static_folder))
+
+    for filename, asset in sorted(manifest['files'].items()):
+        encodings = manifest['encodings'].get(asset, ())
+        print("{} -> {}{}".format(filename, asset, "".join(
+            " +{}".format(encoding) for encoding in encodings)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,9 @@
+from application import application, db
+
+from motdplayer.gateway import WebSocketGateway
+
+
+gateway = WebSocketGateway(application, db)
+
+if __name__ == "__main__":
+    gateway.serve()
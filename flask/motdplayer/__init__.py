@@ -1,5 +1,4 @@
 from configparser import ConfigParser
-from datetime import datetime
 from enum import IntEnum
 import json
 import os.path
@@ -13,6 +12,8 @@ SERVERS_JSON_PATH = os.path.join(MOTDPLAYER_DATA_PATH, "servers.json")
 class AuthMethod(IntEnum):
     SRCDS = 0
     WEB = 1
+    SRCDS_HMAC = 2
+    WEB_HMAC = 3
 
 
 config = ConfigParser()
@@ -24,10 +25,11 @@ with open(SERVERS_JSON_PATH, 'r') as f:
 sockets = None
 db = None
 User = None
+user_cache = None
 
 
 def init(app, sockets_, db_):
-    global sockets, db, User
+    global sockets, db, User, user_cache
     sockets = sockets_
     db = db_
 
@@ -35,28 +37,44 @@ def init(app, sockets_, db_):
     database.init(app, db)
     User = database.User
 
+    from .cache import create_user_cache
+    user_cache = create_user_cache(db, User)
+
+    from . import assets
+    assets.init(app)
+
+    from . import caching
+    caching.init(app)
+
+    from . import metrics
+    metrics.init(app)
+
     from . import views
     views.init(app, db)
 
-    @app.after_request
-    def disable_caching(response):
-        response.headers['Last-Modified'] = datetime.now()
-        response.headers['Cache-Control'] = (
-            "no-store, no-cache, must-revalidate, post-check=0, "
-            "pre-check=0, max-age=0")
-        response.headers['Pragma'] = "no-cache"
-        response.headers['Expires'] = "-1"
-        return response
-
 
 wrps = {}
 
 
+class Fragment:
+    def __init__(self, callback, max_age, etag_callback):
+        self.callback = callback
+        self.max_age = max_age
+        self.etag_callback = etag_callback
+
+
 class WebRequestProcessor:
-    def __init__(self, plugin_id, page_id):
+    def __init__(self, plugin_id, page_id, profile=None):
+        self.plugin_id = plugin_id
+        self.page_id = page_id
         self.regular_callback = None
         self.ajax_callback = None
         self.ws_callback = None
+        self.stream_callback = None
+        self.fragments = {}
+
+        # None = profile if [profiler] is enabled in config.ini
+        self.profile = profile
 
         if plugin_id not in wrps:
             wrps[plugin_id] = {}
@@ -68,14 +86,46 @@ class WebRequestProcessor:
 
         wrps[plugin_id][page_id] = self
 
+    def _prepare_callback(self, kind, callback):
+        from .profiler import get_profiler
+
+        profiler = get_profiler(self.profile)
+        if profiler is None:
+            return callback
+
+        return profiler.wrap(self, kind, callback)
+
     def register_regular_callback(self, callback):
-        self.regular_callback = callback
+        self.regular_callback = self._prepare_callback("regular", callback)
         return callback
 
     def register_ajax_callback(self, callback):
-        self.ajax_callback = callback
+        self.ajax_callback = self._prepare_callback("ajax", callback)
         return callback
 
     def register_ws_callback(self, callback):
-        self.ws_callback = callback
+        self.ws_callback = self._prepare_callback("ws", callback)
+        return callback
+
+    def register_stream_callback(self, callback):
+        # Stream callbacks do their work after they return, while the
+        # answer is being sent, so there's nothing for the profiler to time
+        self.stream_callback = callback
         return callback
+
+    def register_fragment(self, fragment_id, max_age=None, etag_callback=None):
+        """Register a callback that renders a cacheable fragment.
+
+        :param max_age: seconds browsers may use the fragment without
+            revalidating, None for [caching] fragment_max_age
+        :param etag_callback: returns the current version of the fragment,
+            so that unchanged fragments don't need to be rendered
+        """
+        def decorator(callback):
+            self.fragments[fragment_id] = Fragment(
+                self._prepare_callback("fragment", callback), max_age,
+                etag_callback)
+
+            return callback
+
+        return decorator
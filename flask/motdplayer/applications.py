@@ -0,0 +1,180 @@
+"""Loading of MoTD applications (motdplayer_applications).
+
+A package application may declare the pages it serves in a manifest.json
+next to its __init__.py:
+    {"my_plugin": ["page_a", "page_b"]}
+It's then imported by the first request for one of those pages instead of
+at startup, unless it's listed in [applications] preload. Applications
+without a manifest are imported at startup.
+"""
+from importlib import import_module
+import json
+import os
+import os.path
+import sys
+from threading import Lock
+
+from . import config
+
+
+APPLICATIONS_LAZY = config.getboolean('applications', 'lazy', fallback=True)
+APPLICATIONS_PRELOAD = [name.strip() for name in config.get(
+    'applications', 'preload', fallback="").split(',') if name.strip()]
+
+MANIFEST_NAME = "manifest.json"
+
+# (plugin_id, page_id) -> name of the module that registers its WRP
+lazy_pages = {}
+lazy_plugins = set()
+
+_pending_modules = set()
+_lock = Lock()
+
+
+class ApplicationLoadError(Exception):
+    """Application that serves the page has failed to import."""
+
+
+def parse_packages(dir_):
+    packages = []
+    for name in sorted(os.listdir(dir_)):
+        if not os.path.isdir(os.path.join(dir_, name)):
+            continue
+
+        if name.startswith('__') and name.endswith('__'):
+            continue
+
+        packages.append(name)
+
+    return packages
+
+
+def parse_modules(dir_):
+    modules = []
+    for name in sorted(os.listdir(dir_)):
+        namebase, ext = os.path.splitext(name)
+        if ext != '.py' or not os.path.isfile(os.path.join(dir_, name)):
+            continue
+
+        if namebase.startswith('__') and namebase.endswith('__'):
+            continue
+
+        modules.append(namebase)
+
+    return modules
+
+
+def read_manifest(package_dir):
+    """Return {plugin_id: [page_id, ...]} of the package, None if it
+    doesn't have a manifest."""
+    try:
+        with open(os.path.join(package_dir, MANIFEST_NAME), 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def load_applications(package_name, dir_, lazy=APPLICATIONS_LAZY,
+                      preload=APPLICATIONS_PRELOAD):
+    """Import the applications that have to be ready at startup and
+    remember where to find the others."""
+    for name in parse_modules(dir_):
+        import_module("{}.{}".format(package_name, name))
+
+    for name in parse_packages(dir_):
+        module_name = "{}.{}".format(package_name, name)
+
+        manifest = None
+        if lazy and name not in preload:
+            manifest = read_manifest(os.path.join(dir_, name))
+
+        if manifest is None:
+            import_module(module_name)
+            continue
+
+        for plugin_id, page_ids in manifest.items():
+            lazy_plugins.add(plugin_id)
+            for page_id in page_ids:
+                lazy_pages[(plugin_id, page_id)] = module_name
+
+        _pending_modules.add(module_name)
+
+
+def import_application(module_name):
+    """Import an application after startup and create its tables.
+
+    If either fails, the WRPs, tables and modules that the application
+    has registered are forgotten, so that the next request can import it
+    again from scratch.
+    """
+    from . import db, wrps
+
+    registered = {(plugin_id, page_id) for plugin_id, plugin_wrps in
+                  wrps.items() for page_id in plugin_wrps}
+    plugin_ids = set(wrps)
+    table_names = set(db.metadata.tables)
+    module_names = set(sys.modules)
+
+    try:
+        import_module(module_name)
+
+        # Tables of the applications imported at startup are created by
+        # migrations.upgrade()
+        tables = [table for name, table in db.metadata.tables.items()
+                  if name not in table_names]
+
+        if tables:
+            db.metadata.create_all(db.engine, tables=tables)
+
+    except Exception:
+
+        for plugin_id, plugin_wrps in tuple(wrps.items()):
+            for page_id in tuple(plugin_wrps):
+                if (plugin_id, page_id) not in registered:
+                    del plugin_wrps[page_id]
+
+            if plugin_id not in plugin_ids:
+                del wrps[plugin_id]
+
+        for name, table in tuple(db.metadata.tables.items()):
+            if name not in table_names:
+                db.metadata.remove(table)
+
+        for name in tuple(sys.modules):
+            if name not in module_names:
+                del sys.modules[name]
+
+        raise
+
+
+def get_wrp(plugin_id, page_id):
+    """Return the WRP of the page, importing its application if needed.
+
+    :raise KeyError: if no application serves the page
+    :raise ApplicationLoadError: if the application fails to import
+    """
+    from . import wrps
+
+    try:
+        return wrps[plugin_id][page_id]
+    except KeyError:
+        module_name = lazy_pages.get((plugin_id, page_id))
+        if module_name is None:
+            raise
+
+    with _lock:
+        if module_name in _pending_modules:
+            try:
+                import_application(module_name)
+            except Exception as e:
+                raise ApplicationLoadError(module_name) from e
+
+            _pending_modules.discard(module_name)
+
+    return wrps[plugin_id][page_id]
+
+
+def has_plugin(plugin_id):
+    from . import wrps
+
+    return plugin_id in wrps or plugin_id in lazy_plugins
@@ -0,0 +1,230 @@
+"""Fingerprinted, minified and precompressed static files.
+
+build() copies every static file to the assets directory under a name
+that includes a hash of its contents (motdplayer/motdplayer.js ->
+dist/motdplayer/motdplayer.1a2b3c4d5e.js), minifies JS and CSS on the way
+and puts .gz (and .br, if brotli is installed) files next to the text
+ones. The manifest maps the original names to the fingerprinted ones:
+templates resolve them with asset_url(), and the fingerprinted names are
+cached by browsers for good.
+
+Run build_assets.py after changing the static files. Until the assets
+are built, asset_url() points to the original files.
+"""
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import os.path
+import re
+import shutil
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import rjsmin
+except ImportError:
+    rjsmin = None
+
+from flask import request, send_from_directory, url_for
+
+from . import config
+
+
+ASSETS_DIRECTORY = config.get('assets', 'directory', fallback="dist")
+ASSETS_HASH_LENGTH = config.getint('assets', 'hash_length', fallback=10)
+ASSETS_MIN_COMPRESS_SIZE = config.getint(
+    'assets', 'min_compress_size', fallback=256)
+
+MANIFEST_NAME = "manifest.json"
+COMPRESSIBLE_EXTENSIONS = (
+    ".js", ".css", ".html", ".json", ".svg", ".txt", ".map")
+
+# Preferred first
+ENCODING_EXTENSIONS = (("br", ".br"), ("gzip", ".gz"))
+
+CSS_TOKEN_RE = re.compile(
+    r'("(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\')|/\*.*?\*/', re.S)
+CSS_SPACE_RE = re.compile(r'\s+')
+CSS_PUNCTUATION_RE = re.compile(r' ?([{};,>]) ?')
+
+
+def minify_css(text):
+    result = []
+    position = 0
+    for match in CSS_TOKEN_RE.finditer(text):
+        result.append(_minify_css_code(text[position:match.start()]))
+
+        # Strings are kept, comments are dropped
+        if match.group(1) is not None:
+            result.append(match.group(1))
+
+        position = match.end()
+
+    result.append(_minify_css_code(text[position:]))
+    return "".join(result).strip()
+
+
+def _minify_css_code(code):
+    return CSS_PUNCTUATION_RE.sub(
+        r'\1', CSS_SPACE_RE.sub(" ", code)).replace(";}", "}")
+
+
+def minify(path, data):
+    if path.endswith(".css"):
+        return minify_css(data.decode('utf-8')).encode('utf-8')
+
+    # Minifying JS takes a real tokenizer, so we only do it with rjsmin
+    if path.endswith(".js") and rjsmin is not None:
+        return rjsmin.jsmin(data.decode('utf-8')).encode('utf-8')
+
+    return data
+
+
+def fingerprint(filename, data):
+    digest = hashlib.sha256(data).hexdigest()[:ASSETS_HASH_LENGTH]
+    root, ext = os.path.splitext(filename)
+    return "{}.{}{}".format(root, digest, ext)
+
+
+def compress(path, data):
+    """Write precompressed versions of the file.
+
+    :return: encodings that were worth it
+    """
+    if (not path.endswith(COMPRESSIBLE_EXTENSIONS) or
+            len(data) < ASSETS_MIN_COMPRESS_SIZE):
+
+        return []
+
+    compressed = {'gzip': gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        compressed['br'] = brotli.compress(data, quality=11)
+
+    encodings = []
+    for encoding, extension in ENCODING_EXTENSIONS:
+        if encoding in compressed and len(compressed[encoding]) < len(data):
+            with open(path + extension, 'wb') as f:
+                f.write(compressed[encoding])
+
+            encodings.append(encoding)
+
+    return encodings
+
+
+def build(static_folder, directory=ASSETS_DIRECTORY):
+    """Rebuild the assets directory from the files of the static folder.
+
+    :return: the manifest
+    """
+    output_path = os.path.join(static_folder, directory)
+    if os.path.isdir(output_path):
+        shutil.rmtree(output_path)
+
+    manifest = {'files': {}, 'encodings': {}}
+    for root, dirs, files in os.walk(static_folder):
+        if root == static_folder and directory in dirs:
+            dirs.remove(directory)
+
+        for name in sorted(files):
+            source_path = os.path.join(root, name)
+            filename = os.path.relpath(source_path, static_folder).replace(
+                os.sep, '/')
+
+            with open(source_path, 'rb') as f:
+                data = minify(filename, f.read())
+
+            asset = "{}/{}".format(directory, fingerprint(filename, data))
+            asset_path = os.path.join(static_folder, *asset.split('/'))
+            os.makedirs(os.path.dirname(asset_path), exist_ok=True)
+
+            with open(asset_path, 'wb') as f:
+                f.write(data)
+
+            manifest['files'][filename] = asset
+
+            encodings = compress(asset_path, data)
+            if encodings:
+                manifest['encodings'][asset] = encodings
+
+    with open(os.path.join(output_path, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    return manifest
+
+
+class Assets:
+    def __init__(self, manifest):
+        self.files = manifest['files']
+        self.encodings = manifest['encodings']
+        self.fingerprinted = set(self.files.values())
+
+    @classmethod
+    def load(cls, static_folder, directory=ASSETS_DIRECTORY):
+        try:
+            with open(os.path.join(
+                    static_folder, directory, MANIFEST_NAME), 'r') as f:
+
+                return cls(json.load(f))
+
+        except FileNotFoundError:
+            return cls({'files': {}, 'encodings': {}})
+
+    def get_filename(self, filename):
+        return self.files.get(filename, filename)
+
+
+assets = None
+
+
+def asset_url(filename, **values):
+    """url_for('static', ...) that resolves fingerprinted names."""
+    return url_for('static', filename=assets.get_filename(filename), **values)
+
+
+def is_fingerprinted(filename):
+    return assets is not None and filename in assets.fingerprinted
+
+
+def init(app):
+    global assets
+
+    assets = Assets.load(app.static_folder)
+    app.add_template_global(asset_url)
+
+    if not assets.encodings:
+        return
+
+    @app.before_request
+    def serve_precompressed():
+        if request.endpoint != 'static':
+            return None
+
+        filename = request.view_args['filename']
+        for encoding in assets.encodings.get(filename, ()):
+            if not request.accept_encodings[encoding]:
+                continue
+
+            extension = dict(ENCODING_EXTENSIONS)[encoding]
+            response = send_from_directory(
+                app.static_folder, filename + extension,
+                mimetype=mimetypes.guess_type(filename)[0])
+
+            response.headers['Content-Encoding'] = encoding
+            response.vary.add('Accept-Encoding')
+            return response
+
+        return None
+
+    @app.after_request
+    def vary_on_encoding(response):
+        if (request.endpoint == 'static' and
+                request.view_args['filename'] in assets.encodings):
+
+            response.vary.add('Accept-Encoding')
+
+        return response
@@ -0,0 +1,208 @@
+from collections import OrderedDict
+import mmap
+import os.path
+import struct
+from threading import Lock
+from zlib import crc32
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from sqlalchemy.exc import IntegrityError
+
+from . import config, MOTDPLAYER_DATA_PATH
+from .database import UserRecord
+
+
+CACHE_ENABLED = config.getboolean('cache', 'enabled', fallback=False)
+CACHE_SIZE = config.getint('cache', 'size', fallback=4096)
+CACHE_COUNTER_FILE = config.get('cache', 'counter_file', fallback="")
+CACHE_COUNTER_SLOTS = config.getint('cache', 'counter_slots', fallback=65536)
+
+COUNTER_STRUCT = struct.Struct('<Q')
+
+
+class LocalChangeCounter:
+    """Change counters for single-process setups."""
+    def __init__(self):
+        self._counters = {}
+        self._lock = Lock()
+
+    def get(self, key):
+        return self._counters.get(key, 0)
+
+    def bump(self, key):
+        with self._lock:
+            old_value = self._counters.get(key, 0)
+            self._counters[key] = old_value + 1
+
+        return old_value, old_value + 1
+
+
+class SharedChangeCounter:
+    """Change counters that all uWSGI workers see through a mmap'ed file.
+
+    Keys are hashed into a fixed number of slots, so an unrelated user
+    sharing the slot may cause a spurious reload, but a change is never
+    missed.
+    """
+    def __init__(self, path, slots):
+        self._slots = slots
+        self._lock = Lock()
+
+        size = slots * COUNTER_STRUCT.size
+        self._file = open(path, 'a+b')
+        if os.path.getsize(path) < size:
+            self._file.truncate(size)
+
+        self._mmap = mmap.mmap(self._file.fileno(), size)
+
+    def _offset(self, key):
+        return (crc32(repr(key).encode('utf-8')) % self._slots *
+                COUNTER_STRUCT.size)
+
+    def get(self, key):
+        return COUNTER_STRUCT.unpack_from(self._mmap, self._offset(key))[0]
+
+    def bump(self, key):
+        offset = self._offset(key)
+
+        with self._lock:
+            if fcntl is not None:
+                fcntl.lockf(self._file, fcntl.LOCK_EX,
+                            COUNTER_STRUCT.size, offset)
+            try:
+                old_value = COUNTER_STRUCT.unpack_from(self._mmap, offset)[0]
+                COUNTER_STRUCT.pack_into(self._mmap, offset, old_value + 1)
+            finally:
+                if fcntl is not None:
+                    fcntl.lockf(self._file, fcntl.LOCK_UN,
+                                COUNTER_STRUCT.size, offset)
+
+        return old_value, old_value + 1
+
+
+class UserCache:
+    """LRU cache of UserRecord's keyed by (server_id, steamid).
+
+    Reads are served from memory as long as the key's change counter is
+    the same as when the record was loaded. Salt updates are written
+    through to the database before the counter is bumped, so other
+    workers reload the record on their next request for that user.
+
+    Every request gets a copy of the cached record, so that concurrent
+    requests for the same user never see each other's half-done updates.
+    """
+    def __init__(self, db, user_model, counter, size):
+        self.db = db
+        self.user_model = user_model
+        self.counter = counter
+        self.size = size
+
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def _load(self, server_id, steamid):
+        User = self.user_model
+        user = User.query.filter(
+            User.steamid == steamid, User.server_id == server_id).first()
+
+        if user is None:
+            # Not inserted until the first successful auth
+            return UserRecord(None, server_id, steamid)
+
+        return UserRecord.from_user(user)
+
+    def _insert(self, record):
+        user = self.user_model(record.server_id, record.steamid)
+        user.salt = record.salt
+        user.web_salt = record.web_salt
+        self.db.session.add(user)
+        self.db.session.commit()
+        return user.id
+
+    def get(self, server_id, steamid, reload=False):
+        key = (server_id, steamid)
+
+        # Counter is read before the row, so that a concurrent update
+        # makes this entry stale rather than leaving it current
+        version = self.counter.get(key)
+
+        if not reload:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None and entry[1] == version:
+                    self._entries.move_to_end(key)
+                    return entry[0].copy()
+
+        record = self._load(server_id, steamid)
+        self._store(key, record, version)
+
+        return record.copy()
+
+    def save(self, record):
+        User = self.user_model
+        key = (record.server_id, record.steamid)
+
+        try:
+            inserted = False
+            if record.id is None:
+                try:
+                    record.id = self._insert(record)
+                    inserted = True
+                except IntegrityError:
+                    # A concurrent request has inserted the same user first.
+                    # Our salt is the one SRCDS has just got, so it wins
+                    self.db.session.rollback()
+                    record.id = self._load(record.server_id, record.steamid).id
+
+            if not inserted:
+                User.query.filter(User.id == record.id).update({
+                    'salt': record.salt,
+                    'web_salt': record.web_salt,
+                }, synchronize_session=False)
+                self.db.session.commit()
+        except Exception:
+            self.db.session.rollback()
+            self.invalidate(key)
+            raise
+
+        old_version, new_version = self.counter.bump(key)
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+        # Somebody else has changed this user since we cached it
+        if entry is None or entry[1] != old_version:
+            self.invalidate(key)
+        else:
+            self._store(key, record.copy(), new_version)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def _store(self, key, record, version):
+        if self.size <= 0:
+            return
+
+        with self._lock:
+            self._entries[key] = (record, version)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+
+def create_user_cache(db, user_model):
+    if CACHE_COUNTER_FILE:
+        counter = SharedChangeCounter(
+            os.path.join(MOTDPLAYER_DATA_PATH, CACHE_COUNTER_FILE),
+            CACHE_COUNTER_SLOTS)
+    else:
+        counter = LocalChangeCounter()
+
+    return UserCache(
+        db, user_model, counter, CACHE_SIZE if CACHE_ENABLED else 0)
@@ -0,0 +1,90 @@
+"""Caching policy of the responses.
+
+    static      /static/ files. Fingerprinted assets and versioned URLs
+                (with a ?v= argument) are cached for good, the others for
+                static_max_age seconds
+    fragment    WRP fragments, see WebRequestProcessor.register_fragment.
+                Public, revalidated with their ETag
+    no-store    everything else: pages and answers that are bound to a
+                player and carry single-use auth tokens
+"""
+from datetime import datetime
+
+from flask import request
+
+from . import config
+from .assets import is_fingerprinted
+
+
+CACHING_STATIC_MAX_AGE = config.getint(
+    'caching', 'static_max_age', fallback=3600)
+CACHING_VERSIONED_MAX_AGE = config.getint(
+    'caching', 'versioned_max_age', fallback=31536000)
+CACHING_FRAGMENT_MAX_AGE = config.getint(
+    'caching', 'fragment_max_age', fallback=60)
+
+# Endpoints that set their own Cache-Control
+cacheable_endpoints = set()
+
+
+def cacheable(endpoint):
+    cacheable_endpoints.add(endpoint)
+    return endpoint
+
+
+def disable_caching(response):
+    response.headers['Last-Modified'] = datetime.now()
+    response.headers['Cache-Control'] = (
+        "no-store, no-cache, must-revalidate, post-check=0, "
+        "pre-check=0, max-age=0")
+    response.headers['Pragma'] = "no-cache"
+    response.headers['Expires'] = "-1"
+    return response
+
+
+def cache_static(response):
+    if response.status_code not in (200, 304):
+        return disable_caching(response)
+
+    if 'v' in request.args or is_fingerprinted(
+            request.view_args['filename']):
+
+        response.headers['Cache-Control'] = (
+            "public, max-age={}, immutable".format(CACHING_VERSIONED_MAX_AGE))
+    else:
+        response.headers['Cache-Control'] = "public, max-age={}".format(
+            CACHING_STATIC_MAX_AGE)
+
+    response.headers.pop('Expires', None)
+    return response
+
+
+def cache_fragment(response, max_age=None):
+    """Make a fragment response public and answer If-None-Match with 304.
+
+    The ETag is the one the response already has, otherwise a hash of its
+    body.
+    """
+    if max_age is None:
+        max_age = CACHING_FRAGMENT_MAX_AGE
+
+    if response.get_etag()[0] is None:
+        response.add_etag()
+
+    response.headers['Cache-Control'] = "public, max-age={}".format(max_age)
+    return response.make_conditional(request)
+
+
+def init(app):
+    @app.after_request
+    def apply_caching_policy(response):
+        if request.endpoint == 'static':
+            return cache_static(response)
+
+        # Errors of cacheable endpoints leave Cache-Control unset
+        if (request.endpoint in cacheable_endpoints and
+                'Cache-Control' in response.headers):
+
+            return response
+
+        return disable_caching(response)
@@ -1,22 +1,66 @@
+from abc import ABC, abstractmethod
 from contextlib import suppress
 import json
+from time import perf_counter
 
 from ccp.constants import CommunicationMode
-from ccp.transmit import CommunicationAccepted, SRCDSClient
+from ccp.sock_client import ConnectionAbort
+from ccp.transmit import (
+    CommunicationAccepted, CommunicationEnded, SRCDSClient)
 
+from . import config
+from .health import get_server_health
+from .wire import get_codec, JSONCodec, WIRE_CODECS
 
-class MOTDClient(SRCDSClient):
-    def __init__(self, addr, plugin_name):
-        super().__init__(addr, plugin_name)
 
-        self.set_mode(CommunicationMode.RAW)
+# How long we wait for SRCDS to accept a new connection, seconds
+CONNECT_TIMEOUT = config.getfloat('ccp', 'connect_timeout', fallback=5.0)
 
-        with suppress(CommunicationAccepted):
-            self.receive_data()
+
+class AnswerStreamError(Exception):
+    """SRCDS failed in the middle of a streamed answer."""
+    def __init__(self, status):
+        super().__init__(status)
+        self.status = status
+
+
+class MOTDProtocolMixin(ABC):
+    """High-level MOTDPlayer actions on top of send_json_data() and
+    receive_json_data()."""
+    # Pool that this client is returned to on release (None = not pooled)
+    pool = None
+
+    # Becomes False as soon as SRCDS rejects anything: in that case
+    # the receiver closes its end of the connection
+    reusable = True
+
+    # True while SRCDS may still be sending chunks of a streamed answer
+    answer_pending = False
+
+    # True while the answer to a reset sent by send_reset() is unread
+    reset_pending = False
+
+    # Messages SRCDS may send to a WebSocket before we acknowledge them
+    # (None = SRCDS doesn't wait for acknowledgements)
+    ws_window = None
+    ws_delivered = 0
+
+    @abstractmethod
+    def send_json_data(self, **kwargs):
+        """Send a message to SRCDS."""
+
+    @abstractmethod
+    def receive_json_data(self):
+        """Wait for the next message from SRCDS and return it."""
 
     def exchange_json_data(self, **kwargs):
-        self.send_data(json.dumps(kwargs).encode('utf-8'))
-        return json.loads(self.receive_data().decode('utf-8'))
+        self.send_json_data(**kwargs)
+        response = self.receive_json_data()
+
+        if response['status'] != "OK":
+            self.reusable = False
+
+        return response
 
     def exchange_custom_data(self, data):
         response = self.exchange_json_data(
@@ -27,22 +71,198 @@ class MOTDClient(SRCDSClient):
 
         return None
 
-    def request_switch(self, new_page_id):
-        response = self.exchange_json_data(
-            action="switch", new_page_id=new_page_id)
+    def exchange_custom_data_stream(self, data):
+        """Yield the chunks of the answer as SRCDS sends them.
+
+        Pages that don't stream their answers produce a single chunk.
+
+        :raise AnswerStreamError: if SRCDS fails mid-way
+        """
+        self.send_json_data(
+            action="custom-data", custom_data=data, stream=True)
+        self.answer_pending = True
 
-        self.stop()
+        while True:
+            response = self.receive_json_data()
+
+            if response['status'] == "CHUNK":
+                yield response['custom_data']
+                continue
+
+            self.answer_pending = False
+
+            if response['status'] != "OK":
+                self.reusable = False
+                raise AnswerStreamError(response['status'])
+
+            if not response.get('stream_end'):
+                yield response['custom_data']
+
+            return
+
+    def request_switch(self, new_page_id, request_type=None):
+        """
+        :param request_type: request type the new page should see on
+            the following exchanges of this connection, None to keep it
+        """
+        kwargs = {}
+        if request_type is not None:
+            kwargs['request_type'] = request_type
+
+        response = self.exchange_json_data(
+            action="switch", new_page_id=new_page_id, **kwargs)
 
         return response['status'] == "OK"
 
-    def set_identity(self, steamid, salt, session_id, request_type):
+    def set_identity(self, steamid, salt, session_id, request_type,
+                     push_channel=None):
+
+        kwargs = {}
+        if push_channel is not None:
+            kwargs['push_channel'] = push_channel
+
+        if request_type == "WEBSOCKET":
+            kwargs['flow_control'] = True
+
         response = self.exchange_json_data(
             action="set-identity", new_salt=salt, steamid=steamid,
-            session_id=session_id, request_type=request_type
+            session_id=session_id, request_type=request_type, **kwargs
         )
 
         if response['status'] == "OK":
+            self.ws_window = response.get('ws_window')
+            self.ws_delivered = 0
             return None
 
-        self.stop()
+        self.release()
         return response['status']
+
+    def ack_ws_messages(self, count):
+        """Tell SRCDS that count more messages have reached the browser.
+
+        Acknowledgements are sent once half of the window is delivered.
+        """
+        if self.ws_window is None:
+            return
+
+        self.ws_delivered += count
+        if self.ws_delivered >= max(1, self.ws_window // 2):
+            self.send_json_data(action="ack", count=self.ws_delivered)
+            self.ws_delivered = 0
+
+    @abstractmethod
+    def release(self):
+        """Give the connection back (or close it) once the request is
+        done with it."""
+
+
+class MOTDClient(MOTDProtocolMixin, SRCDSClient):
+    def __init__(self, addr, plugin_name, features=(),
+                 timeout=CONNECT_TIMEOUT):
+
+        super().__init__(addr, plugin_name)
+
+        self.codec = JSONCodec
+        self.features = []
+
+        # A frozen SRCDS still lets the OS accept our connection, so bound
+        # the handshake too
+        self.sock.settimeout(timeout)
+
+        self.set_mode(CommunicationMode.RAW)
+
+        with suppress(CommunicationAccepted):
+            self.receive_data()
+
+        # Old receivers don't know about 'hello', so only send it if we
+        # actually want something else than plain lock-step JSON
+        if features or WIRE_CODECS != [JSONCodec, ]:
+            self.negotiate(features)
+
+        self.sock.settimeout(None)
+
+    def send_json_data(self, **kwargs):
+        self.send_data(self.codec.encode(kwargs))
+
+    def receive_json_data(self):
+        return self.codec.decode(self.receive_data())
+
+    def negotiate(self, features):
+        # The handshake itself is always JSON
+        self.send_data(json.dumps({
+            'action': "hello",
+            'features': list(features),
+            'codecs': [codec.name for codec in WIRE_CODECS],
+        }).encode('utf-8'))
+        response = json.loads(self.receive_data().decode('utf-8'))
+
+        self.features = response.get('features', [])
+        self.codec = get_codec(response.get('codec'))
+
+    def subscribe_push(self, channel_id):
+        """Turn this connection into a push channel."""
+        return self.exchange_json_data(
+            action="push-subscribe", channel_id=channel_id)['status'] == "OK"
+
+    def reset(self):
+        """Ask SRCDS to forget the identity set on this connection."""
+        return self.exchange_json_data(action="reset")['status'] == "OK"
+
+    def send_reset(self):
+        """Same as reset(), but leave the answer for confirm_reset()."""
+        self.send_json_data(action="reset")
+        self.reset_pending = True
+
+    def confirm_reset(self):
+        """Read the answer to send_reset(), if it hasn't been read yet.
+
+        :return: whether SRCDS has forgotten the identity
+        """
+        if not self.reset_pending:
+            return True
+
+        self.reset_pending = False
+        return self.receive_json_data()['status'] == "OK"
+
+    def release(self):
+        # Chunks of an abandoned answer are still on their way
+        if self.answer_pending:
+            self.reusable = False
+
+        if self.pool is None:
+            self.stop()
+        else:
+            self.pool.checkin(self)
+
+
+def open_client(client_class, server_id, addr, timeout=CONNECT_TIMEOUT,
+                **kwargs):
+    """Make a new connection to SRCDS and update the server's health.
+
+    Only actual connects are recorded: reusing a pooled client or opening
+    a stream on a shared connection tells nothing about the server.
+    """
+    health = get_server_health(server_id)
+
+    started_at = perf_counter()
+    try:
+        client = client_class(addr, 'motdplayer', timeout=timeout, **kwargs)
+
+    except ConnectionAbort:
+
+        # SRCDS is up, it just doesn't like us
+        if health is not None:
+            health.record_success(perf_counter() - started_at)
+
+        raise
+
+    except (OSError, CommunicationEnded):
+        if health is not None:
+            health.record_failure()
+
+        raise
+
+    if health is not None:
+        health.record_success(perf_counter() - started_at)
+
+    return client
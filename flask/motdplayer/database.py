@@ -1,24 +1,117 @@
-from hashlib import sha512
 import os.path
 from random import choice
 import string
 
-from . import AuthMethod, MOTDPLAYER_DATA_PATH
+from . import AuthMethod, config, MOTDPLAYER_DATA_PATH
+from .tokens import get_legacy_token, HMACTokenizer, verify_legacy_token
 
 
 SALT_CHARACTERS = string.ascii_letters + string.digits
 SALT_LENGTH = 64
 SERVER_SALTS_DIR = os.path.join(MOTDPLAYER_DATA_PATH, "server_salts")
+HMAC_TOKEN_SIZE = config.getint('auth', 'hmac_token_size', fallback=64)
+HMAC_MIN_TOKEN_SIZE = config.getint(
+    'auth', 'hmac_min_token_size', fallback=32)
+
+SRCDS_AUTH_METHODS = (AuthMethod.SRCDS, AuthMethod.SRCDS_HMAC)
+WEB_AUTH_METHODS = (AuthMethod.WEB, AuthMethod.WEB_HMAC)
+HMAC_AUTH_METHODS = (AuthMethod.SRCDS_HMAC, AuthMethod.WEB_HMAC)
 
 
 server_salts = {}
+server_tokenizers = {}
+
+
+def add_server_salt(server_id, server_salt):
+    server_salts[server_id] = server_salt
+    server_tokenizers[server_id] = HMACTokenizer(
+        server_salt, HMAC_TOKEN_SIZE, HMAC_MIN_TOKEN_SIZE)
+
+
 for item in os.listdir(SERVER_SALTS_DIR):
     full_item = os.path.join(SERVER_SALTS_DIR, item)
 
     if os.path.isfile(full_item) and full_item.lower().endswith('.dat'):
         base_item = os.path.splitext(item)[0]
         with open(full_item, 'rb') as f:
-            server_salts[base_item] = f.read()
+            add_server_salt(base_item, f.read())
+
+
+def get_web_auth_method(auth_method):
+    """Web tokens we issue follow the scheme of the request."""
+    if auth_method in HMAC_AUTH_METHODS:
+        return AuthMethod.WEB_HMAC
+
+    return AuthMethod.WEB
+
+
+class UserMixin:
+    """Auth logic shared by the User model and its cached copies."""
+    def _get_token_fields(self, salt, plugin_id, page_id, session_id):
+        return (salt, self.server_id, plugin_id, self.steamid, page_id,
+                session_id)
+
+    def _get_token(self, salt, method, plugin_id, page_id, session_id):
+        fields = self._get_token_fields(salt, plugin_id, page_id, session_id)
+
+        if method in HMAC_AUTH_METHODS:
+            return server_tokenizers[self.server_id].get_token(*fields)
+
+        return get_legacy_token(*fields, server_salts[self.server_id])
+
+    def get_auth_token(self, plugin_id, page_id, session_id,
+                       method=AuthMethod.SRCDS):
+
+        return self._get_token(
+            self.salt, method, plugin_id, page_id, session_id)
+
+    def get_web_auth_token(self, plugin_id, page_id, session_id,
+                           method=AuthMethod.WEB):
+
+        return self._get_token(
+            self.web_salt, method, plugin_id, page_id, session_id)
+
+    def authenticate(self, method, plugin_id, page_id, auth_token, session_id):
+        if method in SRCDS_AUTH_METHODS:
+            salt = self.salt
+        elif method in WEB_AUTH_METHODS:
+            salt = self.web_salt
+        else:
+            return False
+
+        if method in HMAC_AUTH_METHODS:
+            return server_tokenizers[self.server_id].verify(
+                auth_token, *self._get_token_fields(
+                    salt, plugin_id, page_id, session_id))
+
+        return verify_legacy_token(auth_token, self._get_token(
+            salt, method, plugin_id, page_id, session_id))
+
+    @staticmethod
+    def get_new_salt():
+        return ''.join(
+            [choice(SALT_CHARACTERS) for x in range(SALT_LENGTH)])
+
+
+class UserRecord(UserMixin):
+    """Detached copy of a User row that can outlive the DB session."""
+    __slots__ = ('id', 'server_id', 'steamid', 'salt', 'web_salt')
+
+    def __init__(self, id_, server_id, steamid, salt="", web_salt=""):
+        self.id = id_
+        self.server_id = server_id
+        self.steamid = steamid
+        self.salt = salt
+        self.web_salt = web_salt
+
+    @classmethod
+    def from_user(cls, user):
+        return cls(
+            user.id, user.server_id, user.steamid, user.salt, user.web_salt)
+
+    def copy(self):
+        return UserRecord(
+            self.id, self.server_id, self.steamid, self.salt, self.web_salt)
 
 
 User = None
@@ -27,8 +120,12 @@ User = None
 def init(app, db):
     global User
 
-    class User(db.Model):
+    class User(UserMixin, db.Model):
         __tablename__ = "motdplayer_users"
+        __table_args__ = (
+            db.Index("ix_motdplayer_users_server_id_steamid",
+                     'server_id', 'steamid', unique=True),
+        )
 
         id = db.Column(db.Integer, primary_key=True)
         server_id = db.Column(db.String(32))
@@ -43,45 +140,3 @@ def init(app, db):
             self.steamid = steamid
             self.salt = ""
             self.web_salt = ""
-
-        def get_auth_token(self, plugin_id, page_id, session_id):
-            return sha512(
-                (
-                    self.salt +
-                    self.server_id +
-                    plugin_id +
-                    self.steamid +
-                    page_id +
-                    str(session_id)
-                ).encode('ascii') + server_salts[self.server_id]
-            ).hexdigest()
-
-        def get_web_auth_token(self, plugin_id, page_id, session_id):
-            return sha512(
-                (
-                    self.web_salt +
-                    self.server_id +
-                    plugin_id +
-                    self.steamid +
-                    page_id +
-                    str(session_id)
-                ).encode('ascii') + server_salts[self.server_id]
-            ).hexdigest()
-
-        def authenticate(
-                self, method, plugin_id, page_id, auth_token, session_id):
-
-            if method == AuthMethod.SRCDS:
-                return auth_token == self.get_auth_token(
-                    plugin_id, page_id, session_id)
-
-            if method == AuthMethod.WEB:
-                return auth_token == self.get_web_auth_token(
-                    plugin_id, page_id, session_id)
-
-            return False
-
-        @staticmethod
-        def get_new_salt():
-            return ''.join(
-                [choice(SALT_CHARACTERS) for x in range(SALT_LENGTH)])
@@ -0,0 +1,812 @@
+"""Standalone asyncio WebSocket gateway.
+
+Serves base_route_ws without uWSGI: a single process holds any number of
+MoTD WebSockets, and the SRCDS side of each one is watched by the event
+loop instead of occupying a worker.
+"""
+import asyncio
+from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha1
+import struct
+from uuid import uuid4
+import zlib
+
+from werkzeug.exceptions import NotFound
+from werkzeug.routing import Map, Rule
+
+from ccp.sock_client import ConnectionAbort
+from ccp.transmit import CommunicationEnded
+
+from . import config, servers
+from .clients import MOTDClient, open_client
+from .metrics import RequestTimer
+from .relay import (
+    count_ws_messages, encode_ws_message, RelayError, relay_to_srcds,
+    relay_to_ws)
+from .views import build_error, create_client, get_web_auth, print_exc
+from .wire import DECODE_ERRORS
+
+
+GATEWAY_HOST = config.get('gateway', 'host', fallback="127.0.0.1")
+GATEWAY_PORT = config.getint('gateway', 'port', fallback=5001)
+GATEWAY_MAX_MESSAGE_SIZE = config.getint(
+    'gateway', 'max_message_size', fallback=1024 * 1024)
+GATEWAY_WRITE_BUFFER_LIMIT = config.getint(
+    'gateway', 'write_buffer_limit', fallback=256 * 1024)
+GATEWAY_PUSH_CHANNELS = config.getboolean(
+    'gateway', 'push_channels', fallback=False)
+
+# ccp sockets are blocking: every connect, write and frame being read holds
+# one of these threads until it's done
+GATEWAY_SRCDS_THREADS = config.getint(
+    'gateway', 'srcds_threads', fallback=64)
+GATEWAY_SRCDS_FRAME_TIMEOUT = config.getfloat(
+    'gateway', 'srcds_frame_timeout', fallback=5.0)
+
+# permessage-deflate (RFC 7692), if the browser offers it
+GATEWAY_COMPRESSION = config.getboolean(
+    'gateway', 'compression', fallback=True)
+GATEWAY_COMPRESSION_LEVEL = config.getint(
+    'gateway', 'compression_level', fallback=6)
+GATEWAY_COMPRESSION_THRESHOLD = config.getint(
+    'gateway', 'compression_threshold', fallback=256)
+
+WS_GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+MAX_HEADERS_SIZE = 8192
+
+OPCODE_CONTINUATION = 0x0
+OPCODE_TEXT = 0x1
+OPCODE_BINARY = 0x2
+OPCODE_CLOSE = 0x8
+OPCODE_PING = 0x9
+OPCODE_PONG = 0xA
+
+RSV1 = 0x40
+
+CLOSE_NORMAL = 1000
+CLOSE_PROTOCOL_ERROR = 1002
+CLOSE_TOO_BIG = 1009
+
+DEFLATE_TAIL = b"\x00\x00\xff\xff"
+
+SRCDS_ERRORS = (OSError, ConnectionAbort, CommunicationEnded)
+PUSH_CHANNEL_ERRORS = SRCDS_ERRORS + DECODE_ERRORS
+
+
+class WebSocketClosed(Exception):
+    pass
+
+
+class WebSocketProtocolError(Exception):
+    def __init__(self, message, close_code=CLOSE_PROTOCOL_ERROR):
+        super().__init__(message)
+        self.close_code = close_code
+
+
+async def wait_readable(sock):
+    """Wait until there's something to read on a blocking socket."""
+    loop = asyncio.get_running_loop()
+    readable = loop.create_future()
+
+    def on_readable():
+        if not readable.done():
+            readable.set_result(None)
+
+    fileno = sock.fileno()
+    loop.add_reader(fileno, on_readable)
+    try:
+        await readable
+    finally:
+        loop.remove_reader(fileno)
+
+
+def unmask(payload, mask):
+    length = len(payload)
+    mask = (mask * (length // 4 + 1))[:length]
+
+    return (int.from_bytes(payload, 'big') ^
+            int.from_bytes(mask, 'big')).to_bytes(length, 'big')
+
+
+class PerMessageDeflate:
+    """permessage-deflate extension of a single connection.
+
+    Both directions keep their compression context between messages
+    (unless the browser asks otherwise), so repetitive messages such as
+    player lists shrink to a fraction of their first copy.
+    """
+    name = "permessage-deflate"
+
+    def __init__(self, level=GATEWAY_COMPRESSION_LEVEL,
+                 threshold=GATEWAY_COMPRESSION_THRESHOLD, window_bits=15,
+                 server_no_context_takeover=False,
+                 client_no_context_takeover=False):
+
+        self.level = level
+        self.threshold = threshold
+        self.window_bits = window_bits
+        self.server_no_context_takeover = server_no_context_takeover
+        self.client_no_context_takeover = client_no_context_takeover
+
+        self._compressor = zlib.compressobj(
+            level, zlib.DEFLATED, -window_bits)
+        self._decompressor = zlib.decompressobj(-15)
+
+    @classmethod
+    def negotiate(cls, header, level=GATEWAY_COMPRESSION_LEVEL,
+                  threshold=GATEWAY_COMPRESSION_THRESHOLD):
+        """Accept the first offer of Sec-WebSocket-Extensions we support.
+
+        :return: (extension, response header value) or (None, None)
+        """
+        for offer in header.split(','):
+            name, *params = [part.strip() for part in offer.split(';')]
+            if name != cls.name:
+                continue
+
+            try:
+                kwargs, response = cls._accept_params(params)
+            except ValueError:
+                continue
+
+            return cls(level, threshold, **kwargs), "; ".join(
+                [cls.name, ] + response)
+
+        return None, None
+
+    @staticmethod
+    def _accept_params(params):
+        kwargs = {}
+        response = []
+        seen = set()
+        for param in params:
+            key, _, value = param.partition('=')
+            key, value = key.strip(), value.strip().strip('"')
+
+            if key in seen:
+                raise ValueError("Duplicate parameter")
+
+            seen.add(key)
+
+            if key == "server_no_context_takeover" and not value:
+                kwargs['server_no_context_takeover'] = True
+                response.append(key)
+
+            elif key == "client_no_context_takeover" and not value:
+                kwargs['client_no_context_takeover'] = True
+                response.append(key)
+
+            # zlib can't make raw deflate streams with a 256-byte window
+            elif key == "server_max_window_bits":
+                window_bits = int(value)
+                if not 9 <= window_bits <= 15:
+                    raise ValueError("Unsupported window size")
+
+                kwargs['window_bits'] = window_bits
+                response.append("{}={}".format(key, window_bits))
+
+            # We decompress with the largest window anyway
+            elif key == "client_max_window_bits":
+                if value and not 8 <= int(value) <= 15:
+                    raise ValueError("Invalid window size")
+
+            else:
+                raise ValueError("Unknown parameter")
+
+        return kwargs, response
+
+    def compress(self, data):
+        """Return (payload, rsv) of a data frame."""
+        if len(data) < self.threshold:
+            return data, 0
+
+        # A full flush makes the message independent of the previous ones
+        mode = (zlib.Z_FULL_FLUSH if self.server_no_context_takeover
+                else zlib.Z_SYNC_FLUSH)
+
+        payload = self._compressor.compress(data) + self._compressor.flush(
+            mode)
+
+        return payload[:-len(DEFLATE_TAIL)], RSV1
+
+    def decompress(self, payload, max_size):
+        if self.client_no_context_takeover:
+            self._decompressor = zlib.decompressobj(-15)
+
+        try:
+            data = self._decompressor.decompress(
+                payload + DEFLATE_TAIL, max_size + 1)
+        except zlib.error as e:
+            raise WebSocketProtocolError("Invalid compressed data") from e
+
+        if len(data) > max_size or self._decompressor.unconsumed_tail:
+            raise WebSocketProtocolError("Message is too big", CLOSE_TOO_BIG)
+
+        return data
+
+
+class WebSocket:
+    """Server end of an RFC 6455 connection."""
+    def __init__(self, reader, writer, max_message_size, deflate=None):
+        self.reader = reader
+        self.writer = writer
+        self.max_message_size = max_message_size
+        self.deflate = deflate
+        self.closed = False
+
+    async def _read_frame(self):
+        head = await self.reader.readexactly(2)
+
+        fin = bool(head[0] & 0x80)
+        rsv = head[0] & 0x70
+        opcode = head[0] & 0x0F
+        masked = bool(head[1] & 0x80)
+        length = head[1] & 0x7F
+
+        if length == 126:
+            length = struct.unpack('!H', await self.reader.readexactly(2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', await self.reader.readexactly(8))[0]
+
+        if not masked:
+            raise WebSocketProtocolError("Client frames must be masked")
+
+        if length > self.max_message_size:
+            raise WebSocketProtocolError("Frame is too big", CLOSE_TOO_BIG)
+
+        mask = await self.reader.readexactly(4)
+        payload = unmask(await self.reader.readexactly(length), mask)
+
+        return fin, rsv, opcode, payload
+
+    async def receive(self):
+        """Return the next data message (bytes), None once closed."""
+        message = None
+        compressed = False
+        while True:
+            try:
+                fin, rsv, opcode, payload = await self._read_frame()
+            except (asyncio.IncompleteReadError, ConnectionError):
+                self.closed = True
+                return None
+
+            # RSV1 marks the first frame of a compressed message
+            if rsv == RSV1 and self.deflate is not None and opcode in (
+                    OPCODE_TEXT, OPCODE_BINARY):
+
+                compressed = True
+
+            elif rsv:
+                raise WebSocketProtocolError("Unexpected RSV bits")
+
+            if opcode == OPCODE_CLOSE:
+                self.close(CLOSE_NORMAL)
+                return None
+
+            if opcode == OPCODE_PING:
+                self.write_frame(OPCODE_PONG, payload)
+                continue
+
+            if opcode == OPCODE_PONG:
+                continue
+
+            if opcode in (OPCODE_TEXT, OPCODE_BINARY):
+                if message is not None:
+                    raise WebSocketProtocolError("Expected continuation")
+
+                message = payload
+
+            elif opcode == OPCODE_CONTINUATION:
+                if message is None:
+                    raise WebSocketProtocolError("Unexpected continuation")
+
+                message += payload
+
+            else:
+                raise WebSocketProtocolError("Unknown opcode")
+
+            if len(message) > self.max_message_size:
+                raise WebSocketProtocolError(
+                    "Message is too big", CLOSE_TOO_BIG)
+
+            if fin:
+                if compressed:
+                    return self.deflate.decompress(
+                        message, self.max_message_size)
+
+                return message
+
+    def write_frame(self, opcode, payload, rsv=0):
+        if self.closed:
+            raise WebSocketClosed()
+
+        length = len(payload)
+        if length < 126:
+            head = struct.pack('!BB', 0x80 | rsv | opcode, length)
+        elif length < 65536:
+            head = struct.pack('!BBH', 0x80 | rsv | opcode, 126, length)
+        else:
+            head = struct.pack('!BBQ', 0x80 | rsv | opcode, 127, length)
+
+        self.writer.write(head + payload)
+
+    def send(self, data):
+        if self.deflate is None:
+            self.write_frame(OPCODE_TEXT, data)
+        else:
+            self.write_frame(OPCODE_TEXT, *self.deflate.compress(data))
+
+    @property
+    def write_buffer_size(self):
+        return self.writer.transport.get_write_buffer_size()
+
+    async def drain(self):
+        await self.writer.drain()
+
+    def close(self, code=CLOSE_NORMAL):
+        if self.closed:
+            return
+
+        try:
+            self.write_frame(OPCODE_CLOSE, struct.pack('!H', code))
+        finally:
+            self.closed = True
+            self.writer.close()
+
+
+class MOTDWebSocketSession:
+    """Relays data between one browser WebSocket and SRCDS."""
+    request_type = "WEBSOCKET"
+
+    def __init__(self, gateway, ws, route_args):
+        self.gateway = gateway
+        self.ws = ws
+        self.route_args = route_args
+        self.client = None
+        self.wrp = None
+        self._finished = None
+        self._send_lock = None
+        self._undelivered = 0
+
+    @property
+    def key(self):
+        return (str(self.route_args['steamid']), self.route_args['session_id'])
+
+    @property
+    def topic(self):
+        return (self.route_args['plugin_id'], self.route_args['page_id'])
+
+    def ws_send(self, **kwargs):
+        self.ws.send(encode_ws_message(**kwargs))
+
+    def push(self, data_encoded):
+        try:
+            self.ws.send(data_encoded)
+        except WebSocketClosed:
+            self._finish()
+            return
+
+        # We can't slow the push channel down for a single browser
+        if self.ws.write_buffer_size > self.gateway.write_buffer_limit:
+            self._end_transmission(RelayError("WS Client Too Slow."))
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        timer = RequestTimer(self.request_type)
+
+        channel = await self.gateway.get_push_channel(
+            self.route_args['server_id'])
+
+        server, wrp, user, client, error = await self.gateway.run_blocking(
+            self.gateway.create_client, self.route_args,
+            None if channel is None else channel.id, timer)
+
+        if error is not None:
+            self.ws_send(**error)
+            self.ws.close()
+            return
+
+        self.wrp = wrp
+        self.client = client
+        self._finished = loop.create_future()
+        self._send_lock = asyncio.Lock()
+
+        web_auth_method, web_auth_token = get_web_auth(
+            user, self.route_args['auth_method'],
+            self.route_args['plugin_id'], self.route_args['page_id'],
+            self.route_args['session_id'])
+
+        self.ws_send(status="OK", web_auth_method=web_auth_method,
+                     web_auth_token=web_auth_token)
+        timer.finish()
+
+        if channel is not None:
+            channel.add(self)
+
+        tasks = [asyncio.ensure_future(self._read_from_ws()),
+                 asyncio.ensure_future(self._read_from_srcds())]
+        try:
+            await asyncio.wait(
+                tasks + [self._finished], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            if channel is not None:
+                channel.remove(self)
+
+            for task in tasks:
+                task.cancel()
+
+            # Also wakes up an executor thread that's still reading
+            self._stop_client()
+            self.ws.close()
+
+    def _stop_client(self):
+        try:
+            self.client.stop()
+        except SRCDS_ERRORS:
+            pass
+
+    def _finish(self):
+        if not self._finished.done():
+            self._finished.set_result(None)
+
+    def _end_transmission(self, e):
+        if e.__cause__ is not None:
+            print_exc()
+
+        if e.error_id is not None and not self.ws.closed:
+            self.ws_send(**build_error(e.error_id, self.request_type))
+
+        self._finish()
+
+    async def _send_to_srcds(self, func, *args):
+        # Only one thread may write to the CCP socket at a time
+        async with self._send_lock:
+            await self.gateway.run_blocking(func, *args)
+
+    async def _read_from_ws(self):
+        while True:
+            try:
+                data_encoded = await self.ws.receive()
+            except WebSocketProtocolError as e:
+                self.ws.close(e.close_code)
+                break
+
+            if data_encoded is None:
+                break
+
+            try:
+                data_encoded = relay_to_srcds(
+                    self.wrp, self.client, data_encoded)
+            except RelayError as e:
+                self._end_transmission(e)
+                break
+
+            if data_encoded is None:
+                continue
+
+            try:
+                await self._send_to_srcds(self.client.send_data, data_encoded)
+            except SRCDS_ERRORS:
+                break
+
+        self._finish()
+
+    async def _read_from_srcds(self):
+        while True:
+            # Idle sessions don't hold a thread: we only hand the socket to
+            # the executor once a frame has started to arrive
+            try:
+                await wait_readable(self.client.sock)
+                data_encoded = await self.gateway.run_blocking(
+                    self.client.receive_data)
+            except SRCDS_ERRORS:
+                break
+
+            try:
+                messages = relay_to_ws(self.client, data_encoded)
+            except RelayError as e:
+                self._end_transmission(e)
+                return
+
+            try:
+                for message in messages:
+                    self.ws_send(**message)
+            except WebSocketClosed:
+                break
+
+            self._undelivered += count_ws_messages(messages)
+
+            # The browser doesn't keep up: stop reading from SRCDS and hold
+            # the acknowledgements back, so that SRCDS queues (or drops) the
+            # data instead of us buffering it
+            if self.ws.write_buffer_size > self.gateway.write_buffer_limit:
+                try:
+                    await self.ws.drain()
+                except ConnectionError:
+                    break
+
+            count, self._undelivered = self._undelivered, 0
+            try:
+                await self._send_to_srcds(self.client.ack_ws_messages, count)
+            except SRCDS_ERRORS:
+                break
+
+        self._finish()
+
+
+class PushChannel:
+    """Single SRCDS connection that carries broadcasts for a server.
+
+    SRCDS addresses a broadcast either to (steamid64, session_id) targets
+    or to (plugin_id, page_id) topics, and we fan it out to the matching
+    browser WebSockets.
+    """
+    def __init__(self, gateway, server_id, channel_id, client):
+        self.gateway = gateway
+        self.server_id = server_id
+        self.id = channel_id
+        self.client = client
+        self.closed = False
+
+        self._task = None
+        self._sessions = {}
+        self._topics = {}
+
+    def add(self, session):
+        self._sessions[session.key] = session
+        self._topics.setdefault(session.topic, set()).add(session)
+
+    def remove(self, session):
+        if self._sessions.get(session.key) is session:
+            del self._sessions[session.key]
+
+        topic_sessions = self._topics.get(session.topic)
+        if topic_sessions is not None:
+            topic_sessions.discard(session)
+            if not topic_sessions:
+                del self._topics[session.topic]
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._read())
+
+    def close(self):
+        if self.closed:
+            return
+
+        self.closed = True
+        if self._task is not asyncio.current_task():
+            self._task.cancel()
+
+        try:
+            self.client.stop()
+        except SRCDS_ERRORS:
+            pass
+
+    async def _read(self):
+        while True:
+            try:
+                await wait_readable(self.client.sock)
+                message = self.client.codec.decode(
+                    await self.gateway.run_blocking(self.client.receive_data))
+
+            except PUSH_CHANNEL_ERRORS:
+
+                self.close()
+                return
+
+            self._dispatch(message)
+
+    def _dispatch(self, message):
+        if not isinstance(message, dict) or message.get('status') != "PUSH":
+            return
+
+        recipients = set()
+        for topic in message.get('topics', ()):
+            recipients.update(self._topics.get(tuple(topic), ()))
+
+        for target in message.get('targets', ()):
+            session = self._sessions.get(tuple(target))
+            if session is not None:
+                recipients.add(session)
+
+        if not recipients:
+            return
+
+        # Same bytes for every browser
+        data_encoded = encode_ws_message(
+            status="CUSTOM_DATA", custom_data=message['custom_data'])
+
+        for session in recipients:
+            session.push(data_encoded)
+
+
+class WebSocketGateway:
+    def __init__(self, app, db, client_class=MOTDClient,
+                 max_message_size=GATEWAY_MAX_MESSAGE_SIZE,
+                 write_buffer_limit=GATEWAY_WRITE_BUFFER_LIMIT,
+                 push_channels=GATEWAY_PUSH_CHANNELS,
+                 compression=GATEWAY_COMPRESSION,
+                 srcds_threads=GATEWAY_SRCDS_THREADS,
+                 srcds_frame_timeout=GATEWAY_SRCDS_FRAME_TIMEOUT):
+
+        self.app = app
+        self.db = db
+        self.client_class = client_class
+        self.max_message_size = max_message_size
+        self.write_buffer_limit = write_buffer_limit
+        self.push_channels_enabled = push_channels
+        self.compression = compression
+        self.srcds_frame_timeout = srcds_frame_timeout
+
+        self.executor = ThreadPoolExecutor(
+            max_workers=srcds_threads, thread_name_prefix="motdplayer-srcds")
+
+        self.push_channels = {}
+        self._push_channel_locks = {}
+
+        self.url_map = Map([
+            Rule(config.get('application', 'base_route_ws'),
+                 endpoint='route_base_route_ws'),
+        ])
+
+    async def run_blocking(self, func, *args):
+        """Run a blocking call (ccp, database) in the SRCDS threads."""
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, func, *args)
+
+    def bound_frames(self, client):
+        """Make a frame that stops halfway fail instead of holding a thread.
+
+        We only start reading once the socket is readable, so the timeout
+        never fires on an idle connection.
+        """
+        client.sock.settimeout(self.srcds_frame_timeout)
+
+    def create_client(self, route_args, push_channel=None, timer=None):
+        # Runs in an executor thread: DB access and CCP handshake block
+        with self.app.app_context():
+            result = create_client(
+                self.client_class, self.db,
+                route_args['server_id'], route_args['plugin_id'],
+                route_args['page_id'], route_args['steamid'],
+                route_args['auth_method'], route_args['auth_token'],
+                route_args['session_id'], MOTDWebSocketSession.request_type,
+                push_channel, timer)
+
+        client, error = result[3:]
+        if client is not None and error is None:
+            self.bound_frames(client)
+
+        return result
+
+    def _connect_push_channel(self, server_id, channel_id):
+        server = servers[server_id]
+        client = open_client(
+            self.client_class, server_id, (server['host'], server['port']))
+
+        if not client.subscribe_push(channel_id):
+            client.stop()
+            raise ConnectionAbort()
+
+        self.bound_frames(client)
+        return client
+
+    async def get_push_channel(self, server_id):
+        """Return a live push channel to the server, None if unavailable."""
+        if not self.push_channels_enabled or server_id not in servers:
+            return None
+
+        lock = self._push_channel_locks.setdefault(server_id, asyncio.Lock())
+        async with lock:
+            channel = self.push_channels.get(server_id)
+            if channel is not None and not channel.closed:
+                return channel
+
+            channel_id = uuid4().hex
+            try:
+                client = await self.run_blocking(
+                    self._connect_push_channel, server_id, channel_id)
+
+            except PUSH_CHANNEL_ERRORS:
+
+                # Broadcasts will reach these sessions directly
+                return None
+
+            channel = self.push_channels[server_id] = PushChannel(
+                self, server_id, channel_id, client)
+
+            channel.start()
+            return channel
+
+    async def handle_connection(self, reader, writer):
+        try:
+            route_args, deflate = await self.handshake(reader, writer)
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                ConnectionError, ValueError):
+
+            writer.close()
+            return
+
+        if route_args is None:
+            writer.close()
+            return
+
+        ws = WebSocket(reader, writer, self.max_message_size, deflate)
+        try:
+            await MOTDWebSocketSession(self, ws, route_args).run()
+        except Exception:
+            print_exc()
+            ws.close()
+
+    async def handshake(self, reader, writer):
+        head = await reader.readuntil(b"\r\n\r\n")
+        if len(head) > MAX_HEADERS_SIZE:
+            raise ValueError("Headers are too big")
+
+        request_line, *header_lines = head.decode('latin-1').split("\r\n")
+        method, path, version = request_line.split(' ', 2)
+
+        headers = {}
+        for line in header_lines:
+            if line:
+                name, value = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+
+        try:
+            endpoint, route_args = self.url_map.bind(
+                headers.get('host', "")).match(path.split('?', 1)[0])
+        except NotFound:
+            self.respond(writer, "404 Not Found")
+            return None, None
+
+        key = headers.get('sec-websocket-key')
+        if (method != "GET" or key is None or
+                headers.get('upgrade', "").lower() != "websocket" or
+                "upgrade" not in headers.get('connection', "").lower() or
+                headers.get('sec-websocket-version') != "13"):
+
+            self.respond(writer, "400 Bad Request")
+            return None, None
+
+        deflate = extensions = None
+        if self.compression:
+            deflate, extensions = PerMessageDeflate.negotiate(
+                headers.get('sec-websocket-extensions', ""))
+
+        accept = b64encode(sha1(key.encode('ascii') + WS_GUID).digest())
+        response = (
+            b"HTTP/1.1 101 Switching Protocols\r\n"
+            b"Upgrade: websocket\r\n"
+            b"Connection: Upgrade\r\n"
+            b"Sec-WebSocket-Accept: " + accept + b"\r\n")
+
+        if extensions is not None:
+            response += "Sec-WebSocket-Extensions: {}\r\n".format(
+                extensions).encode('ascii')
+
+        writer.write(response + b"\r\n")
+
+        return route_args, deflate
+
+    @staticmethod
+    def respond(writer, status):
+        writer.write(
+            "HTTP/1.1 {}\r\nContent-Length: 0\r\n"
+            "Connection: close\r\n\r\n".format(status).encode('ascii'))
+
+    async def _serve(self, host, port):
+        server = await asyncio.start_server(
+            self.handle_connection, host, port, limit=MAX_HEADERS_SIZE)
+
+        print("MOTDPlayer: WebSocket gateway is listening on {}:{}".format(
+            host, port))
+
+        async with server:
+            await server.serve_forever()
+
+    def serve(self, host=GATEWAY_HOST, port=GATEWAY_PORT):
+        try:
+            asyncio.run(self._serve(host, port))
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,121 @@
+"""Health of the game servers, as seen by the connections we make to them.
+
+Every server is in one of these states:
+    healthy     connects succeed and are fast
+    degraded    connects are slower than slow_connect on average, or some
+                of the latest ones failed
+    open        failure_threshold connects in a row failed: requests fail
+                right away instead of waiting for a connect that is going
+                to fail too. After open_timeout seconds a single request is
+                let through as a probe, and its success closes the circuit
+
+Each process keeps its own view, so a worker only waits for the failures
+it has seen itself.
+"""
+from threading import Lock
+from time import monotonic
+
+from . import config, metrics
+
+
+HEALTH_ENABLED = config.getboolean('health', 'enabled', fallback=True)
+HEALTH_FAILURE_THRESHOLD = config.getint(
+    'health', 'failure_threshold', fallback=3)
+HEALTH_OPEN_TIMEOUT = config.getfloat('health', 'open_timeout', fallback=10.0)
+HEALTH_SLOW_CONNECT = config.getfloat('health', 'slow_connect', fallback=0.5)
+HEALTH_LATENCY_SMOOTHING = config.getfloat(
+    'health', 'latency_smoothing', fallback=0.2)
+
+HEALTHY = "healthy"
+DEGRADED = "degraded"
+OPEN = "open"
+
+
+class ServerHealth:
+    def __init__(self, server_id, failure_threshold=HEALTH_FAILURE_THRESHOLD,
+                 open_timeout=HEALTH_OPEN_TIMEOUT,
+                 slow_connect=HEALTH_SLOW_CONNECT,
+                 latency_smoothing=HEALTH_LATENCY_SMOOTHING):
+
+        self.server_id = server_id
+        self.failure_threshold = failure_threshold
+        self.open_timeout = open_timeout
+        self.slow_connect = slow_connect
+        self.latency_smoothing = latency_smoothing
+
+        self.state = HEALTHY
+        self.failures = 0  # In a row
+        self.latency = None  # Moving average of connect times, seconds
+
+        self._opened_at = None
+        self._probe_started_at = None
+        self._lock = Lock()
+
+        metrics.set_server_state(server_id, None, self.state)
+
+    def _set_state(self, state):
+        if state != self.state:
+            metrics.set_server_state(self.server_id, self.state, state)
+            self.state = state
+
+    def allow_request(self):
+        """Return whether the request may connect to the server."""
+        with self._lock:
+            if self.state != OPEN:
+                return True
+
+            now = monotonic()
+            if now - self._opened_at < self.open_timeout:
+                return False
+
+            # Half-open: a single probe at a time. A probe that never
+            # reported back is replaced after another open_timeout
+            if (self._probe_started_at is not None and
+                    now - self._probe_started_at < self.open_timeout):
+
+                return False
+
+            self._probe_started_at = now
+            return True
+
+    def record_success(self, latency):
+        with self._lock:
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += self.latency_smoothing * (
+                    latency - self.latency)
+
+            self.failures = 0
+            self._opened_at = self._probe_started_at = None
+
+            self._set_state(
+                DEGRADED if self.latency > self.slow_connect else HEALTHY)
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probe_started_at = None
+
+            if self.state == OPEN or self.failures >= self.failure_threshold:
+                self._opened_at = monotonic()
+                self._set_state(OPEN)
+            else:
+                self._set_state(DEGRADED)
+
+
+servers_health = {}
+_servers_health_lock = Lock()
+
+
+def get_server_health(server_id):
+    """Return the health of the server, None if tracking is disabled."""
+    if not HEALTH_ENABLED:
+        return None
+
+    with _servers_health_lock:
+        try:
+            return servers_health[server_id]
+        except KeyError:
+            health = servers_health[server_id] = ServerHealth(server_id)
+            return health
@@ -0,0 +1,461 @@
+"""Request metrics in Prometheus text format.
+
+Every process writes its values to its own file in the metrics directory
+(a mmap'ed append-only table of keys and doubles), so recording a value
+never takes a lock that other uWSGI workers would contend for. The
+metrics route sums up the files of all workers. Files of workers that have
+exited are folded into an archive, minus their gauges.
+
+Phases of a request, in order:
+    lookup          server, plugin and page lookup
+    user            loading the user (from the cache or the database)
+    auth            token verification
+    connect         connecting to SRCDS (or a pool checkout)
+    set_identity    set-identity exchange with SRCDS
+    salt_save       saving the rotated salt
+    callback        WRP callback, including the SRCDS exchanges it makes
+                    and the release of the connection
+    switch          switch exchange with SRCDS
+    render          render_template
+"""
+from bisect import bisect_left
+from contextlib import contextmanager
+from hmac import compare_digest
+import json
+import mmap
+import os
+import os.path
+import struct
+from threading import Lock
+from time import perf_counter
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from flask import abort, request, Response
+
+from . import config, MOTDPLAYER_DATA_PATH
+
+
+METRICS_ENABLED = config.getboolean('metrics', 'enabled', fallback=False)
+METRICS_ROUTE = config.get('metrics', 'route', fallback="/metrics")
+METRICS_DIRECTORY = os.path.join(MOTDPLAYER_DATA_PATH, config.get(
+    'metrics', 'directory', fallback="metrics"))
+METRICS_ALLOWED_ADDRESSES = [address.strip() for address in config.get(
+    'metrics', 'allowed_addresses', fallback="127.0.0.1").split(',')]
+
+# Behind a reverse proxy every request comes from the proxy's address, so
+# the address alone lets everyone in: require this bearer token then
+METRICS_TOKEN = config.get('metrics', 'token', fallback="")
+
+METRICS_FILE_EXTENSION = ".metrics"
+METRICS_FILE_INITIAL_SIZE = 64 * 1024
+
+# Counters and histograms of processes that have exited
+ARCHIVE_FILE_NAME = "archive.json"
+ARCHIVE_LOCK_FILE_NAME = "archive.lock"
+
+# Upper bounds, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0)
+BUCKET_NAMES = [repr(bucket) for bucket in BUCKETS] + ["+Inf", ]
+
+HEADER_STRUCT = struct.Struct('<I')
+KEY_LENGTH_STRUCT = struct.Struct('<I')
+VALUE_STRUCT = struct.Struct('<d')
+
+PAGE_LABELS = ("server_id", "plugin_id", "page_id", "request_type")
+
+# Statuses of failed requests, so that the error IDs (some of which carry
+# SRCDS statuses) can't create new series
+ERROR_STATUSES = {
+    "Unknown Server.": "NOT_FOUND",
+    "Unknown Plugin.": "NOT_FOUND",
+    "Unknown Page.": "NOT_FOUND",
+    "Unknown Fragment.": "NOT_FOUND",
+    "Bad Request.": "BAD_REQUEST",
+    "Invalid Action.": "BAD_REQUEST",
+    "Unknown Auth Method.": "BAD_REQUEST",
+    "Invalid Auth.": "AUTH_FAILED",
+    "IP Not Whitelisted.": "AUTH_FAILED",
+    "Identity Rejected": "REJECTED",
+    "Switch Rejected.": "REJECTED",
+    "SRCDS Unavailable.": "SRCDS_UNAVAILABLE",
+    "SRCDS Connection Failed.": "SRCDS_UNAVAILABLE",
+    "SRCDS Connection Lost.": "SRCDS_ERROR",
+    "SRCDS Stream Failed": "SRCDS_ERROR",
+    "Application Failed To Load.": "APPLICATION_ERROR",
+    "WRP": "APPLICATION_ERROR",
+}
+
+
+class Metric:
+    def __init__(self, name, type_, description, label_names):
+        self.name = name
+        self.type = type_
+        self.description = description
+        self.label_names = label_names
+
+
+PHASE_SECONDS = Metric(
+    "motdplayer_phase_seconds", "histogram",
+    "Time spent in each phase of a request.", PAGE_LABELS + ("phase", ))
+REQUEST_SECONDS = Metric(
+    "motdplayer_request_seconds", "histogram",
+    "Time it took to answer a request.", PAGE_LABELS)
+REQUESTS_TOTAL = Metric(
+    "motdplayer_requests_total", "counter",
+    "Requests by their outcome.", PAGE_LABELS + ("status", ))
+SERVER_STATE = Metric(
+    "motdplayer_server_state", "gauge",
+    "Processes that see the game server in the state (healthy, degraded, "
+    "open).", ("server_id", "state"))
+SERVER_STATE_CHANGES_TOTAL = Metric(
+    "motdplayer_server_state_changes_total", "counter",
+    "Times a process saw the game server enter the state.",
+    ("server_id", "state"))
+
+metrics = {metric.name: metric for metric in (
+    PHASE_SECONDS, REQUEST_SECONDS, REQUESTS_TOTAL, SERVER_STATE,
+    SERVER_STATE_CHANGES_TOTAL)}
+
+
+class MetricsFile:
+    """Values of a single process.
+
+    Layout: used size (4 bytes, padded to 8), then entries of a key length
+    (4 bytes), a JSON key (padded to 8 bytes) and a double. The used size
+    is updated after the entry is complete, so readers never see a partial
+    entry.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'w+b')
+        self._size = METRICS_FILE_INITIAL_SIZE
+        self._file.truncate(self._size)
+        self._mmap = mmap.mmap(self._file.fileno(), self._size)
+
+        self._used = 8
+        HEADER_STRUCT.pack_into(self._mmap, 0, self._used)
+
+        self._offsets = {}
+
+    def _allocate(self, key):
+        key_encoded = json.dumps(key).encode('utf-8')
+        key_size = KEY_LENGTH_STRUCT.size + len(key_encoded)
+        key_size += -key_size % 8
+        entry_size = key_size + VALUE_STRUCT.size
+
+        if self._used + entry_size > self._size:
+            while self._used + entry_size > self._size:
+                self._size *= 2
+
+            self._mmap.close()
+            self._file.truncate(self._size)
+            self._mmap = mmap.mmap(self._file.fileno(), self._size)
+
+        offset = self._used
+        KEY_LENGTH_STRUCT.pack_into(self._mmap, offset, len(key_encoded))
+        self._mmap[offset + KEY_LENGTH_STRUCT.size:
+                   offset + KEY_LENGTH_STRUCT.size + len(key_encoded)] = (
+            key_encoded)
+        VALUE_STRUCT.pack_into(self._mmap, offset + key_size, 0.0)
+
+        self._used += entry_size
+        HEADER_STRUCT.pack_into(self._mmap, 0, self._used)
+
+        value_offset = self._offsets[key] = offset + key_size
+        return value_offset
+
+    def add(self, key, amount):
+        offset = self._offsets.get(key)
+        if offset is None:
+            offset = self._allocate(key)
+
+        value, = VALUE_STRUCT.unpack_from(self._mmap, offset)
+        VALUE_STRUCT.pack_into(self._mmap, offset, value + amount)
+
+    @staticmethod
+    def read(path):
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        used, = HEADER_STRUCT.unpack_from(data, 0)
+        offset = 8
+        while offset < used:
+            key_length, = KEY_LENGTH_STRUCT.unpack_from(data, offset)
+            key_start = offset + KEY_LENGTH_STRUCT.size
+            key = json.loads(data[key_start:key_start + key_length].decode(
+                'utf-8'))
+
+            key_size = KEY_LENGTH_STRUCT.size + key_length
+            key_size += -key_size % 8
+            value, = VALUE_STRUCT.unpack_from(data, offset + key_size)
+
+            yield key, value
+            offset += key_size + VALUE_STRUCT.size
+
+
+class MetricsStore:
+    def __init__(self, directory):
+        self.directory = directory
+
+        self._pid = None
+        self._file = None
+        self._lock = Lock()
+
+    def _get_file(self):
+        # Workers are forked after init(), each gets a file of its own
+        pid = os.getpid()
+        if pid != self._pid:
+            self._pid = pid
+            self._file = MetricsFile(os.path.join(
+                self.directory, str(pid) + METRICS_FILE_EXTENSION))
+
+        return self._file
+
+    def inc(self, metric, labels, amount=1):
+        with self._lock:
+            self._get_file().add((metric.name, labels, ""), amount)
+
+    def observe(self, metric, labels, value):
+        bucket_name = BUCKET_NAMES[bisect_left(BUCKETS, value)]
+
+        with self._lock:
+            metrics_file = self._get_file()
+            metrics_file.add((metric.name, labels, bucket_name), 1)
+            metrics_file.add((metric.name, labels, "sum"), value)
+            metrics_file.add((metric.name, labels, "count"), 1)
+
+    def get_paths(self):
+        return [os.path.join(self.directory, name)
+                for name in os.listdir(self.directory)
+                if name.endswith(METRICS_FILE_EXTENSION)]
+
+    def get_dead_paths(self):
+        paths = []
+        for path in self.get_paths():
+            pid = int(os.path.basename(path)[:-len(METRICS_FILE_EXTENSION)])
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                paths.append(path)
+            except PermissionError:
+                pass
+
+        return paths
+
+    @contextmanager
+    def _archive_lock(self):
+        if fcntl is None:
+            yield
+            return
+
+        with open(os.path.join(
+                self.directory, ARCHIVE_LOCK_FILE_NAME), 'a') as lock_file:
+
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def read_archive(self):
+        try:
+            with open(os.path.join(self.directory, ARCHIVE_FILE_NAME)) as f:
+                return {(name, tuple(labels), suffix): value
+                        for name, labels, suffix, value in json.load(f)}
+        except FileNotFoundError:
+            return {}
+
+    def remove_dead_files(self):
+        """Forget values of processes that are not running anymore.
+
+        Their counters and histograms are moved to the archive, so that
+        the sums never go down. Their gauges are dropped.
+        """
+        dead_paths = self.get_dead_paths()
+        if not dead_paths:
+            return
+
+        with self._archive_lock():
+            archive = self.read_archive()
+
+            for path in dead_paths:
+                # Might have been archived by another worker
+                try:
+                    entries = list(MetricsFile.read(path))
+                except FileNotFoundError:
+                    continue
+
+                for (name, labels, suffix), value in entries:
+                    metric = metrics.get(name)
+                    if metric is None or metric.type == "gauge":
+                        continue
+
+                    key = (name, tuple(labels), suffix)
+                    archive[key] = archive.get(key, 0) + value
+
+            archive_path = os.path.join(self.directory, ARCHIVE_FILE_NAME)
+            with open(archive_path + ".tmp", 'w') as f:
+                json.dump([[name, labels, suffix, value] for
+                           (name, labels, suffix), value in archive.items()],
+                          f)
+
+            os.replace(archive_path + ".tmp", archive_path)
+
+            for path in dead_paths:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def collect(self):
+        values = self.read_archive()
+        for path in self.get_paths():
+            try:
+                for (name, labels, suffix), value in MetricsFile.read(path):
+                    key = (name, tuple(labels), suffix)
+                    values[key] = values.get(key, 0) + value
+            except FileNotFoundError:
+                continue
+
+        return values
+
+
+def format_labels(label_names, labels, extra=()):
+    return ",".join('{}="{}"'.format(name, str(value).replace(
+        '\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in tuple(zip(label_names, labels)) + extra)
+
+
+def render(values):
+    lines = []
+    for metric in metrics.values():
+        lines.append("# HELP {} {}".format(metric.name, metric.description))
+        lines.append("# TYPE {} {}".format(metric.name, metric.type))
+
+        # Gauges are summed up over the processes, too
+        if metric.type in ("counter", "gauge"):
+            for (name, labels, suffix), value in sorted(values.items()):
+                if name == metric.name:
+                    lines.append("{}{{{}}} {!r}".format(
+                        name, format_labels(metric.label_names, labels),
+                        value))
+            continue
+
+        label_sets = sorted({labels for name, labels, suffix in values
+                             if name == metric.name})
+
+        for labels in label_sets:
+            cumulative = 0
+            for bucket_name in BUCKET_NAMES:
+                cumulative += values.get((metric.name, labels, bucket_name), 0)
+                lines.append("{}_bucket{{{}}} {!r}".format(
+                    metric.name, format_labels(
+                        metric.label_names, labels, (("le", bucket_name), )),
+                    cumulative))
+
+            for suffix in ("sum", "count"):
+                lines.append("{}_{}{{{}}} {!r}".format(
+                    metric.name, suffix,
+                    format_labels(metric.label_names, labels),
+                    values.get((metric.name, labels, suffix), 0)))
+
+    return "\n".join(lines) + "\n"
+
+
+store = None
+
+
+class RequestTimer:
+    """Times consecutive phases of a single request.
+
+    Labels only get the server/plugin/page IDs once they're known to be
+    valid, so that random URLs can't create new series.
+    """
+    def __init__(self, request_type):
+        self.labels = ("", "", "", request_type)
+        self._started_at = self._marked_at = perf_counter()
+        self._finished = False
+
+    def set_page(self, server_id, plugin_id, page_id):
+        self.labels = (server_id, plugin_id, page_id, self.labels[3])
+
+    def mark(self, phase):
+        if store is None or self._finished:
+            return
+
+        now = perf_counter()
+        store.observe(PHASE_SECONDS, self.labels + (phase, ),
+                      now - self._marked_at)
+        self._marked_at = now
+
+    def finish(self, error_id=None):
+        """
+        :param error_id: error the request has ended with, if any
+        """
+        if store is None or self._finished:
+            return
+
+        self._finished = True
+        store.observe(REQUEST_SECONDS, self.labels,
+                      perf_counter() - self._started_at)
+        store.inc(REQUESTS_TOTAL, self.labels + (get_status(error_id), ))
+
+
+def get_status(error_id):
+    if error_id is None:
+        return "OK"
+
+    for prefix, status in ERROR_STATUSES.items():
+        if error_id.startswith(prefix):
+            return status
+
+    return "ERROR"
+
+
+def set_server_state(server_id, old_state, new_state):
+    """Move this process from one state of the server to another.
+
+    :param old_state: None if the server hasn't been seen before
+    """
+    if store is None:
+        return
+
+    if old_state is not None:
+        store.inc(SERVER_STATE, (server_id, old_state), -1)
+
+    store.inc(SERVER_STATE, (server_id, new_state))
+    store.inc(SERVER_STATE_CHANGES_TOTAL, (server_id, new_state))
+
+
+def init(app):
+    global store
+
+    if not METRICS_ENABLED:
+        return
+
+    os.makedirs(METRICS_DIRECTORY, exist_ok=True)
+    store = MetricsStore(METRICS_DIRECTORY)
+    store.remove_dead_files()
+
+    @app.route(METRICS_ROUTE)
+    def route_metrics():
+        if request.remote_addr not in METRICS_ALLOWED_ADDRESSES:
+            abort(404)
+
+        if METRICS_TOKEN and not compare_digest(
+                request.headers.get('Authorization', "").encode('utf-8'),
+                "Bearer {}".format(METRICS_TOKEN).encode('utf-8')):
+
+            abort(404)
+
+        # Workers that uWSGI has respawned would still report their gauges
+        store.remove_dead_files()
+
+        return Response(
+            render(store.collect()),
+            mimetype="text/plain; version=0.0.4")
@@ -0,0 +1,110 @@
+from contextlib import contextmanager
+import os.path
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from sqlalchemy import Column, Integer, inspect, MetaData, Table, text
+
+from . import MOTDPLAYER_DATA_PATH
+
+
+SCHEMA_VERSION_TABLE = "motdplayer_schema_version"
+UPGRADE_LOCK_FILE = "migrations.lock"
+
+
+def create_users_table(connection, user_model):
+    if not connection.dialect.has_table(connection, user_model.__tablename__):
+        user_model.__table__.create(connection)
+
+
+def add_users_unique_index(connection, user_model):
+    table = user_model.__tablename__
+
+    # Older versions could insert the same user twice. Keep the row that
+    # .first() used to return, as that's the one whose salt is in use.
+    connection.execute(text(
+        "DELETE FROM {table} WHERE id NOT IN ("
+        "SELECT id FROM (SELECT MIN(id) AS id FROM {table} "
+        "GROUP BY server_id, steamid) AS keep)".format(table=table)))
+
+    index_names = {
+        index['name'] for index in inspect(connection).get_indexes(table)}
+
+    for index in user_model.__table__.indexes:
+        if index.name not in index_names:
+            index.create(connection)
+
+
+# Never reorder or remove steps: their positions are schema versions
+STEPS = (
+    create_users_table,
+    add_users_unique_index,
+)
+
+
+def get_version_table():
+    return Table(
+        SCHEMA_VERSION_TABLE, MetaData(),
+        Column('version', Integer, nullable=False),
+    )
+
+
+def get_schema_version(connection, version_table):
+    if not connection.dialect.has_table(connection, version_table.name):
+        return None
+
+    return connection.execute(version_table.select()).scalar()
+
+
+@contextmanager
+def upgrade_lock():
+    """Make the workers that start at the same time upgrade one by one.
+
+    The schema version is read under the lock, so whoever comes second
+    finds the schema up to date.
+    """
+    if fcntl is None:
+        yield
+        return
+
+    with open(os.path.join(MOTDPLAYER_DATA_PATH, UPGRADE_LOCK_FILE),
+              'a') as lock_file:
+
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def upgrade(db):
+    with upgrade_lock():
+        _upgrade(db)
+
+
+def _upgrade(db):
+    from . import User
+
+    version_table = get_version_table()
+
+    with db.engine.begin() as connection:
+        version = get_schema_version(connection, version_table)
+
+        if version is None:
+            version_table.create(connection)
+            connection.execute(version_table.insert().values(version=0))
+            version = 0
+
+        for step_version, step in enumerate(STEPS, start=1):
+            if step_version <= version:
+                continue
+
+            step(connection, User)
+            connection.execute(
+                version_table.update().values(version=step_version))
+
+    # Tables of MoTD applications are not versioned by MOTDPlayer
+    db.create_all()
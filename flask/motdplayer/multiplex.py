@@ -0,0 +1,166 @@
+from collections import deque
+from threading import Condition, Lock
+
+from ccp.sock_client import ConnectionAbort
+from ccp.transmit import CommunicationEnded
+
+from . import config
+from .clients import CONNECT_TIMEOUT, MOTDProtocolMixin, open_client
+from .wire import DECODE_ERRORS
+
+
+MULTIPLEX_ENABLED = config.getboolean('multiplex', 'enabled', fallback=False)
+RECEIVE_ERRORS = (OSError, ConnectionAbort, CommunicationEnded) + DECODE_ERRORS
+
+
+class MultiplexError(OSError):
+    pass
+
+
+class MOTDStream(MOTDProtocolMixin):
+    """One request's worth of conversation over a shared connection.
+
+    Provides the same interface as MOTDClient, so views don't need to know
+    whether they talk to SRCDS over a dedicated or a shared socket.
+    """
+    def __init__(self, connection, stream_id):
+        self.connection = connection
+        self.id = stream_id
+
+    def send_json_data(self, **kwargs):
+        self.connection.send_message(self.id, kwargs)
+
+    def receive_json_data(self):
+        return self.connection.receive_message(self.id)
+
+    def release(self):
+        # Chunks of an abandoned answer are dropped along with the inbox
+        self.connection.close_stream(self.id, notify=self.reusable)
+
+
+class MultiplexedConnection:
+    """Long-lived CCP connection that carries many MOTDStream's at once.
+
+    Every frame is tagged with a stream ID, so responses may arrive in any
+    order. Whichever thread waits for a response reads the socket on behalf
+    of everybody else and puts foreign frames into their owners' inboxes.
+    """
+    def __init__(self, client_class, server_id, addr,
+                 connect_timeout=CONNECT_TIMEOUT):
+
+        self.client = open_client(
+            client_class, server_id, addr, connect_timeout,
+            features=["multiplex", ])
+
+        if "multiplex" not in self.client.features:
+            self.client.stop()
+            raise MultiplexError("SRCDS refused to multiplex this connection")
+
+        self.broken = False
+
+        self._send_lock = Lock()
+        self._condition = Condition()
+        self._reading = False
+        self._inboxes = {}
+        self._next_stream_id = 1
+
+    @property
+    def streams_count(self):
+        return len(self._inboxes)
+
+    def open_stream(self):
+        with self._condition:
+            if self.broken:
+                raise MultiplexError("Connection is broken")
+
+            stream_id = self._next_stream_id
+            self._next_stream_id += 1
+            self._inboxes[stream_id] = deque()
+
+        return MOTDStream(self, stream_id)
+
+    def close_stream(self, stream_id, notify=True):
+        with self._condition:
+            if self._inboxes.pop(stream_id, None) is None or self.broken:
+                return
+
+        # If SRCDS rejected anything on this stream, it has already
+        # closed the stream on its end
+        if notify:
+            self.send_message(stream_id, {'action': "close-stream"})
+
+    def send_message(self, stream_id, message):
+        message['stream_id'] = stream_id
+        data = self.client.codec.encode(message)
+
+        with self._send_lock:
+            try:
+                self.client.send_data(data)
+            except (OSError, ConnectionAbort, CommunicationEnded) as e:
+                self._break()
+                raise MultiplexError("Failed to send data") from e
+
+    def receive_message(self, stream_id):
+        while True:
+            with self._condition:
+                while True:
+                    try:
+                        inbox = self._inboxes[stream_id]
+                    except KeyError:
+                        raise MultiplexError("Stream is closed")
+
+                    if inbox:
+                        return inbox.popleft()
+
+                    if self.broken:
+                        raise MultiplexError("Connection is broken")
+
+                    if not self._reading:
+                        break
+
+                    self._condition.wait()
+
+                self._reading = True
+
+            try:
+                message = self.client.codec.decode(self.client.receive_data())
+
+            except RECEIVE_ERRORS as e:
+
+                self._break()
+                raise MultiplexError("Failed to receive data") from e
+
+            with self._condition:
+                self._reading = False
+
+                inbox = self._inboxes.get(message.get('stream_id'))
+                if inbox is not None:
+                    inbox.append(message)
+
+                self._condition.notify_all()
+
+    def _break(self):
+        with self._condition:
+            self.broken = True
+            self._reading = False
+            self._condition.notify_all()
+
+        try:
+            self.client.stop()
+        except (OSError, ConnectionAbort, CommunicationEnded):
+            pass
+
+
+connections = {}
+_connections_lock = Lock()
+
+
+def open_stream(client_class, server_id, addr):
+    with _connections_lock:
+        connection = connections.get(server_id)
+
+        if connection is None or connection.broken:
+            connection = connections[server_id] = MultiplexedConnection(
+                client_class, server_id, addr)
+
+    return connection.open_stream()
@@ -0,0 +1,256 @@
+from collections import deque
+from threading import Lock
+from time import monotonic
+
+from ccp.sock_client import ConnectionAbort
+from ccp.transmit import CommunicationEnded
+
+from . import config
+from .clients import CONNECT_TIMEOUT, open_client
+from .multiplex import MULTIPLEX_ENABLED, open_stream
+from .wire import DECODE_ERRORS
+
+
+POOL_ENABLED = config.getboolean('pool', 'enabled', fallback=False)
+POOL_MIN_SIZE = config.getint('pool', 'min_size', fallback=0)
+POOL_MAX_SIZE = config.getint('pool', 'max_size', fallback=8)
+POOL_IDLE_TIMEOUT = config.getfloat('pool', 'idle_timeout', fallback=60.0)
+POOL_HEALTH_CHECK_INTERVAL = config.getfloat(
+    'pool', 'health_check_interval', fallback=10.0)
+POOL_MAINTENANCE_INTERVAL = config.getfloat(
+    'pool', 'maintenance_interval', fallback=5.0)
+CHECK_ERRORS = (
+    OSError, KeyError, ConnectionAbort, CommunicationEnded) + DECODE_ERRORS
+FIRST_EXCHANGE_ERRORS = (OSError, CommunicationEnded)
+
+
+class ConnectionLost(Exception):
+    """Connection to SRCDS broke during the first exchange."""
+
+
+def exchange_first(client, first_exchange):
+    try:
+        return first_exchange(client)
+    except FIRST_EXCHANGE_ERRORS as e:
+        client.reusable = False
+        client.release()
+        raise ConnectionLost() from e
+
+
+class ClientPool:
+    """Warm, already authenticated CCP connections to a single SRCDS.
+
+    Clients are checked out for a single INIT/AJAX/switch request and
+    checked back in with MOTDClient.release(). Checked in clients are reset
+    (SRCDS forgets the identity that was set on them) and kept idle until
+    they're needed again or evicted. The answer to the reset is only read
+    on the next checkout, so checking in doesn't wait for SRCDS.
+    """
+    def __init__(self, client_class, server_id, addr, min_size=POOL_MIN_SIZE,
+                 max_size=POOL_MAX_SIZE, idle_timeout=POOL_IDLE_TIMEOUT,
+                 health_check_interval=POOL_HEALTH_CHECK_INTERVAL,
+                 maintenance_interval=POOL_MAINTENANCE_INTERVAL,
+                 connect_timeout=CONNECT_TIMEOUT):
+
+        self.client_class = client_class
+        self.server_id = server_id
+        self.addr = addr
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self.maintenance_interval = maintenance_interval
+        self.connect_timeout = connect_timeout
+
+        self._lock = Lock()
+        self._idle = deque()  # (client, released_at), most recent on the right
+        self._size = 0  # Idle clients + clients that are checked out
+        self._last_maintenance = monotonic()
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def idle_count(self):
+        return len(self._idle)
+
+    def _open_client(self):
+        return open_client(self.client_class, self.server_id, self.addr,
+                           self.connect_timeout)
+
+    def _connect(self):
+        client = self._open_client()
+        client.pool = self
+        return client
+
+    def _discard(self, client):
+        with self._lock:
+            self._size -= 1
+
+        client.pool = None
+        try:
+            client.stop()
+        except (OSError, ConnectionAbort, CommunicationEnded):
+            pass
+
+    def _check(self, client):
+        try:
+            return client.reset()
+        except CHECK_ERRORS:
+            return False
+
+    def _send_reset(self, client):
+        try:
+            client.send_reset()
+        except CHECK_ERRORS:
+            return False
+
+        return True
+
+    def _confirm_reset(self, client):
+        try:
+            return client.confirm_reset()
+        except CHECK_ERRORS:
+            return False
+
+    def _checkout(self, reuse=True):
+        """
+        :param reuse: False to skip idle clients
+        :return: client, whether it was idle
+        """
+        while True:
+            with self._lock:
+                if reuse and self._idle:
+                    client, released_at = self._idle.pop()
+                elif self._size < self.max_size:
+                    self._size += 1
+                    break
+                else:
+                    # Pool is exhausted, fall back to a one-off connection
+                    return self._open_client(), False
+
+            if self._confirm_reset(client) and (
+                    monotonic() - released_at < self.health_check_interval or
+                    self._check(client)):
+
+                return client, True
+
+            self._discard(client)
+
+        try:
+            return self._connect(), False
+        except Exception:
+            with self._lock:
+                self._size -= 1
+            raise
+
+    def checkout(self, first_exchange):
+        """Check a client out and make the first exchange on it.
+
+        An idle client may have gone stale since it was checked in (e.g.
+        SRCDS has been restarted), so if the first exchange on it fails,
+        it's made once more on a new connection.
+
+        :param first_exchange: function that takes the client and returns
+            the result of the exchange
+        :return: client, result of first_exchange
+        :raise ConnectionLost: if the first exchange fails on a new
+            connection
+        """
+        client, idle = self._checkout()
+        if idle:
+            try:
+                return client, first_exchange(client)
+            except FIRST_EXCHANGE_ERRORS:
+                client.reusable = False
+                client.release()
+
+            client, idle = self._checkout(reuse=False)
+
+        return client, exchange_first(client, first_exchange)
+
+    def checkin(self, client):
+        if not client.reusable or not self._send_reset(client):
+            self._discard(client)
+        else:
+            with self._lock:
+                self._idle.append((client, monotonic()))
+
+        if monotonic() - self._last_maintenance >= self.maintenance_interval:
+            self.maintain()
+
+    def maintain(self):
+        self._last_maintenance = now = monotonic()
+
+        # Evict clients that have been idle for too long, oldest first
+        expired = []
+        with self._lock:
+            while (self._idle and self._size - len(expired) > self.min_size
+                   and now - self._idle[0][1] >= self.idle_timeout):
+
+                expired.append(self._idle.popleft()[0])
+
+        for client in expired:
+            self._discard(client)
+
+        # Keep at least min_size warm clients around
+        while True:
+            with self._lock:
+                if self._size >= self.min_size:
+                    break
+                self._size += 1
+
+            try:
+                client = self._connect()
+            except (OSError, ConnectionAbort, CommunicationEnded):
+                with self._lock:
+                    self._size -= 1
+                break
+
+            with self._lock:
+                self._idle.append((client, monotonic()))
+
+    def close(self):
+        with self._lock:
+            clients = [client for client, released_at in self._idle]
+            self._idle.clear()
+
+        for client in clients:
+            self._discard(client)
+
+
+pools = {}
+_pools_lock = Lock()
+
+
+def get_pool(client_class, server_id, addr):
+    with _pools_lock:
+        try:
+            return pools[server_id]
+        except KeyError:
+            pool = pools[server_id] = ClientPool(
+                client_class, server_id, addr)
+            return pool
+
+
+def connect(client_class, server_id, server, first_exchange, pooled=True):
+    """Get a client for the server and make the first exchange on it.
+
+    :param first_exchange: function that takes the client and returns
+        the result of the exchange
+    :return: client, result of first_exchange
+    :raise ConnectionLost: if the connection breaks during the first
+        exchange
+    """
+    addr = (server['host'], server['port'])
+
+    if pooled and MULTIPLEX_ENABLED:
+        client = open_stream(client_class, server_id, addr)
+    elif not (pooled and POOL_ENABLED):
+        client = open_client(client_class, server_id, addr)
+    else:
+        return get_pool(client_class, server_id, addr).checkout(
+            first_exchange)
+
+    return client, exchange_first(client, first_exchange)
@@ -0,0 +1,273 @@
+"""Opt-in profiler for WebRequestProcessor callbacks.
+
+Profiled callbacks are timed along with the number of SRCDS round trips
+they make through ex_data_func. Calls over the threshold are logged, and
+the slowest calls of every worker are dumped to the profiles directory:
+    sample mode     stacks sampled every sample_interval seconds, in the
+                    collapsed format that flamegraph.pl and speedscope read
+    cprofile mode   cProfile stats (pstats/snakeviz/gprof2dot), at a much
+                    higher overhead
+"""
+import cProfile
+from collections import Counter
+import heapq
+import os
+import os.path
+import sys
+from threading import Event, get_ident, Lock, Thread
+from time import perf_counter, sleep
+
+from . import config, MOTDPLAYER_DATA_PATH
+
+
+PROFILER_ENABLED = config.getboolean('profiler', 'enabled', fallback=False)
+PROFILER_MODE = config.get('profiler', 'mode', fallback="sample")
+PROFILER_THRESHOLD = config.getfloat('profiler', 'threshold', fallback=0.1)
+PROFILER_SLOWEST = config.getint('profiler', 'slowest', fallback=10)
+PROFILER_SAMPLE_INTERVAL = config.getfloat(
+    'profiler', 'sample_interval', fallback=0.005)
+PROFILER_DIRECTORY = os.path.join(MOTDPLAYER_DATA_PATH, config.get(
+    'profiler', 'directory', fallback="profiles"))
+
+
+class CallbackCall:
+    def __init__(self, name, code):
+        self.name = name
+        self.code = code
+        self.duration = None
+        self.round_trips = 0
+        self.stacks = Counter()
+        self.profile = None
+
+    def add_sample(self, frame):
+        # Only keep the frames of the callback itself
+        stack = []
+        while frame is not None and frame.f_code is not self.code:
+            stack.append("{}:{}".format(
+                frame.f_globals.get('__name__', "?"), frame.f_code.co_name))
+            frame = frame.f_back
+
+        stack.append(self.name)
+        self.stacks[";".join(reversed(stack))] += 1
+
+    def dump(self, path):
+        if self.profile is not None:
+            self.profile.dump_stats(path + ".prof")
+            return
+
+        with open(path + ".folded", 'w') as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write("{} {}\n".format(stack, count))
+
+
+class StackSampler:
+    """Samples the stacks of threads that are running a callback."""
+    def __init__(self, interval):
+        self.interval = interval
+
+        self._calls = {}
+        self._lock = Lock()
+        self._thread = None
+
+    def _run(self):
+        while True:
+            sleep(self.interval)
+
+            with self._lock:
+                if not self._calls:
+                    continue
+
+                frames = sys._current_frames()
+                for thread_id, call in self._calls.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        call.add_sample(frame)
+
+    def start(self, thread_id, call):
+        with self._lock:
+            self._calls[thread_id] = call
+
+            if self._thread is None:
+                self._thread = Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def stop(self, thread_id):
+        with self._lock:
+            self._calls.pop(thread_id, None)
+
+
+class CallbackProfiler:
+    def __init__(self, mode=PROFILER_MODE, threshold=PROFILER_THRESHOLD,
+                 slowest=PROFILER_SLOWEST,
+                 sample_interval=PROFILER_SAMPLE_INTERVAL,
+                 directory=PROFILER_DIRECTORY):
+
+        if mode not in ("sample", "cprofile"):
+            raise ValueError("Unknown profiler mode: {}".format(mode))
+
+        self.mode = mode
+        self.threshold = threshold
+        self.slowest = slowest
+        self.directory = directory
+
+        self._sampler = StackSampler(sample_interval)
+        self._slowest_calls = []  # Heap of (duration, call counter, call)
+        self._calls_made = 0
+        self._totals = {}  # name -> [calls, duration, round trips, max]
+        self._lock = Lock()
+
+        # Dumps are written by a thread of their own, off the request path
+        self._dump_needed = Event()
+        self._dump_thread = None
+
+    def wrap(self, wrp, kind, callback):
+        """Return a profiled version of the callback."""
+        name = "{}/{}:{}".format(wrp.plugin_id, wrp.page_id, kind)
+
+        def profiled_callback(*args):
+            profiled_call = CallbackCall(name, self.run.__code__)
+
+            # ws_callback and fragments don't talk to SRCDS
+            if kind in ("regular", "ajax"):
+                ex_data_func = args[0]
+
+                def counting_ex_data_func(data):
+                    profiled_call.round_trips += 1
+                    return ex_data_func(data)
+
+                args = (counting_ex_data_func, ) + args[1:]
+
+            return self.run(profiled_call, callback, args)
+
+        return profiled_callback
+
+    def run(self, profiled_call, callback, args):
+        thread_id = get_ident()
+
+        if self.mode == "cprofile":
+            profiled_call.profile = cProfile.Profile()
+            try:
+                profiled_call.profile.enable()
+            except ValueError:
+
+                # Another thread is being profiled (Python 3.12+)
+                profiled_call.profile = None
+        else:
+            self._sampler.start(thread_id, profiled_call)
+
+        started_at = perf_counter()
+        try:
+            return callback(*args)
+        finally:
+            profiled_call.duration = perf_counter() - started_at
+
+            if profiled_call.profile is not None:
+                profiled_call.profile.disable()
+            elif self.mode == "sample":
+                self._sampler.stop(thread_id)
+
+            self.record(profiled_call)
+
+    def record(self, call):
+        if call.duration >= self.threshold:
+            print("MOTDPlayer: slow callback {}: {:.1f} ms, {} SRCDS round "
+                  "trip(s)".format(call.name, call.duration * 1000,
+                                   call.round_trips), file=sys.stderr)
+
+        with self._lock:
+            totals = self._totals.setdefault(call.name, [0, 0.0, 0, 0.0])
+            totals[0] += 1
+            totals[1] += call.duration
+            totals[2] += call.round_trips
+            totals[3] = max(totals[3], call.duration)
+
+            self._calls_made += 1
+            entry = (call.duration, self._calls_made, call)
+
+            if len(self._slowest_calls) < self.slowest:
+                heapq.heappush(self._slowest_calls, entry)
+            elif call.duration > self._slowest_calls[0][0]:
+                heapq.heapreplace(self._slowest_calls, entry)
+            else:
+                return
+
+            # Only rewritten when the slowest calls change, which gets
+            # rare once the worker has warmed up
+            if self._dump_thread is None:
+                self._dump_thread = Thread(target=self._run_dumps, daemon=True)
+                self._dump_thread.start()
+
+        self._dump_needed.set()
+
+    def _run_dumps(self):
+        while True:
+            self._dump_needed.wait()
+            self._dump_needed.clear()
+
+            try:
+                self.dump()
+            except OSError as e:
+                print("MOTDPlayer: couldn't dump profiles: {}".format(e),
+                      file=sys.stderr)
+
+    def dump(self):
+        # Calls that have been recorded are never changed again, so the
+        # copies can be written without holding the lock
+        with self._lock:
+            totals = {name: list(values)
+                      for name, values in self._totals.items()}
+            slowest_calls = sorted(self._slowest_calls, reverse=True)
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        prefix = "{}-".format(os.getpid())
+        for name in os.listdir(self.directory):
+            if name.startswith(prefix):
+                os.remove(os.path.join(self.directory, name))
+
+        with open(os.path.join(
+                self.directory, prefix + "summary.txt"), 'w') as f:
+
+            f.write("{:<48}{:>8}{:>12}{:>12}{:>14}\n".format(
+                "callback", "calls", "avg, ms", "max, ms", "round trips"))
+
+            for name, (calls, duration, round_trips, max_duration) in sorted(
+                    totals.items()):
+
+                f.write("{:<48}{:>8}{:>12.2f}{:>12.2f}{:>14.2f}\n".format(
+                    name, calls, duration / calls * 1000,
+                    max_duration * 1000, round_trips / calls))
+
+            f.write("\nSlowest calls:\n")
+            for rank, (duration, i, call) in enumerate(
+                    slowest_calls, start=1):
+
+                f.write("{:>3}. {:<48}{:>10.2f} ms{:>6} round trip(s)\n"
+                        .format(rank, call.name, duration * 1000,
+                                call.round_trips))
+
+                call.dump(os.path.join(self.directory, "{}{:02}-{}".format(
+                    prefix, rank, call.name.replace('/', '-').replace(
+                        ':', '-'))))
+
+
+profiler = None
+
+
+def get_profiler(profile=None):
+    """Return the profiler if profiling is on, None otherwise.
+
+    :param profile: True/False to override [profiler] enabled
+    """
+    global profiler
+
+    if profile is None:
+        profile = PROFILER_ENABLED
+
+    if not profile:
+        return None
+
+    if profiler is None:
+        profiler = CallbackProfiler()
+
+    return profiler
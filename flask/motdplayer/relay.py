@@ -0,0 +1,109 @@
+"""Message relaying between MoTD WebSockets and SRCDS.
+
+Shared by the uWSGI WebSocket route and the asyncio gateway, so that both
+transports filter and forward data exactly the same way.
+"""
+import json
+from json.decoder import JSONDecodeError
+
+from .wire import DECODE_ERRORS, ENCODE_ERRORS
+
+
+class RelayError(Exception):
+    """Transmission must end.
+
+    If error_id is not None, the browser should be notified with
+    an ERROR_VIEW message carrying it.
+    """
+    def __init__(self, error_id=None):
+        super().__init__(error_id)
+        self.error_id = error_id
+
+
+def encode_ws_message(**kwargs):
+    return json.dumps(kwargs).encode('utf-8')
+
+
+def relay_to_srcds(wrp, client, data_encoded):
+    """Filter a browser message and encode it for SRCDS.
+
+    :return: encoded data to send to SRCDS or None if the message should
+        be ignored
+    :raise RelayError: if the transmission must end
+    """
+    try:
+        data = json.loads(data_encoded.decode('utf-8'))
+    except (JSONDecodeError, UnicodeDecodeError) as e:
+        raise RelayError() from e
+
+    try:
+        action = data['action']
+        custom_data = data['custom_data']
+    except (KeyError, TypeError):
+        return None
+
+    if action != "custom-data":
+        return None
+
+    # WebSocket -> SRCDS: data goes through wrp callback
+    if wrp.ws_callback is None:
+        raise RelayError("WRP No WS Callback.")
+
+    try:
+        filtered_data = wrp.ws_callback(custom_data)
+    except Exception as e:
+        raise RelayError("WRP WS Callback Raised.") from e
+
+    if filtered_data is None:
+        raise RelayError("WRP WS Callback Refused Data.")
+
+    try:
+        return client.codec.encode({
+            'action': "custom-data",
+            'custom_data': filtered_data,
+        })
+    except ENCODE_ERRORS as e:
+        raise RelayError("WRP WS Callback Invalid Answer.") from e
+
+
+def relay_to_ws(client, data_encoded):
+    """Decode an SRCDS message and turn it into browser messages.
+
+    :return: list of dictionaries to send to the browser
+    :raise RelayError: if the transmission must end
+    """
+    try:
+        data = client.codec.decode(data_encoded)
+    except DECODE_ERRORS as e:
+        raise RelayError("SRCDS Sends Invalid Data") from e
+
+    if not isinstance(data, dict):
+        raise RelayError("SRCDS Sends Invalid Data")
+
+    # SRCDS sends a non-OK status right before ending the transmission
+    if data.get('status') != "OK":
+        raise RelayError("Transmission Ended ({}).".format(data.get('status')))
+
+    # SRCDS -> WebSocket: send directly without interfering
+    if 'batch' in data:
+        return [{
+            'status': "CUSTOM_DATA_BATCH",
+            'batch': data['batch'],
+        }, ]
+
+    if 'delta' in data:
+        return [{
+            'status': "CUSTOM_DATA",
+            'delta': data['delta'],
+        }, ]
+
+    return [{
+        'status': "CUSTOM_DATA",
+        'custom_data': data['custom_data'],
+    }, ]
+
+
+def count_ws_messages(messages):
+    """Number of SRCDS messages the browser messages carry."""
+    return sum(len(message['batch']) if 'batch' in message else 1
+               for message in messages)
@@ -1,10 +1,9 @@
 from base64 import b64encode
 import json
-from json.decoder import JSONDecodeError
 import sys
 from traceback import format_exc
 
-from flask import jsonify, render_template, request
+from flask import jsonify, make_response, render_template, request, Response
 
 try:
     import uwsgi
@@ -14,12 +13,29 @@ except ImportError:
 from ccp.transmit import CommunicationEnded
 from ccp.sock_client import ConnectionAbort
 
-from . import AuthMethod, config, servers, sockets, User, wrps
-from .clients import MOTDClient
+from . import config, servers, sockets, user_cache
+from .applications import ApplicationLoadError, get_wrp, has_plugin
+from .caching import cache_fragment, cacheable
+from .clients import AnswerStreamError, MOTDClient
+from .database import (
+    get_web_auth_method, SRCDS_AUTH_METHODS, WEB_AUTH_METHODS)
+from .health import get_server_health
+from .metrics import RequestTimer
+from .pool import connect, ConnectionLost
+from .relay import (
+    count_ws_messages, encode_ws_message, RelayError, relay_to_srcds,
+    relay_to_ws)
 
 
 TEMPLATE_CSGO_REDIRECT_PATH = "motdplayer/csgo_redirect.html"
 TEMPLATE_ERROR_PATH = "motdplayer/error.html"
+WS_URL_BASE = config.get('application', 'ws_url_base', fallback="")
+FRAGMENT_ROUTE = config.get(
+    'application', 'fragment_route',
+    fallback="/fragment/<server_id>/<plugin_id>/<page_id>/<fragment_id>/")
+# Switch request 'fetch' -> request type of the new page on SRCDS
+FETCH_REQUEST_TYPES = {None: None, 'ajax': "AJAX", 'render': "INIT"}
+BATCH_MAX_SIZE = config.getint('application', 'max_batch_size', fallback=32)
 EXCEPTION_HEADER = ("{breaker}\nMOTDPlayer has caught "
                     "an exception!\n{breaker}\n".format(breaker="=" * 79))
 
@@ -29,7 +45,10 @@ def print_exc():
     print(format_exc(), file=sys.stderr)
 
 
-def build_error(error_id, request_type):
+def build_error(error_id, request_type, timer=None):
+    if timer is not None:
+        timer.finish(error_id)
+
     if request_type == "WEBSOCKET":
         return {
             'status': "ERROR_VIEW",
@@ -45,81 +64,226 @@ def build_error(error_id, request_type):
     return render_template(TEMPLATE_ERROR_PATH, error=error_id)
 
 
+def get_web_auth(user, auth_method, plugin_id, page_id, session_id):
+    """
+    :return: web_auth_method, web_auth_token for the browser's next request
+    """
+    web_auth_method = get_web_auth_method(auth_method)
+    return web_auth_method, user.get_web_auth_token(
+        plugin_id, page_id, session_id, web_auth_method)
+
+
+def render_page(template_name, context, server_id, plugin_id, page_id,
+                steamid, auth_method, auth_token, session_id,
+                web_auth_method, web_auth_token):
+
+    auth_data = {
+        'serverId': server_id,
+        'pluginId': plugin_id,
+        'pageId': page_id,
+        'steamid': str(steamid),  # JS cannot into big numbers
+        'authMethod': auth_method,
+        'authToken': auth_token,
+        'sessionId': session_id,
+    }
+    next_auth_data = {
+        'serverId': server_id,
+        'pluginId': plugin_id,
+        'pageId': page_id,
+        'steamid': str(steamid),  # JS cannot into big numbers
+        'authMethod': web_auth_method,
+        'authToken': web_auth_token,
+        'sessionId': session_id,
+        'wsUrlBase': WS_URL_BASE,
+        'fragmentRoute': FRAGMENT_ROUTE,
+        'maxBatchSize': BATCH_MAX_SIZE,
+    }
+
+    return render_template(
+        template_name,
+        context=context,
+        auth_data=auth_data,
+        next_auth_data=next_auth_data,
+        base64_init_string=b64encode(
+            json.dumps(next_auth_data).encode('utf-8')
+        ).decode('utf-8'),
+    )
+
+
+def run_ajax_batch(wrp, ex_data_func, batch):
+    """Pass every item of the batch to the AJAX callback in turn.
+
+    An item that fails doesn't stop the rest of the batch.
+
+    :return: list of results, in the order of the batch
+    """
+    results = []
+    for data in batch:
+        try:
+            results.append({
+                'status': "OK",
+                'custom_data': wrp.ajax_callback(ex_data_func, data),
+            })
+        except Exception:
+            print_exc()
+            results.append({
+                'status': "ERROR_VIEW",
+                'error_id': "WRP AJAX Callback Raised.",
+            })
+
+    return results
+
+
+def encode_ndjson_line(**kwargs):
+    return json.dumps(kwargs) + "\n"
+
+
+def stream_answer(wrp, client, data, web_auth_method, web_auth_token, timer):
+    """Yield the chunks of the WRP stream callback as NDJSON lines.
+
+    The first line carries the next auth token, the last one is either END
+    or an error. Only one chunk at a time is held in memory. The client is
+    not released here: the response does it when it's closed.
+    """
+    yield encode_ndjson_line(
+        status="OK", web_auth_method=web_auth_method,
+        web_auth_token=web_auth_token)
+
+    try:
+        for chunk in wrp.stream_callback(
+                client.exchange_custom_data_stream, data):
+
+            yield encode_ndjson_line(status="CHUNK", custom_data=chunk)
+
+    except AnswerStreamError as e:
+        error_id = "SRCDS Stream Failed ({}).".format(e.status)
+    except Exception:
+        print_exc()
+        error_id = "WRP Stream Callback Raised."
+    else:
+        error_id = None
+
+    timer.mark("callback")
+
+    if error_id is not None:
+        timer.finish(error_id)
+        yield encode_ndjson_line(status="ERROR_VIEW", error_id=error_id)
+        return
+
+    timer.finish()
+    yield encode_ndjson_line(status="END")
+
+
 def create_client(client_class, db, server_id, plugin_id, page_id, steamid,
-                  auth_method, auth_token, session_id, request_type):
+                  auth_method, auth_token, session_id, request_type,
+                  push_channel=None, timer=None):
     """
+    :param push_channel: ID of the push channel that will deliver this
+        WebSocket's broadcasts, if any
+    :param timer: RequestTimer of the request, finished on errors
     :return: server, wrp, user, client, error
     """
+    if timer is None:
+        timer = RequestTimer(request_type)
+
     # Check if server/plugin/page combo exists
     try:
         server = servers[server_id]
     except KeyError:
         return None, None, None, None, build_error(
-            "Unknown Server.", request_type)
+            "Unknown Server.", request_type, timer)
 
-    try:
-        plugin_wrps = wrps[plugin_id]
-    except KeyError:
+    if not has_plugin(plugin_id):
         return server, None, None, None, build_error(
-            "Unknown Plugin.", request_type)
+            "Unknown Plugin.", request_type, timer)
 
     try:
-        wrp = plugin_wrps[page_id]
+        wrp = get_wrp(plugin_id, page_id)
     except KeyError:
         return server, None, None, None, build_error(
-            "Unknown Page.", request_type)
+            "Unknown Page.", request_type, timer)
+    except ApplicationLoadError:
+        print_exc()
+        return server, None, None, None, build_error(
+            "Application Failed To Load.", request_type, timer)
+
+    timer.set_page(server_id, plugin_id, page_id)
+    timer.mark("lookup")
 
     # Auth
     steamid = str(steamid)
-    user = User.query.filter(
-        User.steamid == steamid, User.server_id == server_id).first()
-
-    if user is None:
-        user = User(server_id, steamid)
-        db.session.add(user)
+    user = user_cache.get(server_id, steamid)
+    timer.mark("user")
 
     if not user.authenticate(
             auth_method, plugin_id, page_id, auth_token, session_id):
 
-        db.session.rollback()
-        return server, wrp, None, None, build_error(
-            "Invalid Auth.", request_type)
+        # Make sure we didn't reject the token because of a stale record
+        user = user_cache.get(server_id, steamid, reload=True)
+
+        if not user.authenticate(
+                auth_method, plugin_id, page_id, auth_token, session_id):
+
+            return server, wrp, None, None, build_error(
+                "Invalid Auth.", request_type, timer)
+
+    timer.mark("auth")
+
+    # Don't wait for a server that has been failing to connect
+    health = get_server_health(server_id)
+    if health is not None and not health.allow_request():
+        return server, wrp, user, None, build_error(
+            "SRCDS Unavailable.", request_type, timer)
+
+    if auth_method in SRCDS_AUTH_METHODS:
+        new_salt = user.get_new_salt()
+    elif auth_method in WEB_AUTH_METHODS:
+        new_salt = None
+    else:
+        return server, wrp, user, None, build_error(
+            "Unknown Auth Method.", request_type, timer)
+
+    def set_identity(client):
+        timer.mark("connect")
+        return client.set_identity(
+            steamid, new_salt, session_id, request_type, push_channel)
 
-    # Connection to SRCDS
+    # Connection to SRCDS (WebSocket connections are never pooled as they
+    # stay bound to a single session until the transmission ends)
     try:
-        client = client_class((server['host'], server['port']), 'motdplayer')
+        client, error = connect(client_class, server_id, server, set_identity,
+                                pooled=request_type != "WEBSOCKET")
     except ConnectionAbort:
-        
         # May happen if our IP address is not in receiver's CCP whitelist
         return server, wrp, user, None, build_error(
-            "IP Not Whitelisted.", request_type)
+            "IP Not Whitelisted.", request_type, timer)
 
-    if auth_method == AuthMethod.SRCDS:
-        new_salt = user.get_new_salt()
+    except ConnectionLost:
+        if health is not None:
+            health.record_failure()
 
-        error = client.set_identity(
-            steamid, new_salt, session_id, request_type)
-        if error is not None:
-            return (server, wrp, user, client, build_error(
-                        "Identity Rejected ({}).".format(error), request_type))
+        return server, wrp, user, None, build_error(
+            "SRCDS Connection Lost.", request_type, timer)
 
-        user.salt = new_salt
+    except (OSError, CommunicationEnded):
+        return server, wrp, user, None, build_error(
+            "SRCDS Connection Failed.", request_type, timer)
 
-    elif auth_method == AuthMethod.WEB:
-        error = client.set_identity(steamid, None, session_id, request_type)
-        if error is not None:
-            return (server, wrp, user, client, build_error(
-                        "Identity Rejected ({}).".format(error), request_type))
+    if error is not None:
+        return (server, wrp, user, client, build_error(
+                    "Identity Rejected ({}).".format(error), request_type,
+                    timer))
 
-        web_salt = user.get_new_salt()
-        user.web_salt = web_salt
+    timer.mark("set_identity")
 
+    if auth_method in SRCDS_AUTH_METHODS:
+        user.salt = new_salt
     else:
-        client.stop()
-        return server, wrp, user, client, build_error(
-            "Unknown Auth Method.", request_type)
+        web_salt = user.get_new_salt()
+        user.web_salt = web_salt
 
-    db.session.commit()
+    user_cache.save(user)
+    timer.mark("salt_save")
 
     return server, wrp, user, client, None
 
@@ -142,32 +306,159 @@ def init(app, db):
         return render_template(
             TEMPLATE_CSGO_REDIRECT_PATH, redirect_to=redirect_to)
 
+    @app.route(FRAGMENT_ROUTE, endpoint=cacheable('route_fragment'))
+    def route_fragment(server_id, plugin_id, page_id, fragment_id):
+        request_type = "INIT"
+
+        if server_id not in servers:
+            return build_error("Unknown Server.", request_type)
+
+        try:
+            wrp = get_wrp(plugin_id, page_id)
+        except KeyError:
+            return build_error("Unknown Page.", request_type)
+        except ApplicationLoadError:
+            print_exc()
+            return build_error("Application Failed To Load.", request_type)
+
+        try:
+            fragment = wrp.fragments[fragment_id]
+        except KeyError:
+            return build_error("Unknown Fragment.", request_type)
+
+        etag = None
+        if fragment.etag_callback is not None:
+            try:
+                etag = str(fragment.etag_callback(server_id))
+            except Exception:
+                print_exc()
+                return build_error("WRP ETag Callback Raised.", request_type)
+
+            # Don't render what the browser already has
+            if etag in request.if_none_match:
+                response = make_response("", 304)
+                response.set_etag(etag)
+                return cache_fragment(response, fragment.max_age)
+
+        try:
+            result = fragment.callback(server_id)
+        except Exception:
+            print_exc()
+            return build_error("WRP Fragment Callback Raised.", request_type)
+
+        if isinstance(result, dict):
+            response = jsonify(result)
+        else:
+            template_name, context = result
+            response = make_response(
+                render_template(template_name, context=context))
+
+        if etag is not None:
+            response.set_etag(etag)
+
+        return cache_fragment(response, fragment.max_age)
+
     @app.route(config.get('application', 'switch_url'), methods=['POST', ])
     def route_ajax_switch(server_id, plugin_id, new_page_id, page_id, steamid,
                           auth_method, auth_token, session_id):
 
         request_type = "AJAX"
+        timer = RequestTimer("SWITCH")
 
         # Action check
-        if request.json['action'] != "switch":
-            return build_error("Bad Request.", request_type)
+        try:
+            action = request.json['action']
+            fetch = request.json.get('fetch')
+        except (KeyError, TypeError, AttributeError):
+            return build_error("Bad Request.", request_type, timer)
+
+        if action != "switch" or fetch not in FETCH_REQUEST_TYPES:
+            return build_error("Bad Request.", request_type, timer)
+
+        # Validate the new page before we occupy an SRCDS connection
+        if fetch is not None:
+            try:
+                new_wrp = get_wrp(plugin_id, new_page_id)
+            except KeyError:
+                return build_error("Unknown Page.", request_type, timer)
+            except ApplicationLoadError:
+                print_exc()
+                return build_error(
+                    "Application Failed To Load.", request_type, timer)
+
+            if fetch == "ajax":
+                try:
+                    callback_args = (request.json['custom_data'], )
+                except KeyError:
+                    return build_error("Bad Request.", request_type, timer)
+
+                callback = new_wrp.ajax_callback
+                if callback is None:
+                    return build_error(
+                        "WRP No AJAX Callback.", request_type, timer)
+
+            else:
+                callback_args = ()
+                callback = new_wrp.regular_callback
+                if callback is None:
+                    return build_error(
+                        "WRP No Regular Callback.", request_type, timer)
 
         server, wrp, user, client, error = create_client(
             MOTDClient, db, server_id, plugin_id, page_id, steamid,
-            auth_method, auth_token, session_id, request_type)
+            auth_method, auth_token, session_id, request_type, timer=timer)
 
         if error is not None:
             return error
 
-        # Switch
-        if not client.request_switch(new_page_id):
-            return build_error("Switch Rejected.", request_type)
+        # Switch and fetch the new page over the same connection
+        try:
+            switched = client.request_switch(
+                new_page_id, FETCH_REQUEST_TYPES[fetch])
 
-        return jsonify({
+            timer.mark("switch")
+
+            if switched and fetch is not None:
+                try:
+                    fetched = callback(
+                        client.exchange_custom_data, *callback_args)
+                except Exception:
+                    print_exc()
+                    return build_error(
+                        "WRP AJAX Callback Raised." if fetch == "ajax" else
+                        "WRP Callback Raised.", request_type, timer)
+        finally:
+            client.release()
+
+        if not switched:
+            return build_error("Switch Rejected.", request_type, timer)
+
+        web_auth_method, web_auth_token = get_web_auth(
+            user, auth_method, plugin_id, new_page_id, session_id)
+
+        response = {
             'status': "OK",
-            'web_auth_token': user.get_web_auth_token(
-                plugin_id, new_page_id, session_id),
-        })
+            'web_auth_method': web_auth_method,
+            'web_auth_token': web_auth_token,
+        }
+
+        if fetch == "ajax":
+            timer.mark("callback")
+            response['custom_data'] = fetched
+
+        elif fetch == "render":
+            timer.mark("callback")
+
+            template_name, context = fetched
+            response['html'] = render_page(
+                template_name, context, server_id, plugin_id, new_page_id,
+                steamid, auth_method, auth_token, session_id,
+                web_auth_method, web_auth_token)
+
+            timer.mark("render")
+
+        timer.finish()
+        return jsonify(response)
 
     @app.route(
         config.get('application', 'base_route'), methods=['GET', 'POST'])
@@ -175,10 +466,37 @@ def init(app, db):
                          auth_token, session_id):
 
         request_type = "AJAX" if request.is_json else "INIT"
+        timer = RequestTimer(request_type)
+
+        # Validate the request before we occupy an SRCDS connection
+        if request.is_json:
+            try:
+                action = request.json['action']
+                if action == "custom-data-batch":
+                    data = request.json['custom_data_batch']
+                else:
+                    data = request.json['custom_data']
+            except (KeyError, TypeError):
+                return build_error("Bad Request.", request_type, timer)
+
+            stream = action == "custom-data" and request.json.get('stream')
+            if stream:
+                timer = RequestTimer("STREAM")
+
+            if action == "custom-data-batch":
+                timer = RequestTimer("BATCH")
+
+                if (not isinstance(data, list) or not data or
+                        len(data) > BATCH_MAX_SIZE):
+
+                    return build_error("Bad Request.", request_type, timer)
+
+            elif action != "custom-data":
+                return build_error("Invalid Action.", request_type, timer)
 
         server, wrp, user, client, error = create_client(
             MOTDClient, db, server_id, plugin_id, page_id, steamid,
-            auth_method, auth_token, session_id, request_type)
+            auth_method, auth_token, session_id, request_type, timer=timer)
 
         if error is not None:
             return error
@@ -186,79 +504,99 @@ def init(app, db):
         ex_data_func = client.exchange_custom_data
 
         if request.is_json:
-            try:
-                action = request.json['action']
-                data = request.json['custom_data']
-            except KeyError:
-                return build_error("Bad Request.", request_type)
+            if stream:
+                if wrp.stream_callback is None:
+                    client.release()
+                    return build_error(
+                        "WRP No Stream Callback.", request_type, timer)
+
+                web_auth_method, web_auth_token = get_web_auth(
+                    user, auth_method, plugin_id, page_id, session_id)
+
+                response = Response(stream_answer(
+                    wrp, client, data, web_auth_method, web_auth_token,
+                    timer), mimetype="application/x-ndjson")
 
-            if action != "custom-data":
-                return build_error("Invalid Action.", request_type)
+                # Even if the response is closed before it's iterated
+                response.call_on_close(client.release)
+                return response
 
             if wrp.ajax_callback is None:
-                return build_error("WRP No AJAX Callback.", request_type)
+                client.release()
+                return build_error(
+                    "WRP No AJAX Callback.", request_type, timer)
+
+            if action == "custom-data-batch":
+                try:
+                    results = run_ajax_batch(wrp, ex_data_func, data)
+                finally:
+                    client.release()
+
+                timer.mark("callback")
+
+                web_auth_method, web_auth_token = get_web_auth(
+                    user, auth_method, plugin_id, page_id, session_id)
+
+                timer.finish()
+                return jsonify({
+                    'status': "OK",
+                    'web_auth_method': web_auth_method,
+                    'web_auth_token': web_auth_token,
+                    'results': results,
+                })
 
             try:
                 data = wrp.ajax_callback(ex_data_func, data)
             except Exception:
                 print_exc()
-                return build_error("WRP AJAX Callback Raised.", request_type)
+                return build_error(
+                    "WRP AJAX Callback Raised.", request_type, timer)
             finally:
-                client.stop()
+                client.release()
+
+            timer.mark("callback")
 
-            web_auth_token = user.get_web_auth_token(
-                plugin_id, page_id, session_id)
+            web_auth_method, web_auth_token = get_web_auth(
+                user, auth_method, plugin_id, page_id, session_id)
 
+            timer.finish()
             return jsonify({
                 'status': "OK",
+                'web_auth_method': web_auth_method,
                 'web_auth_token': web_auth_token,
                 'custom_data': data
             })
 
         else:
             if wrp.regular_callback is None:
-                return build_error("WRP No Regular Callback.", request_type)
+                client.release()
+                return build_error(
+                    "WRP No Regular Callback.", request_type, timer)
 
             try:
                 template_name, context = wrp.regular_callback(ex_data_func)
 
             except Exception:
                 print_exc()
-                return build_error("WRP Callback Raised.", request_type)
+                return build_error(
+                    "WRP Callback Raised.", request_type, timer)
             finally:
-                client.stop()
+                client.release()
+
+            timer.mark("callback")
 
-            web_auth_token = user.get_web_auth_token(
-                plugin_id, page_id, session_id)
-
-            auth_data = {
-                'serverId': server_id,
-                'pluginId': plugin_id,
-                'pageId': page_id,
-                'steamid': str(steamid),  # JS cannot into big numbers
-                'authMethod': AuthMethod.SRCDS,
-                'authToken': auth_token,
-                'sessionId': session_id,
-            }
-            next_auth_data = {
-                'serverId': server_id,
-                'pluginId': plugin_id,
-                'pageId': page_id,
-                'steamid': str(steamid),  # JS cannot into big numbers
-                'authMethod': AuthMethod.WEB,
-                'authToken': web_auth_token,
-                'sessionId': session_id,
-            }
-
-            return render_template(
-                template_name,
-                context=context,
-                auth_data=auth_data,
-                next_auth_data=next_auth_data,
-                base64_init_string=b64encode(
-                    json.dumps(next_auth_data).encode('utf-8')
-                ).decode('utf-8'),
-            )
+            web_auth_method, web_auth_token = get_web_auth(
+                user, auth_method, plugin_id, page_id, session_id)
+
+            page = render_page(
+                template_name, context, server_id, plugin_id, page_id,
+                steamid, auth_method, auth_token, session_id,
+                web_auth_method, web_auth_token)
+
+            timer.mark("render")
+            timer.finish()
+
+            return page
 
     # WebSocket
     if uwsgi is None:
@@ -274,22 +612,37 @@ def init(app, db):
                                 auth_method, auth_token, session_id):
 
             request_type = "WEBSOCKET"
+            timer = RequestTimer(request_type)
 
             def ws_send(**kwargs):
-                uwsgi.websocket_send(json.dumps(kwargs).encode('utf-8'))
+                uwsgi.websocket_send(encode_ws_message(**kwargs))
+
+            def end_transmission(e):
+                if e.__cause__ is not None:
+                    print_exc()
+
+                client.stop()
+
+                if e.error_id is not None:
+                    ws_send(**build_error(e.error_id, request_type))
 
             server, wrp, user, client, error = create_client(
                 MOTDClient, db, server_id, plugin_id, page_id, steamid,
-                auth_method, auth_token, session_id, request_type)
+                auth_method, auth_token, session_id, request_type,
+                timer=timer)
 
             if error is not None:
                 ws_send(**error)
                 return
 
-            web_auth_token = user.get_web_auth_token(
-                plugin_id, page_id, session_id)
+            web_auth_method, web_auth_token = get_web_auth(
+                user, auth_method, plugin_id, page_id, session_id)
+
+            ws_send(status="OK", web_auth_method=web_auth_method,
+                    web_auth_token=web_auth_token)
 
-            ws_send(status="OK", web_auth_token=web_auth_token)
+            # The transmission itself may last for hours
+            timer.finish()
 
             fd_ws = uwsgi.connection_fd()
             fd_client = client.sock.fileno()
@@ -305,56 +658,13 @@ def init(app, db):
                     return
 
                 try:
-                    data = json.loads(data_encoded.decode('utf-8'))
-                except (JSONDecodeError, UnicodeDecodeError):
-                    print_exc()
-                    client.stop()
-                    return
-
-                try:
-                    action = data['action']
-                    custom_data = data['custom_data']
-                except KeyError:
-                    return
-
-                if action != "custom-data":
-                    return
-
-                # WebSocket -> SRCDS: data goes through wrp callback
-                if wrp.ws_callback is None:
-                    client.stop()
-                    ws_send(**build_error(
-                        "WRP No WS Callback.", request_type))
-                    return
-
-                try:
-                    filtered_data = wrp.ws_callback(custom_data)
-                except Exception:
-                    print_exc()
-                    client.stop()
-                    ws_send(**build_error(
-                        "WRP WS Callback Raised.", request_type))
-                    return
-
-                if filtered_data is None:
-                    client.stop()
-                    ws_send(**build_error(
-                        "WRP WS Callback Refused Data.", request_type))
-                    return
-
-                try:
-                    data_encoded = json.dumps({
-                        'action': "custom-data",
-                        'custom_data': filtered_data,
-                    }).encode('utf-8')
-                except (TypeError, UnicodeEncodeError):
-                    print_exc()
-                    client.stop()
-                    ws_send(**build_error(
-                        "WRP WS Callback Invalid Answer.", request_type))
+                    data_encoded = relay_to_srcds(wrp, client, data_encoded)
+                except RelayError as e:
+                    end_transmission(e)
                     return
 
-                client.send_data(data_encoded)
+                if data_encoded is not None:
+                    client.send_data(data_encoded)
 
             while True:
                 uwsgi.wait_fd_read(fd_ws, 3)
@@ -368,24 +678,22 @@ def init(app, db):
                         read_from_ws()
 
                     elif fd == fd_client:
-                        # SRCDS -> WebSocket: send directly without interfering
                         try:
                             data_encoded = client.receive_data()
                         except CommunicationEnded:
                             return
 
                         try:
-                            data = json.loads(data_encoded.decode('utf-8'))
-                        except (JSONDecodeError, UnicodeDecodeError):
-                            print_exc()
-                            # TODO: client.stop?
-                            ws_send(**build_error(
-                                "SRCDS Sends Invalid Data", request_type))
-
+                            messages = relay_to_ws(client, data_encoded)
+                        except RelayError as e:
+                            end_transmission(e)
                             return
 
-                        ws_send(status="CUSTOM_DATA",
-                                custom_data=data['custom_data'])
+                        for message in messages:
+                            ws_send(**message)
+
+                        # websocket_send() returns once the data is sent
+                        client.ack_ws_messages(count_ws_messages(messages))
 
                 else:
 
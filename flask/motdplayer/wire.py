@@ -0,0 +1,54 @@
+import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from . import config
+
+
+class JSONCodec:
+    name = "json"
+
+    @staticmethod
+    def encode(obj):
+        return json.dumps(obj).encode('utf-8')
+
+    @staticmethod
+    def decode(data):
+        return json.loads(data.decode('utf-8'))
+
+
+class MsgPackCodec:
+    name = "msgpack"
+
+    @staticmethod
+    def encode(obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    @staticmethod
+    def decode(data):
+        return msgpack.unpackb(data, raw=False)
+
+
+# Exceptions that any of the codecs may raise
+ENCODE_ERRORS = (TypeError, ValueError, OverflowError, UnicodeEncodeError)
+DECODE_ERRORS = (ValueError, UnicodeDecodeError)
+if msgpack is not None:
+    DECODE_ERRORS += (msgpack.UnpackException, )
+
+codecs = {JSONCodec.name: JSONCodec}
+if msgpack is not None:
+    codecs[MsgPackCodec.name] = MsgPackCodec
+
+# Codecs we offer to SRCDS, most preferred first
+WIRE_CODECS = [
+    codecs[name.strip()] for name in config.get(
+        'wire', 'codecs', fallback=JSONCodec.name).split(',')
+    if name.strip() in codecs
+] or [JSONCodec, ]
+
+
+def get_codec(name):
+    return codecs.get(name, JSONCodec)
@@ -1,33 +1,8 @@
-from path import Path
+import os.path
 
+from motdplayer.applications import load_applications
 
-def parse_packages(dir_):
-    packages = []
-    for path in Path(dir_).dirs():
-        name = path.name
-        if name.startswith('__') and name.endswith('__'):
-            continue
 
-        packages.append(name)
-
-    return packages
-
-
-def parse_modules(dir_):
-    modules = []
-    for path in Path(dir_).files():
-        if path.ext != '.py':
-            continue
-
-        if path.name.startswith('__') and path.namebase.endswith('__'):
-            continue
-
-        modules.append(path.namebase)
-
-    return modules
-
-
-__all__ = (parse_modules(Path(__file__).parent) +
-           parse_packages(Path(__file__).parent))
-
-from . import *
+# Applications with a manifest.json are imported on their first request,
+# see motdplayer/applications.py
+load_applications(__name__, os.path.dirname(__file__))
@@ -21,13 +21,21 @@ var MOTDPlayerClass = function (b64InitString) {
 
     var nodeLoadingScreen;
 
-    this.post = function (data, successCallback, errorCallback) {
-        ajaxPostJson("/" + authVar.serverId + "/" + authVar.pluginId + "/" + authVar.pageId + "/" + authVar.steamid + "/" + authVar.authMethod + "/" + authVar.authToken + "/" + authVar.sessionId + "/", {
-                action: "custom-data",
-                custom_data: data
-            }, function (response) {
+    var getPostUrl = function () {
+        return "/" + authVar.serverId + "/" + authVar.pluginId + "/" + authVar.pageId + "/" + authVar.steamid + "/" + authVar.authMethod + "/" + authVar.authToken + "/" + authVar.sessionId + "/";
+    };
+
+    // Fills the variable parts of a Flask route in (converters are ignored)
+    var buildUrl = function (route, values) {
+        return route.replace(/<(?:\w+:)?(\w+)>/g, function (match, name) {
+            return encodeURIComponent(values[name]);
+        });
+    };
+
+    var postJson = function (data, successCallback, errorCallback) {
+        ajaxPostJson(getPostUrl(), data, function (response) {
                 if (response['status'] == "OK") {
-                    authVar.authMethod = 1;
+                    authVar.authMethod = response['web_auth_method'];
                     authVar.authToken = response['web_auth_token'];
 
                     if (nodeLoadingScreen) {
@@ -35,7 +43,7 @@ var MOTDPlayerClass = function (b64InitString) {
                         nodeLoadingScreen = null;
                     }
 
-                    successCallback(response['custom_data']);
+                    successCallback(response);
                 }
                 else if (errorCallback)
                     errorCallback(response['status'] + " " + response['error_id']);
@@ -50,7 +58,200 @@ var MOTDPlayerClass = function (b64InitString) {
         }
     };
 
+    var postSingle = function (data, successCallback, errorCallback) {
+        postJson({
+            action: "custom-data",
+            custom_data: data
+        }, function (response) {
+            successCallback(response['custom_data']);
+        }, errorCallback);
+    };
+
+    this.postStream = function (data, chunkCallback, endCallback, errorCallback) {
+        var xhr = new XMLHttpRequest();
+        var offset = 0;
+        var finished = false;
+
+        var fail = function (error) {
+            finished = true;
+            if (errorCallback)
+                errorCallback(error);
+        };
+
+        // Lines of NDJSON are handled as soon as they're complete
+        var readLines = function () {
+            var end;
+            while (!finished && (end = xhr.responseText.indexOf("\n", offset)) > -1) {
+                var response = JSON.parse(xhr.responseText.substring(offset, end));
+                offset = end + 1;
+
+                if (response['status'] == "OK") {
+                    authVar.authMethod = response['web_auth_method'];
+                    authVar.authToken = response['web_auth_token'];
+
+                    if (nodeLoadingScreen) {
+                        nodeLoadingScreen.parentNode.removeChild(nodeLoadingScreen);
+                        nodeLoadingScreen = null;
+                    }
+                }
+                else if (response['status'] == "CHUNK")
+                    chunkCallback(response['custom_data']);
+                else if (response['status'] == "END") {
+                    finished = true;
+                    if (endCallback)
+                        endCallback();
+                }
+                else
+                    fail(response['status'] + " " + response['error_id']);
+            }
+        };
+
+        xhr.onprogress = readLines;
+        xhr.onreadystatechange = function () {
+            if (xhr.readyState != 4)
+                return;
+
+            if (xhr.status == 200)
+                readLines();
+
+            if (!finished)
+                fail("JS_AJAX_FAILURE");
+        };
+
+        xhr.open("POST", getPostUrl(), true);
+        xhr.setRequestHeader("Content-Type", "application/json;charset=UTF-8");
+        xhr.send(JSON.stringify({
+            action: "custom-data",
+            custom_data: data,
+            stream: true
+        }));
+
+        if (!nodeLoadingScreen) {
+            nodeLoadingScreen = document.body.appendChild(document.createElement('div'));
+            nodeLoadingScreen.classList.add('motdplayer-ajax-loading-screen');
+        }
+    };
+
+    this.postBatch = function (dataList, successCallback, errorCallback) {
+        postJson({
+            action: "custom-data-batch",
+            custom_data_batch: dataList
+        }, function (response) {
+            successCallback(response['results']);
+        }, errorCallback);
+    };
+
+    // Auto-batching: post() calls made within the window go in one request
+    var batchWindow = null;
+    var batchQueue = [];
+    var batchTimer = null;
+    var batchInFlight = false;
+
+    var flushBatchQueue = function () {
+        batchTimer = null;
+
+        // Auth tokens are single-use, so batches go one after another
+        if (batchInFlight || !batchQueue.length)
+            return;
+
+        var calls = batchQueue.splice(0, authVar.maxBatchSize);
+        var done = function () {
+            batchInFlight = false;
+            flushBatchQueue();
+        };
+
+        batchInFlight = true;
+
+        if (calls.length == 1) {
+            postSingle(calls[0].data, function (data) {
+                done();
+                calls[0].successCallback(data);
+            }, function (error) {
+                done();
+                if (calls[0].errorCallback)
+                    calls[0].errorCallback(error);
+            });
+            return;
+        }
+
+        MOTDPlayer.postBatch(calls.map(function (call) {
+            return call.data;
+        }), function (results) {
+            done();
+            for (var i = 0; i < calls.length; i++)
+                if (results[i]['status'] == "OK")
+                    calls[i].successCallback(results[i]['custom_data']);
+                else if (calls[i].errorCallback)
+                    calls[i].errorCallback(results[i]['status'] + " " + results[i]['error_id']);
+        }, function (error) {
+            done();
+            for (var i = 0; i < calls.length; i++)
+                if (calls[i].errorCallback)
+                    calls[i].errorCallback(error);
+        });
+    };
+
+    this.setAutoBatching = function (enabled, windowMs) {
+        batchWindow = enabled ? (windowMs || 0) : null;
+        if (!enabled)
+            flushBatchQueue();
+    };
+
+    this.post = function (data, successCallback, errorCallback) {
+        if (batchWindow === null && !batchQueue.length && !batchInFlight) {
+            postSingle(data, successCallback, errorCallback);
+            return;
+        }
+
+        batchQueue.push({
+            data: data,
+            successCallback: successCallback,
+            errorCallback: errorCallback
+        });
+
+        if (!batchTimer)
+            batchTimer = setTimeout(flushBatchQueue, batchWindow || 0);
+    };
+
+    // Applies a patch made by motdplayer/delta.py on the game server.
+    // Changed objects and arrays are copied, so the old value is intact.
+    var applyPatch = function (value, patch) {
+        var key, result;
+
+        if ('=' in patch)
+            return patch['='];
+
+        if ('o' in patch || 'x' in patch) {
+            result = {};
+            for (key in value)
+                if (value.hasOwnProperty(key))
+                    result[key] = value[key];
+
+            for (key in patch['o'])
+                if (patch['o'].hasOwnProperty(key))
+                    result[key] = applyPatch(result[key], patch['o'][key]);
+
+            if (patch['x'])
+                for (var i = 0; i < patch['x'].length; i++)
+                    delete result[patch['x'][i]];
+
+            return result;
+        }
+
+        if ('a' in patch) {
+            result = value.slice(0, 'n' in patch ? patch['n'] : value.length);
+            for (key in patch['a'])
+                if (patch['a'].hasOwnProperty(key))
+                    result[+key] = applyPatch(result[+key], patch['a'][key]);
+
+            return result;
+        }
+
+        return value;
+    };
+
     var ws;
+    var wsState;
     this.openWSConnection = function (successCallback, messageCallback, closeCallback, errorCallback) {
         if (ws) {
             if (errorCallback)
@@ -64,7 +265,7 @@ var MOTDPlayerClass = function (b64InitString) {
             return;
         }
 
-        ws = new WebSocket("ws://" + location.host + "/ws/" + authVar.serverId + "/" + authVar.pluginId + "/" + authVar.pageId + "/" + authVar.steamid + "/" + authVar.authMethod + "/" + authVar.authToken + "/" + authVar.sessionId + "/");
+        ws = new WebSocket((authVar.wsUrlBase || ("ws://" + location.host)) + "/ws/" + authVar.serverId + "/" + authVar.pluginId + "/" + authVar.pageId + "/" + authVar.steamid + "/" + authVar.authMethod + "/" + authVar.authToken + "/" + authVar.sessionId + "/");
         ws.onclose = function(e) {
             MOTDPlayer.closeWSConnection();
             if (closeCallback)
@@ -74,17 +275,35 @@ var MOTDPlayerClass = function (b64InitString) {
             if (errorCallback)
                 errorCallback("WS_ONERROR_EVENT");
         };
+        var receiveWSData = function (message) {
+            if ('delta' in message)
+                wsState = applyPatch(wsState, message['delta']);
+            else
+                wsState = message['custom_data'];
+
+            messageCallback(wsState);
+        };
         ws.onmessage = function(e) {
             var response = JSON.parse(e.data);
             if (response['status'] == "OK") {
-                authVar.authMethod = 1;
+                authVar.authMethod = response['web_auth_method'];
                 authVar.authToken = response['web_auth_token'];
 
                 if (successCallback)
                     successCallback();
             }
-            else if (response['status'] == "CUSTOM_DATA") {
-                messageCallback(response['custom_data']);
+            else if (response['status'] == "CUSTOM_DATA")
+                receiveWSData(response);
+            else if (response['status'] == "CUSTOM_DATA_BATCH") {
+                // Messages that the game server coalesced within a tick
+                var socket = ws;
+                for (var i = 0; i < response['batch'].length; i++) {
+                    // The callback may have closed the connection
+                    if (ws !== socket)
+                        break;
+
+                    receiveWSData(response['batch'][i]);
+                }
             }
             else if (errorCallback)
                 errorCallback(response['status'] + " " + response['error_id']);
@@ -99,6 +318,7 @@ var MOTDPlayerClass = function (b64InitString) {
         ws.close();
 
         ws = undefined;
+        wsState = undefined;
     };
 
     this.sendWSData = function (obj) {
@@ -115,13 +335,11 @@ var MOTDPlayerClass = function (b64InitString) {
         return window.WebSocket ? true : false;
     };
 
-    this.switchPage = function (newPageId, successCallback, errorCallback) {
+    var requestSwitch = function (newPageId, data, successCallback, errorCallback) {
         ajaxPostJson("/switch/" + authVar.serverId + "/" + authVar.pluginId + "/" + newPageId + "/" + authVar.pageId + "/" + authVar.steamid + "/" + authVar.authMethod + "/" + authVar.authToken + "/" + authVar.sessionId + "/",
-            {
-                action: "switch"
-            }, function (response) {
+            data, function (response) {
                 if (response['status'] == "OK") {
-                    authVar.authMethod = 1;
+                    authVar.authMethod = response['web_auth_method'];
                     authVar.authToken = response['web_auth_token'];
                     authVar.pageId = newPageId;
 
@@ -130,8 +348,7 @@ var MOTDPlayerClass = function (b64InitString) {
                         nodeLoadingScreen = null;
                     }
 
-                    if (successCallback)
-                        successCallback();
+                    successCallback(response);
                 }
                 else
                     if (errorCallback)
@@ -147,8 +364,59 @@ var MOTDPlayerClass = function (b64InitString) {
         }
     };
 
+    this.switchPage = function (newPageId, successCallback, errorCallback) {
+        requestSwitch(newPageId, {
+            action: "switch"
+        }, function (response) {
+            if (successCallback)
+                successCallback();
+        }, errorCallback);
+    };
+
+    this.switchAndPost = function (newPageId, data, successCallback, errorCallback) {
+        requestSwitch(newPageId, {
+            action: "switch",
+            fetch: "ajax",
+            custom_data: data
+        }, function (response) {
+            successCallback(response['custom_data']);
+        }, errorCallback);
+    };
+
+    this.switchAndRender = function (newPageId, errorCallback) {
+        requestSwitch(newPageId, {
+            action: "switch",
+            fetch: "render"
+        }, function (response) {
+            document.open();
+            document.write(response['html']);
+            document.close();
+        }, errorCallback);
+    };
+
+    this.loadFragment = function (fragmentId, successCallback, errorCallback) {
+        var xhr = new XMLHttpRequest();
+
+        xhr.onreadystatechange = function () {
+            if (xhr.readyState == 4)
+                if (xhr.status == 200)
+                    successCallback(xhr.responseText);
+                else if (errorCallback)
+                    errorCallback("JS_AJAX_FAILURE");
+        };
+
+        // Not bound to the player, so the browser may cache it
+        xhr.open("GET", buildUrl(authVar.fragmentRoute, {
+            server_id: authVar.serverId,
+            plugin_id: authVar.pluginId,
+            page_id: authVar.pageId,
+            fragment_id: fragmentId
+        }), true);
+        xhr.send();
+    };
+
     this.reloadPage = function () {
-        location.href = "/" + authVar.serverId + "/" + authVar.pluginId + "/" + authVar.pageId + "/" + authVar.steamid + "/" + authVar.authMethod + "/" + authVar.authToken + "/" + authVar.sessionId + "/";
+        location.href = getPostUrl();
     };
 
     this.getPlayerSteamID64 = function () {
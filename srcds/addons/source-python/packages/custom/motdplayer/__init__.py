@@ -1,19 +1,24 @@
+from collections import deque
 from configparser import ConfigParser
+from contextlib import suppress
+from copy import deepcopy
 from enum import IntEnum
-from hashlib import sha512
+from inspect import isgenerator
 import json
-from json.decoder import JSONDecodeError
 from os import urandom
+from time import perf_counter
 from traceback import format_exc
 
-from sqlalchemy import create_engine, Column, Integer, String
+from sqlalchemy import create_engine, Column, Index, Integer, String
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
+from commands.server import ServerCommand
 from core import echo_console, GAME_NAME
 from cvars import ConVar
-from listeners import OnClientActive, OnLevelInit, OnPluginUnloaded
-from listeners.tick import GameThread
+from listeners import (
+    OnClientActive, OnLevelInit, OnPluginUnloaded, OnTick)
+from listeners.tick import Delay, GameThread
 from messages import HudDestination, TextMsg, VGUIMenu
 from players.dictionary import PlayerDictionary
 from players.helpers import playerinfo_from_index, uniqueid_from_playerinfo
@@ -22,12 +27,19 @@ from steam import SteamID
 from ccp.receive import RawReceiver
 
 from .constants import SessionError, PageRequestType
+from .delta import make_patch
+from .migrations import upgrade
 from .paths import get_server_file, MOTDPLAYER_CFG_PATH, MOTDPLAYER_DATA_PATH
+from .salt_writer import SaltWriter
+from .tokens import get_legacy_token, HMACTokenizer
+from .wire import DECODE_ERRORS, ENCODE_ERRORS, JSONCodec, negotiate_codec
 
 
 class AuthMethod(IntEnum):
     SRCDS = 0
     WEB = 1
+    SRCDS_HMAC = 2
+    WEB_HMAC = 3
 
 
 MOTD_BROKEN_GAMES = ('csgo',)
@@ -53,6 +65,41 @@ if GAME_NAME in MOTD_BROKEN_GAMES:
 else:
     URL_BASE = config['motd']['url']
 
+# Tokens in the MoTD URLs; 'hmac' needs an up-to-date web counterpart
+if config.get('auth', 'token_version', fallback="legacy") == "hmac":
+    AUTH_METHOD = AuthMethod.SRCDS_HMAC
+else:
+    AUTH_METHOD = AuthMethod.SRCDS
+
+TOKENIZER = HMACTokenizer(
+    SECRET_SALT, config.getint('auth', 'hmac_token_size', fallback=64))
+
+WIRE_CODECS = [name.strip() for name in config.get(
+    'wire', 'codecs', fallback=JSONCodec.name).split(',')]
+
+# Time a streamed answer may spend on encoding its chunks within one tick
+STREAM_TICK_BUDGET = config.getfloat('stream', 'tick_budget', fallback=0.002)
+
+# Pages with ws_delta send a full snapshot after this many patches
+DELTA_SNAPSHOT_INTERVAL = config.getint(
+    'delta', 'snapshot_interval', fallback=50)
+
+# Buffer WebSocket data and send it once per tick as a single batched frame
+WS_COALESCE = config.getboolean('ws', 'coalesce', fallback=False)
+WS_COALESCE_MAX_LATENCY = config.getfloat('ws', 'max_latency', fallback=0.0)
+WS_COALESCE_MAX_BATCH = config.getint('ws', 'max_batch', fallback=32)
+
+# WebSocket data that the web-application hasn't delivered yet is limited
+# to WS_WINDOW messages, the data over it waits in a queue of WS_QUEUE_SIZE
+WS_QUEUE_POLICIES = ("drop-oldest", "drop-newest", "latest", "disconnect")
+WS_WINDOW = config.getint('ws', 'window', fallback=64)
+WS_QUEUE_SIZE = config.getint('ws', 'queue_size', fallback=256)
+WS_QUEUE_POLICY = config.get('ws', 'queue_policy', fallback="drop-oldest")
+
+if WS_QUEUE_POLICY not in WS_QUEUE_POLICIES:
+    raise ValueError("Unknown WebSocket queue policy: {}".format(
+        WS_QUEUE_POLICY))
+
 cvar_motdplayer_debug = ConVar(
     "motdplayer_debug", "0",
     "Enable/Disable debugging of MoTD screens sent through MOTDPlayer package")
@@ -66,6 +113,9 @@ Session = sessionmaker(bind=engine)
 
 class User(Base):
     __tablename__ = 'motdplayers_srcds_users'
+    __table_args__ = (
+        Index("ix_motdplayers_srcds_users_steamid64", 'steamid64', unique=True),
+    )
 
     id = Column(Integer, primary_key=True)
     steamid64 = Column(String(32))
@@ -75,7 +125,15 @@ class User(Base):
         return "<User({})>".format(self.steamid)
 
 
-Base.metadata.create_all(engine)
+upgrade(engine, User)
+
+salt_writer = SaltWriter(
+    Session, User,
+    flush_interval=config.getfloat(
+        'database', 'salt_flush_interval', fallback=1.0),
+    max_unsaved=config.getint('database', 'max_unsaved_salts', fallback=0),
+    exception_header=EXCEPTION_HEADER,
+)
 
 
 class SessionClosedException(Exception):
@@ -83,6 +141,9 @@ class SessionClosedException(Exception):
 
 
 _pages_mapping = {}
+_ws_pages = {}
+_push_channels = {}
+_coalescing_streams = set()
 
 
 class PageMeta(type):
@@ -119,6 +180,12 @@ class PageMeta(type):
             raise ValueError("Page '{}' already exists in the plugin "
                              "'{}'".format(cls.page_id, cls.plugin_id))
 
+        if (cls.ws_queue_policy is not None and
+                cls.ws_queue_policy not in WS_QUEUE_POLICIES):
+
+            raise ValueError("Class '{}' has unknown 'ws_queue_policy' "
+                             "{}".format(cls, cls.ws_queue_policy))
+
         _pages_mapping[cls.plugin_id][cls.page_id] = cls
 
 
@@ -128,6 +195,17 @@ class Page(metaclass=PageMeta):
     plugin_id = None
     ws_support = False
 
+    # Send WebSocket data as patches against the previous data
+    ws_delta = False
+
+    # What to do with WebSocket data when the queue is full (None for
+    # [ws] queue_policy) and, for the "latest" policy, the data key which
+    # tells the queued data that the new one replaces
+    ws_queue_policy = None
+    ws_queue_key = None
+
+    _ws_stream = None
+
     def __init__(self, index, page_request_type):
         self.index = index
         self._page_request_type = page_request_type
@@ -144,6 +222,22 @@ class Page(metaclass=PageMeta):
     def is_websocket(self):
         return self._page_request_type == PageRequestType.WEBSOCKET
 
+    @property
+    def ws_queue_length(self):
+        """Number of data waiting for the web-application to catch up."""
+        if self._ws_stream is None:
+            return 0
+
+        return len(self._ws_stream.ws_queue)
+
+    @property
+    def ws_data_dropped(self):
+        """Number of data that never made it out of the queue."""
+        if self._ws_stream is None:
+            return 0
+
+        return self._ws_stream.ws_data_dropped
+
     def on_error(self, error):
         pass
 
@@ -172,6 +266,86 @@ class Page(metaclass=PageMeta):
         motdplayer = motdplayer_dictionary[index]
         motdplayer.send_page(cls)
 
+    @classmethod
+    def get_ws_instances(cls):
+        pages = []
+        for page_class, page_class_pages in _ws_pages.items():
+            if issubclass(page_class, cls):
+                pages.extend(page_class_pages)
+
+        return pages
+
+    @classmethod
+    def broadcast(cls, data, page_filter=None):
+        # Recipients that share a codec get the very same encoded bytes
+        encoded_cache = {}
+
+        # Recipients behind a push channel are reached with a single
+        # message per channel that the web tier fans out
+        push_recipients = {}
+
+        # Broadcasts are never delta-encoded, they resync delta pages instead
+        delta_state = None
+
+        for page in cls.get_ws_instances():
+            if page_filter is not None and not page_filter(page):
+                continue
+
+            stream = page._ws_stream
+
+            # Delta pages get the broadcast on their own stream: the patches
+            # that follow it are made against it, and over the push channel
+            # it could reach the browser after them
+            if page.ws_delta:
+                channel = None
+            else:
+                channel = _push_channels.get(stream.push_channel_id)
+
+            # Behind the web-application: wait in line as any other data
+            if channel is None and stream.ws_congested:
+                stream.queue_ws_data(data)
+                continue
+
+            # Data that was queued before the broadcast goes out first
+            stream.flush_ws_outbox()
+
+            if page.ws_delta:
+                if delta_state is None:
+                    delta_state = deepcopy(data)
+
+                stream.reset_delta_state(delta_state)
+
+            if channel is not None:
+                push_recipients.setdefault(channel, []).append(stream)
+                continue
+
+            # A recipient whose codec can't encode the data is skipped, the
+            # others still get it
+            stream.send_ws_data(data, encoded_cache)
+
+        for channel, streams in push_recipients.items():
+            if page_filter is None:
+                topics = {(page_class.plugin_id, page_class.page_id)
+                          for page_class in _ws_pages
+                          if issubclass(page_class, cls) and
+                          not page_class.ws_delta}
+
+                channel.send_push(data, topics=sorted(topics))
+            else:
+                channel.send_push(data, targets=[
+                    (stream.motdplayer.steamid64, stream.session.id)
+                    for stream in streams])
+
+
+def _get_queue_key(data, key):
+    if key is None:
+        return None
+
+    try:
+        return data[key]
+    except (KeyError, TypeError):
+        return None
+
 
 class MOTDSession:
     def __init__(self, motdplayer, id_, page_class):
@@ -194,22 +368,36 @@ class MOTDSession:
     def page_id(self):
         return self._page_class.page_id
 
+    @property
+    def page_class(self):
+        return self._page_class
+
     def init_page(self, page_class):
         self._page_class = page_class
         self.ws_allowed = page_class.ws_support
 
-        try:
-            if self.page_ws is not None:
-                self._ws_stop_transmission("ERROR_WS_SWITCHED_FROM")
-                self.page_ws.on_error(SessionError.WS_SWITCHED_FROM)
-        finally:
-            self.page_ws = None
+        page_ws = self._discard_page_ws()
+        if page_ws is not None:
+            self._ws_stop_transmission("ERROR_WS_SWITCHED_FROM")
+            page_ws.on_error(SessionError.WS_SWITCHED_FROM)
 
-    def set_ws_callbacks(self, send_data, stop_transmission):
+    def _discard_page_ws(self):
+        page_ws, self.page_ws = self.page_ws, None
+
+        if page_ws is not None:
+            pages = _ws_pages.get(type(page_ws), ())
+            if page_ws in pages:
+                pages.remove(page_ws)
+
+        return page_ws
+
+    def set_ws_callbacks(self, send_data, stop_transmission, ws_stream):
         self.page_ws = self._page_class(
             self._motdplayer.index, PageRequestType.WEBSOCKET)
 
         self.page_ws.send_data = send_data
+        self.page_ws._ws_stream = ws_stream
+        _ws_pages.setdefault(self._page_class, []).append(self.page_ws)
 
         def plugin_stop_ws_transmission():
             stop_transmission("ERROR_WS_TRANSMISSION_STOPPED_BY_PLUGIN")
@@ -227,8 +415,9 @@ class MOTDSession:
         if error in (SessionError.TAKEN_OVER, SessionError.PLAYER_DROP):
             self._ws_stop_transmission("ERROR_SESSION_{}".format(error.name))
 
-        self.page_ws.on_error(error)
-        self.page_ws = None
+        page_ws = self._discard_page_ws()
+        if page_ws is not None:
+            page_ws.on_error(error)
 
     def receive(self, data, page_request_type):
         if self._closed:
@@ -258,11 +447,15 @@ class MOTDSession:
 
         # Call page's on_data_received callback. The page may call its own
         # send_data method, which in turn will put the data in self._answer.
-        page.on_data_received(data)
+        # Generator callbacks stream their answers chunk by chunk instead.
+        chunks = page.on_data_received(data)
 
         # Restore original send_data callback
         page.send_data = old_send_data
 
+        if isgenerator(chunks):
+            return chunks
+
         # Return the answer, no matter if send_data was called or not
         return self._answer
 
@@ -336,23 +529,21 @@ class MOTDPlayer:
 
     def get_auth_token(self, plugin_id, page_id, session_id):
         personal_salt = '' if self.salt is None else self.salt
-        return sha512(
-            (
-                personal_salt +
-                config['server']['id'] +
-                plugin_id +
-                self.steamid64 +
-                page_id +
-                str(session_id)
-            ).encode('ascii') + SECRET_SALT
-        ).hexdigest()
+        fields = (personal_salt, config['server']['id'], plugin_id,
+                  self.steamid64, page_id, session_id)
+
+        if AUTH_METHOD == AuthMethod.SRCDS_HMAC:
+            return TOKENIZER.get_token(*fields)
+
+        return get_legacy_token(*fields, SECRET_SALT)
 
     def confirm_new_salt(self, new_salt):
         self.salt = new_salt
 
-        # We save new salt to the database immediately to prevent
-        # losing it when server crashes
-        self.save_to_database()
+        # The writer coalesces salts and saves them in batches, in the
+        # background; more than max_unsaved_salts rotations make it write
+        # right away
+        salt_writer.put(self.steamid64, new_salt)
 
         return True
 
@@ -372,18 +563,12 @@ class MOTDPlayer:
 
         db_session.close()
 
-        self._loaded = True
-
-    def save_to_database(self):
-        db_session = Session()
-
-        user = db_session.query(User).filter_by(
-            steamid64=self.steamid64).first()
+        # The database may not have caught up with the latest rotation yet
+        pending_salt = salt_writer.get_pending(self.steamid64)
+        if pending_salt is not None:
+            self.salt = pending_salt
 
-        user.salt = self.salt
-        db_session.commit()
-
-        db_session.close()
+        self._loaded = True
 
     def send_page(self, page_class):
         if not self._loaded:
@@ -401,7 +586,7 @@ class MOTDPlayer:
             plugin_id=page_class.plugin_id,
             page_id=page_class.page_id,
             steamid=self.steamid64,
-            auth_method=AuthMethod.SRCDS,
+            auth_method=AUTH_METHOD,
             auth_token=self.get_auth_token(
                 page_class.plugin_id, page_class.page_id, session.id),
             session_id=session.id,
@@ -433,48 +618,394 @@ class MOTDPlayer:
 
 
 class MOTDPlayerDictionary(PlayerDictionary):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self._by_steamid64 = {}
+
+    def __setitem__(self, index, motdplayer):
+        old_motdplayer = self.get(index)
+        if old_motdplayer is not None:
+            self._unindex(old_motdplayer)
+
+        super().__setitem__(index, motdplayer)
+        self._by_steamid64[motdplayer.steamid64] = motdplayer
+
+    def __delitem__(self, index):
+        motdplayer = self.get(index)
+        if motdplayer is not None:
+            self._unindex(motdplayer)
+
+        super().__delitem__(index)
+
+    def pop(self, index, *args):
+        motdplayer = self.get(index)
+        if motdplayer is not None:
+            self._unindex(motdplayer)
+
+        return super().pop(index, *args)
+
+    def clear(self):
+        self._by_steamid64.clear()
+        super().clear()
+
+    def _unindex(self, motdplayer):
+        if self._by_steamid64.get(motdplayer.steamid64) is motdplayer:
+            del self._by_steamid64[motdplayer.steamid64]
+
     def on_automatically_removed(self, index):
         motdplayer = self[index]
         motdplayer.close_all_sessions(SessionError.PLAYER_DROP)
 
+    def find_by_steamid64(self, steamid64):
+        return self._by_steamid64.get(str(steamid64))
+
     def from_steamid64(self, steamid64):
-        steamid64 = str(steamid64)
-        for motdplayer in self.values():
-            if motdplayer.steamid64 == steamid64:
-                return motdplayer
+        motdplayer = self.find_by_steamid64(steamid64)
+        if motdplayer is None:
+            raise ValueError(
+                "Cannot find a player with SteamID64 = {}".format(steamid64))
 
-        raise ValueError(
-            "Cannot find a player with SteamID64 = {}".format(steamid64))
+        return motdplayer
 
 motdplayer_dictionary = MOTDPlayerDictionary(factory=MOTDPlayer)
 
 
-class MOTDPlayerRawReceiver(RawReceiver):
-    plugin_name = "motdplayer"
-
-    def __init__(self, addr, ccp_receive_client):
-        super().__init__(addr, ccp_receive_client)
+class MOTDRequestStream:
+    """State of a single request that Flask makes over a CCP connection.
 
+    In default (lock-step) mode the connection carries exactly one stream
+    at a time. In multiplex mode every frame is tagged with 'stream_id' and
+    a single connection serves any number of concurrent streams.
+    """
+    def __init__(self, receiver, stream_id=None):
+        self.receiver = receiver
+        self.id = stream_id
         self.motdplayer = None
         self.session = None
         self.page_request_type = None
+        self.push_channel_id = None
+        self.closed = False
+        self.delta_state = None
+        self.patches_sent = 0
+        self.ws_outbox = []
+        self.ws_outbox_since = None
+        self.ws_window = None
+        self.ws_in_flight = 0
+        self.ws_queue = deque()
+        self.ws_data_dropped = 0
+
+    def reset_state(self):
+        self.motdplayer = None
+        self.session = None
+        self.page_request_type = None
+        self.push_channel_id = None
+        self.delta_state = None
+        self.patches_sent = 0
+        self.clear_ws_outbox()
+        self.ws_window = None
+        self.ws_in_flight = 0
+        self.ws_queue.clear()
+        self.ws_data_dropped = 0
+
+    def encode_message(self, **kwargs):
+        if self.id is not None:
+            kwargs['stream_id'] = self.id
+
+        return self.receiver.codec.encode(kwargs)
+
+    def send_encoded(self, data):
+        self.receiver.send_data(data)
 
     def send_message(self, **kwargs):
-        self.send_data(json.dumps(kwargs).encode('utf-8'))
+        self.send_encoded(self.encode_message(**kwargs))
+
+    def reset_delta_state(self, state):
+        """Remember the data that the page got in full."""
+        self.delta_state = state
+        self.patches_sent = 0
+
+    def clear_ws_outbox(self):
+        self.ws_outbox = []
+        self.ws_outbox_since = None
+        _coalescing_streams.discard(self)
+
+    def queue_ws_message(self, message):
+        """Buffer a message until the next tick (or a full batch).
+
+        The message must not share any mutable data with the page, because
+        the page may change its data before the message is encoded.
+        """
+        if not self.ws_outbox:
+            self.ws_outbox_since = perf_counter()
+            _coalescing_streams.add(self)
+
+        self.ws_outbox.append(message)
+        if len(self.ws_outbox) >= WS_COALESCE_MAX_BATCH:
+            self.flush_ws_outbox()
+
+    def flush_ws_outbox(self):
+        if not self.ws_outbox:
+            return
 
-    def on_data_received(self, data):
+        messages = self.ws_outbox
+        self.clear_ws_outbox()
+
+        if self.closed:
+            return
+
+        if len(messages) == 1:
+            messages_encoded = [self._encode_ws_message(messages[0])]
+        else:
+            try:
+                messages_encoded = [
+                    self.encode_message(status="OK", batch=messages)]
+
+            # Don't let a single message take the whole batch down
+            except ENCODE_ERRORS:
+                messages_encoded = [
+                    self._encode_ws_message(message) for message in messages]
+
+        for message_encoded in messages_encoded:
+            if message_encoded is not None:
+                self.send_encoded(message_encoded)
+
+    def _encode_ws_message(self, message):
         try:
-            message = json.loads(data.decode('utf-8'))
-        except (JSONDecodeError, UnicodeDecodeError):
+            return self.encode_message(status="OK", **message)
+        except ENCODE_ERRORS:
+            echo_console(EXCEPTION_HEADER)
+            echo_console(format_exc())
+            return None
+
+    @property
+    def ws_congested(self):
+        """Whether new WebSocket data has to wait in the queue."""
+        return self.ws_window is not None and (
+            bool(self.ws_queue) or self.ws_in_flight >= self.ws_window)
+
+    def send_page_data(self, data):
+        """Send the data of the WebSocket page, or queue it if the
+        web-application is behind."""
+        if self.closed:
+            return False
+
+        if self.ws_congested:
+            return self.queue_ws_data(data)
+
+        return self._send_page_data(data)
+
+    def _send_page_data(self, data):
+        if self.session.page_class.ws_delta:
+            return self.send_ws_delta(data)
+
+        return self.send_ws_data(data)
+
+    def queue_ws_data(self, data):
+        page_class = self.session.page_class
+        policy = page_class.ws_queue_policy or WS_QUEUE_POLICY
+
+        # The page may change the data while it waits
+        data = deepcopy(data)
+
+        if policy == "latest":
+            key = _get_queue_key(data, page_class.ws_queue_key)
+            for i, (queued_key, queued_data) in enumerate(self.ws_queue):
+                if queued_key == key:
+                    self.ws_queue[i] = (key, data)
+                    self.ws_data_dropped += 1
+                    return True
+        else:
+            key = None
+
+        if len(self.ws_queue) < WS_QUEUE_SIZE:
+            self.ws_queue.append((key, data))
+            return True
+
+        if policy == "disconnect":
+            self.send_message(status="ERROR_WS_QUEUE_OVERFLOW")
             self.stop()
-            return
+
+            with suppress(SessionClosedException):
+                self.session.error(SessionError.WS_QUEUE_OVERFLOW)
+
+            return False
+
+        self.ws_data_dropped += 1
+
+        if policy == "drop-newest":
+            return True
+
+        if self.ws_queue:
+            self.ws_queue.popleft()
+            self.ws_queue.append((key, data))
+
+        return True
+
+    def on_ws_ack(self, count):
+        """The web-application has delivered count messages."""
+        self.ws_in_flight = max(0, self.ws_in_flight - count)
+
+        while (self.ws_queue and not self.closed and
+               self.ws_in_flight < self.ws_window):
+
+            key, data = self.ws_queue.popleft()
+            self._send_page_data(data)
+
+    def send_ws_delta(self, data):
+        """Send the data as a patch against the previous data.
+
+        The first data, every DELTA_SNAPSHOT_INTERVAL-th one and the data
+        that doesn't share anything with the previous one are sent in full.
+        """
+        state = deepcopy(data)
+
+        patch = None
+        if (self.delta_state is not None and
+                self.patches_sent < DELTA_SNAPSHOT_INTERVAL):
+
+            patch = make_patch(self.delta_state, state)
+            if patch is None:
+                patch = {}
+            elif '=' in patch:
+                patch = None
+
+        # The patch shares its values with the state, which is never
+        # modified, so both are safe to queue
+        if patch is None:
+            message = {'custom_data': state}
+        else:
+            message = {'delta': patch}
+
+        if WS_COALESCE:
+            self.queue_ws_message(message)
+        else:
+            data_encoded = self._encode_ws_message(message)
+            if data_encoded is None:
+                return False
+
+            self.send_encoded(data_encoded)
+
+        if patch is None:
+            self.reset_delta_state(state)
+        else:
+            self.delta_state = state
+            self.patches_sent += 1
+
+        self.ws_in_flight += 1
+        return True
+
+    def send_ws_data(self, data, encoded_cache=None):
+        # Frames of multiplexed streams differ by stream_id, so they can't
+        # share the encoded data
+        cache_key = self.receiver.codec if self.id is None else None
+
+        if WS_COALESCE:
+            if encoded_cache is None:
+                self.queue_ws_message({'custom_data': deepcopy(data)})
+                self.ws_in_flight += 1
+                return True
+
+            self.flush_ws_outbox()
 
+        try:
+            data_encoded = encoded_cache[cache_key]
+        except (KeyError, TypeError):
+            try:
+                data_encoded = self.encode_message(
+                    status="OK", custom_data=data)
+            except ENCODE_ERRORS:
+                echo_console(EXCEPTION_HEADER)
+                echo_console(format_exc())
+                data_encoded = None
+
+            # A failure is cached too, so a broadcast only reports it once
+            # per codec
+            if encoded_cache is not None and cache_key is not None:
+                encoded_cache[cache_key] = data_encoded
+
+        if data_encoded is None:
+            return False
+
+        self.send_encoded(data_encoded)
+        self.ws_in_flight += 1
+        return True
+
+    def send_chunks(self, chunks):
+        """Send a streamed answer, spreading the chunks over ticks.
+
+        Every tick only takes as many chunks as fit in STREAM_TICK_BUDGET,
+        so that a large answer doesn't hold up the game thread.
+        """
+        started_at = perf_counter()
+        while perf_counter() - started_at < STREAM_TICK_BUDGET:
+            if self.closed:
+                chunks.close()
+                return
+
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                self.send_message(status="OK", stream_end=True)
+                return
+            except Exception:
+                echo_console(EXCEPTION_HEADER)
+                echo_console(format_exc())
+                self.send_message(status="ERROR_DATA_CALLBACK_RAISED_3")
+                self.stop()
+                return
+
+            try:
+                chunk_encoded = self.encode_message(
+                    status="CHUNK", custom_data=chunk)
+            except ENCODE_ERRORS:
+                echo_console(EXCEPTION_HEADER)
+                echo_console(format_exc())
+                self.send_message(status="ERROR_DATA_CALLBACK_INVALID_ANSWER")
+                self.stop()
+                return
+
+            self.send_encoded(chunk_encoded)
+
+        Delay(0, self.send_chunks, (chunks, ))
+
+    def stop(self):
+        self.closed = True
+        self.clear_ws_outbox()
+        self.ws_queue.clear()
+
+        if self.id is None:
+            self.receiver.stop()
+        else:
+            self.receiver.close_stream(self)
+
+    def on_connection_abort(self):
+        self.closed = True
+        self.clear_ws_outbox()
+        self.ws_queue.clear()
+
+        if self.page_request_type == PageRequestType.WEBSOCKET:
+            self.session.error(SessionError.WS_TRANSMISSION_END)
+
+    def on_message(self, message):
         try:
             action = message['action']
         except KeyError:
             self.stop()
             return
 
+        if action == "reset":
+            # Flask returns this connection to its pool: forget everything
+            # that was bound to it by the previous request
+            if self.page_request_type == PageRequestType.WEBSOCKET:
+                self.stop()
+                return
+
+            self.reset_state()
+            self.send_message(status="OK")
+
+            return
+
         if action == "set-identity":
             try:
                 steamid = message['steamid']
@@ -518,24 +1049,23 @@ class MOTDPlayerRawReceiver(RawReceiver):
                     self.stop()
                     return
 
+                self.push_channel_id = message.get('push_channel')
+
+                # Flask acknowledges delivered messages, so we can hold
+                # back the data of the pages it doesn't keep up with
+                if message.get('flow_control'):
+                    self.ws_window = WS_WINDOW
+
                 def send_ws_data(data):
-                    try:
-                        data_encoded = json.dumps({
-                            'status': "OK",
-                            'custom_data': data,
-                        }).encode('utf-8')
-                    except (TypeError, UnicodeEncodeError):
-                        echo_console(EXCEPTION_HEADER)
-                        echo_console(format_exc())
-                    else:
-                        self.send_data(data_encoded)
+                    self.send_page_data(data)
 
                 def stop_ws_transmission(status):
+                    self.flush_ws_outbox()
                     self.send_message(status=status)
                     self.stop()
 
                 self.session.set_ws_callbacks(
-                    send_ws_data, stop_ws_transmission)
+                    send_ws_data, stop_ws_transmission, self)
 
             if (new_salt is not None and
                     not motdplayer.confirm_new_salt(new_salt)):
@@ -544,7 +1074,10 @@ class MOTDPlayerRawReceiver(RawReceiver):
                 self.stop()
                 return
 
-            self.send_message(status="OK")
+            if self.ws_window is not None:
+                self.send_message(status="OK", ws_window=self.ws_window)
+            else:
+                self.send_message(status="OK")
 
             return
 
@@ -588,10 +1121,34 @@ class MOTDPlayerRawReceiver(RawReceiver):
                 return
 
             self.session.init_page(new_page_class)
+
+            # Switch-and-fetch: the new page is then requested over this
+            # connection as if it was loaded (INIT) or posted to (AJAX)
+            request_type = message.get('request_type')
+            if (request_type in ("INIT", "AJAX") and
+                    self.page_request_type != PageRequestType.WEBSOCKET):
+
+                self.page_request_type = PageRequestType[request_type]
+
             self.send_message(status="OK")
 
             return
 
+        if action == "ack":
+            if self.ws_window is None:
+                self.stop()
+                return
+
+            try:
+                count = int(message['count'])
+            except (KeyError, TypeError, ValueError):
+                self.stop()
+                return
+
+            self.on_ws_ack(count)
+
+            return
+
         if action == "custom-data":
             try:
                 custom_data = message['custom_data']
@@ -635,15 +1192,30 @@ class MOTDPlayerRawReceiver(RawReceiver):
                     self.stop()
                     return
 
+                if isgenerator(answer):
+                    if message.get('stream'):
+                        self.send_chunks(answer)
+                        return
+
+                    # Flask didn't ask for a stream, so it gets all chunks
+                    # at once
+                    try:
+                        answer = list(answer)
+                    except Exception:
+                        echo_console(EXCEPTION_HEADER)
+                        echo_console(format_exc())
+                        self.send_message(
+                            status="ERROR_DATA_CALLBACK_RAISED_3")
+                        self.stop()
+                        return
+
                 if answer is None:
                     answer = dict()
 
                 try:
-                    answer_encoded = json.dumps({
-                        'status': "OK",
-                        'custom_data': answer,
-                    }).encode('utf-8')
-                except (TypeError, UnicodeEncodeError):
+                    answer_encoded = self.encode_message(
+                        status="OK", custom_data=answer)
+                except ENCODE_ERRORS:
                     echo_console(EXCEPTION_HEADER)
                     echo_console(format_exc())
                     self.send_message(
@@ -651,17 +1223,189 @@ class MOTDPlayerRawReceiver(RawReceiver):
                     self.stop()
                     return
 
-                self.send_data(answer_encoded)
+                self.send_encoded(answer_encoded)
+
+
+class MOTDPlayerRawReceiver(RawReceiver):
+    plugin_name = "motdplayer"
+    features = ("multiplex", )
+
+    def __init__(self, addr, ccp_receive_client):
+        super().__init__(addr, ccp_receive_client)
+
+        self.multiplex = False
+        self.codec = JSONCodec
+        self.default_stream = MOTDRequestStream(self)
+        self.streams = {}
+        self.push_channel_id = None
+
+    def send_push(self, data, targets=None, topics=None):
+        """Send data to many WebSocket sessions behind this channel.
+
+        Sessions are addressed either by (steamid64, session_id) targets
+        or by (plugin_id, page_id) topics.
+        """
+        message = {'status': "PUSH", 'custom_data': data}
+        if targets is not None:
+            message['targets'] = targets
+        if topics is not None:
+            message['topics'] = topics
+
+        try:
+            data_encoded = self.codec.encode(message)
+        except ENCODE_ERRORS:
+            echo_console(EXCEPTION_HEADER)
+            echo_console(format_exc())
+            return
+
+        self.send_data(data_encoded)
+
+    def on_push_subscribe(self, message):
+        try:
+            channel_id = message['channel_id']
+        except KeyError:
+            self.stop()
+            return
+
+        if (self.default_stream.motdplayer is not None or
+                self.push_channel_id is not None):
+
+            self.stop()
+            return
+
+        self.push_channel_id = channel_id
+        _push_channels[channel_id] = self
+        self.default_stream.send_message(status="OK")
+
+    def close_stream(self, stream):
+        if self.streams.pop(stream.id, None) is None:
+            return
+
+        self.send_data(stream.encode_message(status="STREAM_CLOSED"))
+
+    def on_hello(self, message):
+        if self.default_stream.motdplayer is not None:
+            self.stop()
+            return
+
+        features = [feature for feature in message.get('features', ())
+                    if feature in self.features]
+
+        codec = negotiate_codec(message.get('codecs', ()), WIRE_CODECS)
+
+        # The handshake itself is always JSON
+        self.send_data(json.dumps({
+            'status': "OK",
+            'features': features,
+            'codec': codec.name,
+        }).encode('utf-8'))
+
+        self.multiplex = "multiplex" in features
+        self.codec = codec
+
+    def on_data_received(self, data):
+        try:
+            message = self.codec.decode(data)
+        except DECODE_ERRORS:
+            self.stop()
+            return
+
+        if not self.multiplex:
+            if message.get('action') == "hello":
+                if self.codec is not JSONCodec:
+                    self.stop()
+                    return
+
+                self.on_hello(message)
+
+            elif message.get('action') == "push-subscribe":
+                self.on_push_subscribe(message)
+
+            # Push channels don't accept anything after subscribing
+            elif self.push_channel_id is not None:
+                self.stop()
+
+            else:
+                self.default_stream.on_message(message)
+
+            return
+
+        try:
+            stream_id = message['stream_id']
+        except KeyError:
+            self.stop()
+            return
+
+        if message.get('action') == "close-stream":
+            stream = self.streams.pop(stream_id, None)
+            if stream is not None:
+                stream.on_connection_abort()
+
+            return
+
+        try:
+            stream = self.streams[stream_id]
+        except KeyError:
+            stream = self.streams[stream_id] = MOTDRequestStream(
+                self, stream_id)
+
+        stream.on_message(message)
+
+    def _unsubscribe_push(self):
+        if _push_channels.get(self.push_channel_id) is self:
+            del _push_channels[self.push_channel_id]
+
+    def stop(self):
+        self._unsubscribe_push()
+        super().stop()
 
     def on_connection_abort(self):
-        if self.page_request_type == PageRequestType.WEBSOCKET:
-            self.session.error(SessionError.WS_TRANSMISSION_END)
+        self._unsubscribe_push()
+        self.default_stream.on_connection_abort()
+        for stream in tuple(self.streams.values()):
+            stream.on_connection_abort()
+
+        self.streams.clear()
 
 
 @OnPluginUnloaded
 def listener_on_plugin_unloaded(plugin):
     _pages_mapping.pop(plugin.name, None)
 
+    for page_class in tuple(_ws_pages):
+        if page_class.plugin_id == plugin.name:
+            del _ws_pages[page_class]
+
+    # MOTDPlayer is a package, so this is as close as it gets to unloading
+    # MOTDPlayer itself (e.g. Source.Python is being unloaded)
+    if not _pages_mapping:
+        salt_writer.flush()
+
+
+@OnTick
+def listener_on_tick():
+    if not _coalescing_streams:
+        return
+
+    now = perf_counter()
+    for stream in tuple(_coalescing_streams):
+        if now - stream.ws_outbox_since >= WS_COALESCE_MAX_LATENCY:
+            stream.flush_ws_outbox()
+
+
+@ServerCommand("motdplayer_ws_queues")
+def server_motdplayer_ws_queues(command):
+    echo_console("{:<40}{:>20}{:>10}{:>8}{:>10}".format(
+        "page", "steamid", "in flight", "queued", "dropped"))
+
+    for page_class, pages in _ws_pages.items():
+        for page in pages:
+            stream = page._ws_stream
+            echo_console("{:<40}{:>20}{:>10}{:>8}{:>10}".format(
+                "{}/{}".format(page_class.plugin_id, page_class.page_id),
+                stream.motdplayer.steamid64, stream.ws_in_flight,
+                page.ws_queue_length, page.ws_data_dropped))
+
 
 @OnClientActive
 def listener_on_client_active(index):
@@ -676,6 +1420,8 @@ def listener_on_client_active(index):
 # TODO: Do we need to clear EntityDictionary on level init manually?
 @OnLevelInit
 def listener_on_level_init(map_name):
+    salt_writer.flush()
+
     for motdplayer in motdplayer_dictionary.values():
         motdplayer.close_all_sessions(SessionError.PLAYER_DROP)
     motdplayer_dictionary.clear()
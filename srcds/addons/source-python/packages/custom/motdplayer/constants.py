@@ -6,6 +6,7 @@ class SessionError(IntEnum):
     PLAYER_DROP = 1
     WS_TRANSMISSION_END = 2
     WS_SWITCHED_FROM = 3
+    WS_QUEUE_OVERFLOW = 4
 
 
 class PageRequestType(IntEnum):
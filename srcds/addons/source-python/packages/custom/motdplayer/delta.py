@@ -0,0 +1,66 @@
+"""Structural patches between two JSON-like values.
+
+A patch is a dictionary:
+    {'=': value}                    replace the value
+    {'o': {key: patch}, 'x': keys}  update and remove keys of an object
+    {'a': {index: patch}, 'n': n}   update items of an array (indices are
+                                    strings) and truncate/extend it to n
+    {}                              no changes
+
+motdplayer.js applies them in applyPatch().
+"""
+
+
+def make_patch(old, new):
+    """Return the patch that turns old into new, None if they're equal.
+
+    Neither value is modified, so both may be shared.
+    """
+    if isinstance(old, dict) and isinstance(new, dict):
+        changes = {}
+        for key, value in new.items():
+            if key not in old:
+                changes[key] = {'=': value}
+                continue
+
+            patch = make_patch(old[key], value)
+            if patch is not None:
+                changes[key] = patch
+
+        removed = [key for key in old if key not in new]
+        if not changes and not removed:
+            return None
+
+        patch = {}
+        if changes:
+            patch['o'] = changes
+        if removed:
+            patch['x'] = removed
+
+        return patch
+
+    if isinstance(old, (list, tuple)) and isinstance(new, (list, tuple)):
+        changes = {}
+        for i, value in enumerate(new):
+            if i >= len(old):
+                changes[str(i)] = {'=': value}
+                continue
+
+            patch = make_patch(old[i], value)
+            if patch is not None:
+                changes[str(i)] = patch
+
+        if not changes and len(old) == len(new):
+            return None
+
+        patch = {'a': changes}
+        if len(old) != len(new):
+            patch['n'] = len(new)
+
+        return patch
+
+    # 1 == 1.0 == True, but they're encoded differently
+    if type(old) is type(new) and old == new:
+        return None
+
+    return {'=': new}
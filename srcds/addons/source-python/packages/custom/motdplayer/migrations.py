@@ -0,0 +1,87 @@
+from sqlalchemy import Column, Integer, inspect, MetaData, Table, text
+from sqlalchemy.exc import DatabaseError
+
+
+SCHEMA_VERSION_TABLE = "motdplayers_srcds_schema_version"
+UPGRADE_ATTEMPTS = 3
+
+
+def has_index(connection, table_name, index_name):
+    return index_name in {
+        index['name'] for index in inspect(connection).get_indexes(
+            table_name)}
+
+
+def create_users_table(connection, user_model):
+    if not connection.dialect.has_table(connection, user_model.__tablename__):
+        user_model.__table__.create(connection)
+
+
+def add_users_unique_index(connection, user_model):
+    table = user_model.__tablename__
+
+    # Keep the row that .first() used to return, as that's the one
+    # whose salt is in use
+    connection.execute(text(
+        "DELETE FROM {table} WHERE id NOT IN ("
+        "SELECT id FROM (SELECT MIN(id) AS id FROM {table} "
+        "GROUP BY steamid64) AS keep)".format(table=table)))
+
+    for index in user_model.__table__.indexes:
+        if not has_index(connection, table, index.name):
+            index.create(connection)
+
+
+# Never reorder or remove steps: their positions are schema versions
+STEPS = (
+    create_users_table,
+    add_users_unique_index,
+)
+
+
+def upgrade(engine, user_model):
+    """Bring the schema up to date.
+
+    Servers sharing the database may upgrade at the same time, so every
+    step re-reads the version in its own transaction (locking the row
+    where the database supports it), and creates only what's missing.
+    If another server still wins the race to create a table or an index,
+    our statement fails and we start over with what it has left.
+    """
+    for attempt in range(1, UPGRADE_ATTEMPTS + 1):
+        try:
+            _upgrade(engine, user_model)
+        except DatabaseError:
+            if attempt == UPGRADE_ATTEMPTS:
+                raise
+        else:
+            return
+
+
+def _upgrade(engine, user_model):
+    version_table = Table(
+        SCHEMA_VERSION_TABLE, MetaData(),
+        Column('version', Integer, nullable=False),
+    )
+
+    with engine.begin() as connection:
+        if not connection.dialect.has_table(connection, SCHEMA_VERSION_TABLE):
+            version_table.create(connection)
+
+        # Racing servers may both insert a row: every update below sets
+        # all rows, so they stay equal
+        if connection.execute(version_table.select()).first() is None:
+            connection.execute(version_table.insert().values(version=0))
+
+    for step_version, step in enumerate(STEPS, start=1):
+        with engine.begin() as connection:
+            version = connection.execute(
+                version_table.select().with_for_update()).scalar()
+
+            if step_version <= version:
+                continue
+
+            step(connection, user_model)
+            connection.execute(version_table.update().where(
+                version_table.c.version < step_version).values(
+                    version=step_version))
@@ -0,0 +1,113 @@
+from threading import Event, Lock
+from traceback import format_exc
+
+from core import echo_console
+from listeners.tick import GameThread
+
+
+class SaltWriter:
+    """Persists rotated salts in the background.
+
+    Salts are coalesced per SteamID64 and written in a single transaction
+    every flush_interval seconds. Once more than max_unsaved rotations are
+    pending, the writer thread is woken up to write them right away, so a
+    crash only loses the rotations made since then. max_unsaved=0 wakes it
+    up for every salt. The game thread never waits for the database.
+    """
+    def __init__(self, session_factory, user_model, flush_interval,
+                 max_unsaved, exception_header):
+
+        self.session_factory = session_factory
+        self.user_model = user_model
+        self.flush_interval = flush_interval
+        self.max_unsaved = max_unsaved
+        self.exception_header = exception_header
+
+        self._pending = {}
+        self._unsaved_rotations = 0
+        self._lock = Lock()
+        self._flush_lock = Lock()
+        self._wakeup = Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+
+        self._thread = GameThread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+
+            try:
+                self.flush()
+            except Exception:
+                echo_console(self.exception_header)
+                echo_console(format_exc())
+
+    def get_pending(self, steamid64):
+        with self._lock:
+            return self._pending.get(steamid64)
+
+    def put(self, steamid64, salt):
+        with self._lock:
+            self._pending[steamid64] = salt
+            self._unsaved_rotations += 1
+            flush_now = self._unsaved_rotations > self.max_unsaved
+
+        self.start()
+
+        if flush_now:
+            self._wakeup.set()
+
+    def flush(self):
+        with self._flush_lock:
+            # Salts stay pending until they're committed, so that a player
+            # loaded in the meantime doesn't get the one from the database
+            with self._lock:
+                pending = dict(self._pending)
+                self._unsaved_rotations = 0
+
+            if not pending:
+                return
+
+            try:
+                self._write(pending)
+            except Exception:
+                with self._lock:
+                    self._unsaved_rotations += len(pending)
+
+                raise
+
+            # Keep the salts that have been rotated meanwhile
+            with self._lock:
+                for steamid64, salt in pending.items():
+                    if self._pending.get(steamid64) == salt:
+                        del self._pending[steamid64]
+
+    def _write(self, pending):
+        User = self.user_model
+        missing = dict(pending)
+        db_session = self.session_factory()
+
+        try:
+            users = db_session.query(User).filter(
+                User.steamid64.in_(list(pending))).all()
+
+            for user in users:
+                user.salt = missing.pop(user.steamid64)
+
+            # Players that were never loaded from the database
+            for steamid64, salt in missing.items():
+                user = User()
+                user.steamid64 = steamid64
+                user.salt = salt
+                db_session.add(user)
+
+            db_session.commit()
+        finally:
+            db_session.close()
@@ -0,0 +1,87 @@
+from base64 import urlsafe_b64encode
+from hashlib import sha512
+import hmac
+
+
+HMAC_DIGEST_SIZE = sha512().digest_size
+
+
+def get_legacy_token(personal_salt, server_id, plugin_id, steamid, page_id,
+                     session_id, server_salt):
+
+    return sha512(
+        (
+            personal_salt +
+            server_id +
+            plugin_id +
+            steamid +
+            page_id +
+            str(session_id)
+        ).encode('ascii') + server_salt
+    ).hexdigest()
+
+
+def verify_legacy_token(auth_token, expected_token):
+    try:
+        auth_token = auth_token.encode('ascii')
+    except UnicodeEncodeError:
+        return False
+
+    return hmac.compare_digest(auth_token, expected_token.encode('ascii'))
+
+
+def encode_token(digest):
+    return urlsafe_b64encode(digest).rstrip(b'=').decode('ascii')
+
+
+class HMACTokenizer:
+    """HMAC-SHA512 tokens keyed with the server salt.
+
+    The key is absorbed into the hash state once, and every token starts
+    from a copy of that state. Tokens are base64url digests truncated to
+    token_size bytes: 64 bytes are 86 characters, 32 bytes are 43.
+    """
+    def __init__(self, server_salt, token_size=HMAC_DIGEST_SIZE,
+                 min_token_size=HMAC_DIGEST_SIZE // 2):
+
+        if not min_token_size <= token_size <= HMAC_DIGEST_SIZE:
+            raise ValueError("Invalid token size: {}".format(token_size))
+
+        self.token_size = token_size
+        self.min_token_size = min_token_size
+
+        self._state = hmac.new(server_salt, digestmod=sha512)
+
+    def get_digest(self, personal_salt, server_id, plugin_id, steamid,
+                   page_id, session_id):
+
+        mac = self._state.copy()
+        mac.update('\n'.join((
+            personal_salt,
+            server_id,
+            plugin_id,
+            steamid,
+            page_id,
+            str(session_id),
+        )).encode('ascii'))
+
+        return mac.digest()
+
+    def get_token(self, *fields):
+        return encode_token(self.get_digest(*fields)[:self.token_size])
+
+    def verify(self, auth_token, *fields):
+        # Either side may be configured with shorter tokens
+        token_size = len(auth_token) * 3 // 4
+        if not self.min_token_size <= token_size <= HMAC_DIGEST_SIZE:
+            return False
+
+        try:
+            auth_token = auth_token.encode('ascii')
+        except UnicodeEncodeError:
+            return False
+
+        # Compared in the encoded form, so that every digest only has
+        # a single valid token
+        expected_token = encode_token(self.get_digest(*fields)[:token_size])
+        return hmac.compare_digest(auth_token, expected_token.encode('ascii'))